@@ -1,13 +1,48 @@
 # bank_bot.py
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ApplicationBuilder, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 import gspread
+import httpx
 from google.oauth2.service_account import Credentials
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import fcntl
+import functools
+import heapq
+import hmac
+import html
+import itertools
 import json
 import os
+import re
+import random
+import signal
+import sqlite3
+import ssl
+import struct
+import sys
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from http import HTTPStatus
+
+# Cold-start timing: seconds from module load to each startup milestone
+STARTUP_STARTED = time.monotonic()
+STARTUP_TIMINGS = {}
+
+def mark_startup(milestone):
+    """Record and print how long startup took to reach a milestone"""
+    elapsed = time.monotonic() - STARTUP_STARTED
+    STARTUP_TIMINGS[milestone] = elapsed
+    print(f"⏱️ {milestone} after {elapsed:.2f}s")
 
 # Config
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
@@ -16,93 +51,2040 @@ SPREADSHEET_NAME = "RBank"
 SERVICE_ACCOUNT_FILE = "tg-project-01-b8db80779692.json"
 CURRENCY = "₱"
 
-# Setup Google Sheets using modern google-auth
-scope = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/drive"
-]
+# Setup Google Sheets using modern google-auth
+scope = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive"
+]
+
+# The worksheet is opened in the background after startup, see connect_sheet()
+sheet = None
+SHEET_CONNECTED = asyncio.Event()
+
+def open_sheet():
+    """Authorize with the service account and open the bank worksheet (blocking)"""
+    # Get Google Sheets credentials from environment variables
+    google_creds_json = os.environ.get('GOOGLE_CREDS_JSON')
+    if google_creds_json:
+        creds_dict = json.loads(google_creds_json)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    else:
+        # Fallback to file (for local development only)
+        creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scope)
+    
+    client = gspread.authorize(creds)
+    return client.open(SPREADSHEET_NAME).sheet1
+
+# Roles: managers and co-owners keyed by Telegram user ID
+ROLES_PATH = os.environ.get("ROLES_PATH", "roles.json")
+ROLES_RELOAD_INTERVAL = float(os.environ.get("ROLES_RELOAD_INTERVAL", "5"))
+MANAGER = "manager"
+CO_OWNER = "co_owner"
+ROLE_SECTIONS = {MANAGER: "managers", CO_OWNER: "co_owners"}
+
+def write_file_atomic(path, text):
+    """Replace a file in one step, return its new mtime"""
+    # Per-process temp name, as worker processes may save at the same time
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+    return os.stat(path).st_mtime_ns
+
+def read_json_file(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def edit_json_file(path, change):
+    """Apply change to the JSON object in path under a lock on path.lock, return (data, mtime)"""
+    # Worker processes edit the same files, so every edit starts from the
+    # file as it is now rather than from the caller's copy
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = read_json_file(path)
+        except FileNotFoundError:
+            data = {}
+        change(data)
+        return data, write_file_atomic(path, json.dumps(data, ensure_ascii=False, indent=1))
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+class RoleRegistry:
+    """Managers and co-owners keyed by user ID, so checks are one dict lookup.
+
+    roles.json looks like {"managers": {"<id>": "<name>"}, "co_owners": {...},
+    "unclaimed": {"<username>": "manager"}}. Each change is applied to the
+    file as it is on disk, under a file lock and on a worker thread, so
+    worker processes never overwrite each other's changes. A background
+    task polls the file's mtime and reloads edits made by hand or by other
+    processes.
+
+    The old admins.json and co_owners.json held usernames. They are
+    imported as unclaimed entries, and each one is bound to a user ID the
+    first time that user is seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.roles = {}
+        self.names = {}
+        self.unclaimed = {}
+        self.mtime = None
+        self.save_lock = asyncio.Lock()
+        self.saves = set()
+        self.watcher = None
+
+    def apply(self, data):
+        roles = {}
+        names = {}
+        for role, section in ROLE_SECTIONS.items():
+            for user_id, name in data.get(section, {}).items():
+                roles[int(user_id)] = role
+                names[int(user_id)] = name
+        self.roles = roles
+        self.names = names
+        self.unclaimed = {username.lower(): role for username, role in data.get("unclaimed", {}).items()}
+
+    def load(self):
+        """Read roles.json, importing the legacy username lists if it does not exist yet"""
+        try:
+            with open(self.path, "r") as f:
+                self.apply(json.load(f))
+            self.mtime = file_mtime(self.path)
+            return
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Could not read {self.path}: {e}")
+            return
+        
+        unclaimed = {}
+        for legacy_path, role in (("admins.json", MANAGER), ("co_owners.json", CO_OWNER)):
+            try:
+                with open(legacy_path, "r") as f:
+                    for username in json.load(f):
+                        if username:
+                            unclaimed[username.lower()] = role
+            except:
+                pass
+        
+        def migrate(data):
+            # Another worker may have written it in the meantime
+            if not data:
+                data.update({section: {} for section in ROLE_SECTIONS.values()}, unclaimed=unclaimed)
+        data, self.mtime = edit_json_file(self.path, migrate)
+        self.apply(data)
+        if unclaimed:
+            print(f"✅ Imported {len(unclaimed)} roles by username into {self.path}")
+
+    def role(self, user):
+        """MANAGER, CO_OWNER or None; binds an unclaimed username to the user's ID"""
+        role = self.roles.get(user.id)
+        if role is None and self.unclaimed and user.username:
+            role = self.unclaimed.pop(user.username.lower(), None)
+            if role is not None:
+                self.roles[user.id] = role
+                self.names[user.id] = f"@{user.username}"
+                self.edit_soon(functools.partial(claim_role, user))
+        return role
+
+    def members(self, role):
+        """Display names of everyone holding a role, claimed or not"""
+        names = [self.names.get(user_id, str(user_id)) for user_id, held in self.roles.items() if held == role]
+        names += [f"@{username}" for username, held in self.unclaimed.items() if held == role]
+        return names
+
+    async def set(self, user, role):
+        """Give a user a role, or take it away with None, and save"""
+        await self.edit(functools.partial(assign_role, user, role))
+
+    async def edit(self, change):
+        """Apply change to roles.json and take on the result, including other processes' changes"""
+        async with self.save_lock:
+            data, self.mtime = await asyncio.to_thread(edit_json_file, self.path, change)
+            self.apply(data)
+
+    def edit_soon(self, change):
+        task = asyncio.get_running_loop().create_task(self.edit(change))
+        self.saves.add(task)
+        task.add_done_callback(self.saves.discard)
+
+    async def reload(self):
+        """Pick up edits made to roles.json since we last read or wrote it"""
+        async with self.save_lock:
+            mtime = await asyncio.to_thread(file_mtime, self.path)
+            if mtime is None or mtime == self.mtime:
+                return
+            try:
+                data = await asyncio.to_thread(read_json_file, self.path)
+            except Exception as e:
+                # Half-written by an editor; try again next time
+                print(f"⚠️ Could not reload {self.path}: {e}")
+                return
+            self.apply(data)
+            self.mtime = mtime
+            print(f"✅ Reloaded roles from {self.path}")
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(ROLES_RELOAD_INTERVAL)
+            await self.reload()
+
+    async def start(self):
+        self.watcher = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.watcher:
+            self.watcher.cancel()
+        if self.saves:
+            await asyncio.gather(*self.saves, return_exceptions=True)
+
+def assign_role(user, role, data):
+    """Give user role (None takes every role away) in roles.json data"""
+    username = user.username.lower() if user.username else None
+    unclaimed = data.setdefault("unclaimed", {})
+    for name in [name for name in unclaimed if name.lower() == username]:
+        del unclaimed[name]
+    for section in ROLE_SECTIONS.values():
+        data.setdefault(section, {}).pop(str(user.id), None)
+    if role is not None:
+        data[ROLE_SECTIONS[role]][str(user.id)] = f"@{user.username}" if user.username else user.first_name
+
+def claim_role(user, data):
+    """Bind user's username to their ID in roles.json data, unless another process took the role away"""
+    roles = [role for name, role in data.get("unclaimed", {}).items() if name.lower() == user.username.lower()]
+    if roles:
+        assign_role(user, roles[0], data)
+
+ROLES = RoleRegistry(ROLES_PATH)
+
+# Log channel, connected groups and the bank of each group, filled by load_settings()
+LOG_CHANNEL = None
+CONNECTED_GROUPS = []
+GROUP_BANKS = {}  # group ID -> bank name, for groups not on the default bank
+
+CONFIG_PATH = "config.json"
+
+def apply_config(config):
+    global LOG_CHANNEL, CONNECTED_GROUPS, GROUP_BANKS
+    LOG_CHANNEL = config.get("log_channel")
+    CONNECTED_GROUPS = config.get("connected_groups", [])
+    GROUP_BANKS = {int(group_id): bank for group_id, bank in config.get("banks", {}).items()}
+
+def load_settings():
+    """Load roles, log channel, connected groups and their banks"""
+    ROLES.load()
+    
+    try:
+        apply_config(read_json_file(CONFIG_PATH))
+    except:
+        apply_config({})
+
+async def edit_config(change):
+    """Apply change to config.json as it is on disk, then take on the result"""
+    config, _ = await asyncio.to_thread(edit_json_file, CONFIG_PATH, change)
+    apply_config(config)
+
+# Metrics: in-process counters and latency histograms, exported in the
+# Prometheus text format and summarised by /stats
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+
+class Counter:
+    """Monotonic counter with one value per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.label_names, labels)), value
+
+class Histogram:
+    """Latency histogram with fixed buckets per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # labels -> [count per bucket and +Inf, sum]
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, *labels):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def quantile(self, q, *labels):
+        """Estimate a quantile from the buckets, interpolating within one"""
+        counts = self.values.get(labels)
+        if not counts:
+            return 0.0
+        rank = q * sum(counts[:-1])
+        seen = 0
+        for i, count in enumerate(counts[:-1]):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        for labels, counts in self.values.items():
+            base = dict(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", dict(base, le=str(bound)), cumulative
+            yield f"{self.name}_sum", base, counts[-1]
+            yield f"{self.name}_count", base, cumulative
+
+HANDLER_SECONDS = Histogram("bank_handler_seconds", "Time spent handling an update", ("handler",))
+HANDLER_ERRORS = Counter("bank_handler_errors_total", "Updates whose handler raised", ("handler",))
+SHEETS_SECONDS = Histogram("bank_sheets_call_seconds", "Duration of Sheets calls, including queueing in the pool", ("method",))
+SHEETS_ERRORS = Counter("bank_sheets_errors_total", "Sheets calls that failed or timed out", ("method",))
+TELEGRAM_SECONDS = Histogram("bank_telegram_request_seconds", "Duration of Bot API requests", ("endpoint",))
+TELEGRAM_ERRORS = Counter("bank_telegram_errors_total", "Bot API requests that failed", ("endpoint",))
+TELEGRAM_BYTES = Counter("bank_telegram_bytes_total", "Bot API payload bytes", ("direction",))
+
+def metered(name, callback):
+    """Wrap a handler callback to record its latency and errors.
+
+    name is the handler label, or a function of the update returning one.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = name(update) if callable(name) else name
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, label)
+    return wrapper
+
+# Thread pool that runs blocking gspread calls off the event loop
+SHEETS_WORKERS = int(os.environ.get("SHEETS_WORKERS", "4"))
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "20"))
+SHEETS_EXECUTOR = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+# Sheets quota governor. Google allows 60 read and 60 write requests per
+# minute per user; every call waits for a token from its bucket first.
+SHEETS_READS_PER_MINUTE = int(os.environ.get("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.environ.get("SHEETS_WRITES_PER_MINUTE", "60"))
+SHEETS_WRITE_METHODS = {"batch_update", "append_row", "append_rows", "delete_rows", "add_worksheet"}
+SHEETS_MAX_RETRIES = 5
+SHEETS_RETRY_BASE = 1.0
+SHEETS_MAX_BACKOFF = 32.0
+
+SHEETS_RETRIES = Counter("bank_sheets_retries_total", "Sheets calls retried after a 429 or 5xx", ("method",))
+SHEETS_COALESCED = Counter("bank_sheets_coalesced_total", "Reads served by an identical read already in flight", ("method",))
+SHEETS_THROTTLED = Counter("bank_sheets_throttled_seconds_total", "Time Sheets calls waited for quota", ("kind",))
+
+class TokenBucket:
+    """Allows rate requests per second with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Hold the bucket after flood control, e.g. a RetryAfter"""
+        self.wait_time(time.monotonic())
+        # A token debt that refills to exactly one token after the pause
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self, now):
+        self.wait_time(now)
+        return self.tokens >= self.capacity
+
+class SheetsQuota:
+    """Read and write token buckets; callers queue for tokens in arrival order"""
+
+    def __init__(self):
+        # Bursts of up to ten seconds' worth of quota
+        self.buckets = {
+            "read": TokenBucket(SHEETS_READS_PER_MINUTE / 60, max(1, SHEETS_READS_PER_MINUTE / 6)),
+            "write": TokenBucket(SHEETS_WRITES_PER_MINUTE / 60, max(1, SHEETS_WRITES_PER_MINUTE / 6)),
+        }
+        self.locks = {"read": asyncio.Lock(), "write": asyncio.Lock()}
+
+    async def acquire(self, kind):
+        bucket = self.buckets[kind]
+        async with self.locks[kind]:
+            started = time.monotonic()
+            while True:
+                wait = bucket.wait_time(time.monotonic())
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            bucket.take()
+            SHEETS_THROTTLED.inc(kind, amount=time.monotonic() - started)
+
+SHEETS_QUOTA = SheetsQuota()
+# Reads in flight, keyed by method, worksheet and arguments
+SHEETS_INFLIGHT_READS = {}
+
+async def sheets_call(func, *args, **kwargs):
+    """Run a gspread call in the Sheets thread pool under the quota governor.
+
+    Identical reads already in flight are shared rather than repeated;
+    any write starts a fresh generation so later reads see it. 429s are
+    retried with jittered exponential backoff, as are 5xx errors on calls
+    that are safe to repeat.
+    """
+    method = getattr(func, "__name__", "call")
+    target = getattr(func, "__self__", None)
+    if method in SHEETS_WRITE_METHODS:
+        SHEETS_INFLIGHT_READS.clear()
+        # Row appends and deletes may already have happened when Google answers 5xx
+        idempotent = method == "batch_update" and (
+            target is sheet or any(target is worksheet for worksheet in BANK_WORKSHEETS.values()))
+        return await governed_sheets_call("write", idempotent, method, func, args, kwargs)
+    
+    try:
+        key = (method, id(target), args, tuple(sorted(kwargs.items())))
+        pending = SHEETS_INFLIGHT_READS.get(key)
+    except TypeError:
+        # Unhashable arguments, nothing to coalesce
+        return await governed_sheets_call("read", True, method, func, args, kwargs)
+    if pending is not None:
+        SHEETS_COALESCED.inc(method)
+        return await asyncio.shield(pending)
+    
+    pending = asyncio.ensure_future(governed_sheets_call("read", True, method, func, args, kwargs))
+    SHEETS_INFLIGHT_READS[key] = pending
+    
+    def forget(future):
+        if SHEETS_INFLIGHT_READS.get(key) is future:
+            del SHEETS_INFLIGHT_READS[key]
+        if not future.cancelled():
+            # Mark the exception retrieved even if every caller went away
+            future.exception()
+    
+    pending.add_done_callback(forget)
+    return await asyncio.shield(pending)
+
+async def governed_sheets_call(kind, idempotent, method, func, args, kwargs):
+    attempt = 0
+    while True:
+        await SHEETS_QUOTA.acquire(kind)
+        try:
+            return await run_sheets_call(method, func, args, kwargs)
+        except gspread.exceptions.APIError as e:
+            status = getattr(e.response, "status_code", 0)
+            if not (status == 429 or (status >= 500 and idempotent)) or attempt >= SHEETS_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(SHEETS_MAX_BACKOFF, SHEETS_RETRY_BASE * 2 ** attempt))
+            if status == 429:
+                # Everyone else waits out the quota window too
+                SHEETS_QUOTA.buckets[kind].pause(delay)
+            attempt += 1
+            SHEETS_RETRIES.inc(method)
+            await asyncio.sleep(delay)
+
+async def run_sheets_call(method, func, args, kwargs):
+    """Run one blocking gspread call in the Sheets thread pool.
+
+    Raises asyncio.TimeoutError after SHEETS_TIMEOUT seconds. A call that
+    times out or is cancelled while still queued never reaches Google; one
+    that is already running finishes in its worker thread and is discarded.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        future = loop.run_in_executor(SHEETS_EXECUTOR, functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, SHEETS_TIMEOUT)
+    except Exception:
+        SHEETS_ERRORS.inc(method)
+        raise
+    finally:
+        SHEETS_SECONDS.observe(time.perf_counter() - started, method)
+
+async def connect_sheet():
+    """Open the worksheet, retrying with backoff until Google answers"""
+    global sheet
+    failures = 0
+    while True:
+        try:
+            sheet = await sheets_call(open_sheet)
+            break
+        except Exception as e:
+            failures += 1
+            print(f"Failed to connect to the sheet: {e}")
+            await asyncio.sleep(min(2 ** failures, FLUSH_MAX_BACKOFF))
+    SHEET_CONNECTED.set()
+    mark_startup("sheet_connected")
+    return sheet
+
+# Storage backend: "sqlite" keeps the ledger in a local database and mirrors
+# it to the sheet in the background, "sheets" reads and writes the sheet itself
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bank.db")
+JOURNAL_PATH = os.environ.get("JOURNAL_PATH", "transactions.jsonl")
+JOURNAL_INDEX_INTERVAL = int(os.environ.get("JOURNAL_INDEX_INTERVAL", "1000"))
+HISTORY_PAGE_SIZE = 10
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", "900"))
+DATA_LIST_PAGE_SIZE = 25
+DATA_LIST_NAME_LENGTH = 32
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Write-behind mode for the sheets backend: the sheet is loaded into memory,
+# that local state becomes authoritative and mutations are flushed back in
+# one batch_update every FLUSH_INTERVAL_MS or FLUSH_MAX_PENDING mutations.
+# The same flusher replicates the sqlite backend to the sheet.
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND") == "1"
+FLUSH_INTERVAL_MS = int(os.environ.get("FLUSH_INTERVAL_MS", "2000"))
+FLUSH_MAX_PENDING = int(os.environ.get("FLUSH_MAX_PENDING", "50"))
+FLUSH_MAX_BACKOFF = 60
+
+# Banks: a group can be served by its own bank, kept on a worksheet of the
+# same spreadsheet and in its own local files. The default bank is sheet1.
+BANK_CACHE_SIZE = int(os.environ.get("BANK_CACHE_SIZE", "8"))
+BANK_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+BANK_WORKSHEETS = {}  # bank name -> worksheet, for loaded banks
+SHEET_HEADER = ["User ID", "Name", "Username", "Link", "Balance", "Created", "Last Transaction"]
+
+def bank_path(path, bank):
+    """Local file of a bank: bank.db for the default bank, bank.<name>.db for others"""
+    if bank is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{bank}{ext}"
+
+def bank_worksheet(bank):
+    return sheet if bank is None else BANK_WORKSHEETS.get(bank)
+
+def canonical_bank_name(bank):
+    """Name of the bank bank refers to; worksheet titles ignore case, so banks must too"""
+    for existing in GROUP_BANKS.values():
+        if existing.lower() == bank.lower():
+            return existing
+    return bank
+
+async def open_bank_worksheet(bank):
+    """Open the worksheet of a bank, adding it with a header row if it is new"""
+    await SHEET_CONNECTED.wait()
+    if bank.lower() == sheet.title.lower():
+        raise ValueError(f"{bank} is the worksheet of the default bank")
+    try:
+        worksheet = await sheets_call(sheet.spreadsheet.worksheet, bank)
+    except gspread.WorksheetNotFound:
+        worksheet = await sheets_call(sheet.spreadsheet.add_worksheet, bank, 1000, ACCOUNT_COLUMNS)
+        await sheets_call(worksheet.append_row, SHEET_HEADER)
+        print(f"✅ Added worksheet for bank {bank}")
+        return worksheet
+    
+    # Never take over a tab that holds something else
+    header = await sheets_call(worksheet.row_values, 1)
+    if not header:
+        await sheets_call(worksheet.append_row, SHEET_HEADER)
+    elif header[:ACCOUNT_COLUMNS] != SHEET_HEADER:
+        raise ValueError(f"worksheet {bank} already exists and does not hold a bank")
+    return worksheet
+
+# Sheet layout (1-based column numbers)
+COL_USER_ID = 1
+COL_NAME = 2
+COL_USERNAME = 3
+COL_LINK = 4
+COL_BALANCE = 5
+COL_CREATED = 6
+COL_LAST_TRANSACTION = 7
+ACCOUNT_COLUMNS = 7
+
+def row_to_account(values):
+    """Turn a raw sheet row into an account dict"""
+    values = ["" if value is None else value for value in values]
+    values += [""] * (ACCOUNT_COLUMNS - len(values))
+    return {
+        "user_id": str(values[COL_USER_ID - 1]),
+        "name": values[COL_NAME - 1],
+        "username": values[COL_USERNAME - 1],
+        "link": values[COL_LINK - 1],
+        "balance": float(values[COL_BALANCE - 1] or 0),
+        "created": values[COL_CREATED - 1],
+        "last_transaction": values[COL_LAST_TRANSACTION - 1],
+    }
+
+def account_to_row(account):
+    """Turn an account dict into a sheet row"""
+    return [
+        account["user_id"],
+        account["name"],
+        account["username"],
+        account["link"],
+        str(account["balance"]),
+        account["created"],
+        account["last_transaction"],
+    ]
+
+def new_account(user_id, name, username, link):
+    """Account dict for a freshly created account"""
+    return {
+        "user_id": str(user_id),
+        "name": name,
+        "username": username,
+        "link": link,
+        "balance": 0.0,
+        "created": format_datetime(),
+        "last_transaction": "",
+    }
+
+def make_transaction(amount, executor_id, executor_name, transaction_type="added"):
+    """Build a transaction history entry"""
+    return {
+        "timestamp": format_datetime(),
+        "amount": amount,
+        "executor_id": executor_id,
+        "executor_name": executor_name,
+        "type": transaction_type
+    }
+
+def index_sheet_rows(rows):
+    """Build a user ID -> row index from sheet rows (row 1 is the header)"""
+    return {str(values[0]): i + 1 for i, values in enumerate(rows) if i > 0 and values and values[0]}
+
+def appended_rows(response):
+    """Row numbers gspread reports for an append"""
+    # updatedRange looks like "Sheet1!A5:G7"
+    updated_range = response["updates"]["updatedRange"].split("!")[-1]
+    first_cell, _, last_cell = updated_range.partition(":")
+    first_row, _ = gspread.utils.a1_to_rowcol(first_cell)
+    last_row, _ = gspread.utils.a1_to_rowcol(last_cell or first_cell)
+    return list(range(first_row, last_row + 1))
+
+def shift_deleted_rows(rows, deleted):
+    """Drop deleted rows from a user ID -> row index and shift the rows below them up"""
+    deleted = sorted(deleted)
+    removed = set(deleted)
+    return {
+        user_id: row - bisect.bisect_left(deleted, row)
+        for user_id, row in rows.items()
+        if row not in removed
+    }
+
+def balance_ranges(row, balance, last_transaction):
+    """batch_update ranges for the balance and last transaction of one row"""
+    return [
+        {"range": gspread.utils.rowcol_to_a1(row, COL_BALANCE), "values": [[str(balance)]]},
+        {"range": gspread.utils.rowcol_to_a1(row, COL_LAST_TRANSACTION), "values": [[last_transaction]]},
+    ]
+
+# One lock per account so read-modify-write mutations on the same account
+# are applied in order while different accounts proceed in parallel.
+# Entries disappear once no coroutine holds or waits on the lock.
+ACCOUNT_LOCKS = weakref.WeakValueDictionary()
+# In worker mode the lock also covers other processes: byte <user ID> of this file
+ACCOUNT_LOCK_PATH = os.environ.get("ACCOUNT_LOCK_PATH", "accounts.lock")
+ACCOUNT_LOCK_FILE = None
+ACCOUNT_LOCK_POLL = 0.01
+
+class ProcessAccountLock:
+    """Account lock shared by every worker process.
+
+    An asyncio lock orders the coroutines of this process, then a byte-range
+    lock on ACCOUNT_LOCK_PATH orders the processes. POSIX record locks are
+    per process, so the asyncio lock must be held first. The byte lock is
+    polled rather than waited on in a thread, so a cancelled waiter never
+    leaves it held.
+    """
+
+    def __init__(self, key):
+        self.lock = asyncio.Lock()
+        self.offset = int(key) if key.isdigit() else zlib.crc32(key.encode())
+
+    async def __aenter__(self):
+        global ACCOUNT_LOCK_FILE
+        if ACCOUNT_LOCK_FILE is None:
+            ACCOUNT_LOCK_FILE = os.open(ACCOUNT_LOCK_PATH, os.O_RDWR | os.O_CREAT)
+        await self.lock.acquire()
+        try:
+            while True:
+                try:
+                    fcntl.lockf(ACCOUNT_LOCK_FILE, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.offset)
+                    return
+                except OSError:
+                    await asyncio.sleep(ACCOUNT_LOCK_POLL)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        fcntl.lockf(ACCOUNT_LOCK_FILE, fcntl.LOCK_UN, 1, self.offset)
+        self.lock.release()
+
+def account_lock(user_id):
+    """Get the lock that serialises mutations of one account"""
+    key = str(user_id)
+    lock = ACCOUNT_LOCKS.get(key)
+    if lock is None:
+        lock = ProcessAccountLock(key) if BOT_MODE == "worker" else asyncio.Lock()
+        ACCOUNT_LOCKS[key] = lock
+    return lock
+
+class SheetMirror:
+    """Replicates locally held accounts to the sheet in the background.
+
+    Changed user IDs are marked dirty. A flush compares each of them with
+    the local source of truth and the sheet's row index, then deletes,
+    rewrites and appends rows with at most one Sheets call each. Failed
+    flushes keep their accounts dirty and are retried with backoff.
+    """
+
+    def __init__(self, source, bank=None):
+        self.source = source  # user ID -> account dict or None
+        self.bank = bank
+        self.rows = None  # user ID -> sheet row, loaded on first flush
+        self.dirty = set()
+        self.pending = 0
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    @property
+    def sheet(self):
+        return bank_worksheet(self.bank)
+
+    async def load_index(self):
+        """Load the user ID -> row index from the first column of the sheet"""
+        column = await sheets_call(self.sheet.col_values, COL_USER_ID)
+        self.rows = index_sheet_rows([[value] for value in column])
+
+    def mark(self, user_id):
+        """Queue an account for the next flush"""
+        self.dirty.add(str(user_id))
+        self.pending += 1
+        if self.pending >= FLUSH_MAX_PENDING:
+            self.wakeup.set()
+
+    async def flush(self):
+        """Push every dirty account to the sheet, return False if that failed"""
+        if not self.dirty:
+            return True
+        
+        async with self.lock:
+            user_ids = list(self.dirty)
+            self.dirty.clear()
+            self.pending = 0
+            try:
+                if self.rows is None:
+                    await self.load_index()
+                await self.push(user_ids)
+                return True
+            except Exception as e:
+                # Accounts changed meanwhile are already dirty again; just re-add ours
+                self.dirty.update(user_ids)
+                print(f"Failed to flush {len(user_ids)} accounts to the sheet: {e}")
+                return False
+
+    async def push(self, user_ids):
+        """Bring the sheet rows of the given accounts in line with the source"""
+        deleted = [self.rows[user_id] for user_id in user_ids
+                   if user_id in self.rows and self.source(user_id) is None]
+        
+        # Delete bottom-up in one request so the remaining row numbers stay valid
+        if deleted:
+            deleted.sort(reverse=True)
+            await sheets_call(self.sheet.spreadsheet.batch_update, {"requests": [
+                {"deleteDimension": {"range": {
+                    "sheetId": self.sheet.id,
+                    "dimension": "ROWS",
+                    "startIndex": row - 1,
+                    "endIndex": row,
+                }}}
+                for row in deleted
+            ]})
+            self.rows = shift_deleted_rows(self.rows, deleted)
+        
+        # Rows are written RAW so names are never read as formulas; only the
+        # balance and last transaction cells are parsed, as update_cell did
+        updates = []
+        parsed = []
+        appends = []
+        for user_id in user_ids:
+            account = self.source(user_id)
+            if account is None:
+                continue
+            row = self.rows.get(user_id)
+            if row:
+                updates.append({
+                    "range": f"{gspread.utils.rowcol_to_a1(row, 1)}:{gspread.utils.rowcol_to_a1(row, ACCOUNT_COLUMNS)}",
+                    "values": [account_to_row(account)],
+                })
+                parsed += balance_ranges(row, account["balance"], account["last_transaction"])
+            else:
+                appends.append(account)
+        if updates:
+            await sheets_call(self.sheet.batch_update, updates,
+                              value_input_option=gspread.utils.ValueInputOption.raw)
+        
+        # Append new accounts in one request
+        if appends:
+            response = await sheets_call(self.sheet.append_rows, [account_to_row(account) for account in appends],
+                                         value_input_option=gspread.utils.ValueInputOption.raw)
+            for account, row in zip(appends, appended_rows(response)):
+                self.rows[account["user_id"]] = row
+                parsed += balance_ranges(row, account["balance"], account["last_transaction"])
+        if parsed:
+            await sheets_call(self.sheet.batch_update, parsed,
+                              value_input_option=gspread.utils.ValueInputOption.user_entered)
+
+    async def run(self):
+        """Flush every FLUSH_INTERVAL_MS or FLUSH_MAX_PENDING mutations"""
+        # Changes are only marked until the sheet is reachable
+        await SHEET_CONNECTED.wait()
+        failures = 0
+        while True:
+            if failures:
+                # Back off on failed flushes instead of hammering the quota
+                await asyncio.sleep(min(FLUSH_INTERVAL_MS / 1000 * 2 ** failures, FLUSH_MAX_BACKOFF))
+            else:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), FLUSH_INTERVAL_MS / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            if await self.flush():
+                failures = 0
+            else:
+                failures = min(failures + 1, 6)
+
+    async def start(self):
+        """Start the background flusher"""
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flusher and push every pending change"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if not SHEET_CONNECTED.is_set():
+            if self.dirty:
+                print(f"⚠️ {len(self.dirty)} accounts were not flushed, the sheet never connected")
+            return
+        for attempt in range(5):
+            if await self.flush():
+                return
+            await asyncio.sleep(2 ** attempt)
+        print(f"⚠️ {len(self.dirty)} accounts could not be flushed to the sheet on shutdown")
+
+class TransactionJournal:
+    """Append-only, on-disk transaction history with a per-user offset index.
+
+    Every transaction is one JSON line in the journal file. The index maps
+    each user ID to the byte offsets of their entries, so appends are a
+    single write and a page of history is a handful of seeks, newest first.
+    A reset appends a marker that clears the user's entries from the index.
+    Alongside the offsets it keeps running totals per user, keyed by
+    executor ID and transaction type, so summaries never read the history.
+
+    Appends are fsynced before they return, so a recorded transaction
+    survives a crash. The journal is only touched from its own thread:
+    callers go through run(). The index is saved next to the journal every
+    JOURNAL_INDEX_INTERVAL entries and on close; on open it is loaded and
+    only the part of the journal written after it is scanned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.offsets = {}
+        self.totals = {}
+        self.writer = None
+        self.reader = None
+        self.unsaved = 0  # entries written since the index was last saved
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    async def run(self, work, *args):
+        """Call work(*args) on the journal thread, return its result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, work, *args)
+
+    def open(self):
+        start = 0
+        try:
+            with open(self.index_path, "r") as f:
+                saved = json.load(f)
+            if saved["size"] <= os.path.getsize(self.path):
+                self.offsets = saved["offsets"]
+                self.totals = {
+                    user_id: {(executor_id, kind): [name, amount, count] for executor_id, kind, name, amount, count in rows}
+                    for user_id, rows in saved["totals"].items()
+                }
+                start = saved["size"]
+        except:
+            # Missing, stale or pre-totals index: rebuild everything from the journal
+            self.offsets = {}
+            self.totals = {}
+        self.writer = open(self.path, "ab")
+        self.reader = open(self.path, "rb")
+        self.scan(start)
+
+    def scan(self, start):
+        """Index every entry from byte offset start to the end of the journal"""
+        if start == 0:
+            self.offsets = {}
+            self.totals = {}
+        self.reader.seek(start)
+        offset = start
+        for line in self.reader:
+            if not line.endswith(b"\n"):
+                # Torn write from a crash: drop the partial entry
+                self.writer.truncate(offset)
+                break
+            self.index_entry(json.loads(line), offset)
+            offset += len(line)
+        if offset > start:
+            self.save_index()
+
+    def index_entry(self, entry, offset):
+        if entry["type"] == "reset":
+            self.offsets.pop(entry["user_id"], None)
+            self.totals.pop(entry["user_id"], None)
+        else:
+            self.offsets.setdefault(entry["user_id"], []).append(offset)
+            totals = self.totals.setdefault(entry["user_id"], {})
+            total = totals.setdefault((entry["executor_id"], entry["type"]), [entry["executor_name"], 0.0, 0])
+            total[0] = entry["executor_name"]
+            total[1] += entry["amount"]
+            total[2] += 1
+
+    def write(self, entries):
+        """Append entries with a single durable write and index them"""
+        if not entries:
+            return
+        offset = self.writer.seek(0, os.SEEK_END)
+        lines = [(json.dumps(entry, ensure_ascii=False) + "\n").encode() for entry in entries]
+        self.writer.write(b"".join(lines))
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        for entry, line in zip(entries, lines):
+            self.index_entry(entry, offset)
+            offset += len(line)
+        self.unsaved += len(entries)
+        if self.unsaved >= JOURNAL_INDEX_INTERVAL:
+            self.save_index()
+
+    def append(self, user_id, transaction):
+        self.write([dict(transaction, user_id=str(user_id))])
+
+    def clear(self, user_id):
+        self.write([{"user_id": str(user_id), "type": "reset", "timestamp": format_datetime()}])
+
+    def count(self, user_id):
+        return len(self.offsets.get(str(user_id), []))
+
+    def executor_totals(self, user_id):
+        """Running totals of one user as dicts, in order of first appearance"""
+        return [
+            {"executor_id": executor_id, "type": kind, "executor_name": name, "amount": amount, "count": count}
+            for (executor_id, kind), (name, amount, count) in self.totals.get(str(user_id), {}).items()
+        ]
+
+    def page(self, user_id, offset=0, limit=None):
+        """Entries of one user, newest first, skipping the newest offset entries"""
+        offsets = self.offsets.get(str(user_id), [])
+        end = len(offsets) - offset
+        start = 0 if limit is None else max(end - limit, 0)
+        entries = []
+        for position in reversed(offsets[start:max(end, 0)]):
+            self.reader.seek(position)
+            entry = json.loads(self.reader.readline())
+            del entry["user_id"]
+            entries.append(entry)
+        return entries
+
+    def save_index(self):
+        """Save the index for everything written so far, so open only scans what follows"""
+        write_file_atomic(self.index_path, json.dumps({
+            "size": self.writer.seek(0, os.SEEK_END),
+            "offsets": self.offsets,
+            "totals": {
+                user_id: [[executor_id, kind, *total] for (executor_id, kind), total in totals.items()]
+                for user_id, totals in self.totals.items()
+            },
+        }))
+        self.unsaved = 0
+
+    def close(self):
+        if not self.writer:
+            return
+        self.save_index()
+        self.writer.close()
+        self.reader.close()
+        self.writer = None
+
+# Snapshot of the write-behind account cache, so a restart can serve from
+# local state straight away and check it against the sheet in the background
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "accounts.snapshot")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_MAGIC = b"RBSN"
+SNAPSHOT_VERSION = 1
+# magic, version, account count, unflushed ID count, accounts_checksum(), CRC-32 of the body
+SNAPSHOT_HEADER = struct.Struct("<4sHIIII")
+SNAPSHOT_BALANCE = struct.Struct("<d")
+SNAPSHOT_STRING = struct.Struct("<H")
+SNAPSHOT_FIELDS = ("user_id", "name", "username", "link", "created", "last_transaction")
+
+def accounts_checksum(accounts):
+    """Order-independent checksum of account contents"""
+    total = 0
+    for account in accounts:
+        fields = [str(account[field] or "") for field in SNAPSHOT_FIELDS]
+        fields.append(f"{account['balance']:.2f}")
+        total += zlib.crc32("\x1f".join(fields).encode())
+    return total & 0xFFFFFFFF
+
+def pack_snapshot_string(body, value):
+    value = str(value or "").encode()[:0xFFFF]
+    body += SNAPSHOT_STRING.pack(len(value)) + value
+
+def save_snapshot(path, accounts, dirty):
+    """Write accounts and the IDs not yet flushed to the sheet to a binary snapshot, atomically"""
+    body = bytearray()
+    for account in accounts:
+        body += SNAPSHOT_BALANCE.pack(account["balance"])
+        for field in SNAPSHOT_FIELDS:
+            pack_snapshot_string(body, account[field])
+    for user_id in dirty:
+        pack_snapshot_string(body, user_id)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(accounts), len(dirty),
+                                  accounts_checksum(accounts), zlib.crc32(body))
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(header + body)
+    os.replace(temp_path, path)
+
+def load_snapshot(path):
+    """Read a snapshot, return (accounts, dirty IDs, checksum) or None if unusable"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, count, dirty_count, checksum, body_crc = SNAPSHOT_HEADER.unpack_from(data)
+        body = memoryview(data)[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or zlib.crc32(body) != body_crc:
+            return None
+        offset = 0
+        
+        def read_string():
+            nonlocal offset
+            (length,) = SNAPSHOT_STRING.unpack_from(body, offset)
+            offset += SNAPSHOT_STRING.size + length
+            return bytes(body[offset - length:offset]).decode()
+        
+        accounts = []
+        for _ in range(count):
+            (balance,) = SNAPSHOT_BALANCE.unpack_from(body, offset)
+            offset += SNAPSHOT_BALANCE.size
+            account = {"balance": balance}
+            for field in SNAPSHOT_FIELDS:
+                account[field] = read_string()
+            accounts.append(account)
+        dirty = {read_string() for _ in range(dirty_count)}
+        return accounts, dirty, checksum
+    except (OSError, struct.error, UnicodeDecodeError):
+        return None
+
+class SharedLock:
+    """Lock held by many shared holders at once, or by one exclusive holder.
+
+    A waiting exclusive holder keeps new shared holders out, so it is not
+    starved by a steady stream of them.
+    """
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.shared_holders = 0
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.exclusive_held and not self.exclusive_waiting)
+            self.shared_holders += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.shared_holders -= 1
+                self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self.condition:
+            self.exclusive_waiting += 1
+            try:
+                await self.condition.wait_for(lambda: not self.exclusive_held and not self.shared_holders)
+            finally:
+                self.exclusive_waiting -= 1
+                # Shared holders waiting behind us may go ahead if we gave up
+                self.condition.notify_all()
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
+
+class SheetsStorage:
+    """Accounts stored in the Google Sheet itself.
+
+    In write-through mode every read and write is a Sheets call, with an
+    in-memory user ID -> row index so lookups need no column scan. With
+    write_behind the whole sheet is loaded at startup, that local copy is
+    authoritative and a SheetMirror writes changes back. Write-behind
+    state is also snapshotted to SNAPSHOT_PATH; when a snapshot exists it
+    is served at once and reconciled with the sheet in the background.
+    Transaction history is kept in a TransactionJournal.
+    """
+
+    def __init__(self, write_behind=False, bank=None):
+        self.write_behind = write_behind
+        self.bank = bank
+        self.rows = {}  # user ID -> sheet row (write-through)
+        self.row_order = []  # the values of rows, ascending, for paging (write-through)
+        self.balances = {}  # user ID -> last known balance (write-through)
+        self.accounts = {}  # user ID -> account (write-behind)
+        self.total_accounts = 0
+        self.total_value = 0.0
+        # Row numbers are resolved and used under a shared hold, so balance
+        # writes run in parallel; creates and deletes hold it exclusively
+        # so no row shifts underneath an in-flight read or write
+        self.rows_lock = SharedLock()
+        self.mirror = SheetMirror(self.accounts.get, bank) if write_behind else None
+        self.journal = TransactionJournal(bank_path(JOURNAL_PATH, bank))
+        self.snapshot_path = bank_path(SNAPSHOT_PATH, bank)
+        self.reconciler = None
+        self.snapshotter = None
+        self.touched = None  # accounts changed since the snapshot was loaded, until it is reconciled
+
+    @property
+    def sheet(self):
+        return bank_worksheet(self.bank)
+
+    async def start(self):
+        await self.journal.run(self.journal.open)
+        if not (self.write_behind and self.load_snapshot()):
+            await SHEET_CONNECTED.wait()
+            rows = await sheets_call(self.sheet.get_all_values)
+            self.load_rows(rows)
+            if self.write_behind:
+                self.mirror.rows = index_sheet_rows(rows)
+                self.snapshotter = asyncio.create_task(self.snapshot_periodically())
+        if self.write_behind:
+            await self.mirror.start()
+        self.reconciler = asyncio.create_task(reconcile_totals_periodically(self))
+
+    async def stop(self):
+        for task in (self.reconciler, self.snapshotter):
+            if task:
+                task.cancel()
+        if self.mirror:
+            await self.mirror.stop()
+            self.save_snapshot()
+        await self.journal.run(self.journal.close)
+        self.journal.executor.shutdown()
+
+    def load_snapshot(self):
+        """Serve from the local snapshot if there is one, return False otherwise"""
+        started = time.monotonic()
+        snapshot = load_snapshot(self.snapshot_path)
+        if snapshot is None:
+            return False
+        accounts, dirty, checksum = snapshot
+        self.accounts.update((account["user_id"], account) for account in accounts)
+        self.total_accounts = len(accounts)
+        self.total_value = sum(account["balance"] for account in accounts)
+        self.touched = set()
+        # Changes that never reached the sheet before the last shutdown
+        for key in dirty:
+            self.changed(key)
+        self.snapshotter = asyncio.create_task(self.reconcile_snapshot(len(accounts), checksum))
+        print(f"✅ Loaded {len(accounts)} accounts from the snapshot in {(time.monotonic() - started) * 1000:.1f}ms")
+        return True
+
+    async def reconcile_snapshot(self, count, checksum):
+        """Compare the snapshot with the sheet by row count and checksum.
+
+        On a mismatch the sheet wins for every account that has not been
+        changed locally since startup, as it would on a cold start.
+        """
+        await SHEET_CONNECTED.wait()
+        failures = 0
+        while True:
+            try:
+                rows = await sheets_call(self.sheet.get_all_values)
+                break
+            except Exception as e:
+                failures += 1
+                print(f"Failed to read the sheet for snapshot reconciliation: {e}")
+                await asyncio.sleep(min(2 ** failures, FLUSH_MAX_BACKOFF))
+        
+        accounts = [row_to_account(values) for values in rows[1:] if values and values[0]]
+        if len(accounts) != count or accounts_checksum(accounts) != checksum:
+            in_sheet = set()
+            for account in accounts:
+                in_sheet.add(account["user_id"])
+                if account["user_id"] not in self.touched:
+                    self.accounts[account["user_id"]] = account
+            for key in list(self.accounts):
+                if key not in in_sheet and key not in self.touched:
+                    del self.accounts[key]
+            await self.reconcile_totals()
+            print(f"⚠️ Snapshot ({count} accounts) differed from the sheet ({len(accounts)} accounts), sheet edits applied")
+        self.touched = None
+        await self.snapshot_periodically()
+
+    async def snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                print(f"Failed to save account snapshot: {e}")
+
+    def save_snapshot(self):
+        save_snapshot(self.snapshot_path, list(self.accounts.values()), self.mirror.dirty)
+
+    def changed(self, key):
+        """Queue a write-behind change for the sheet"""
+        self.mirror.mark(key)
+        if self.touched is not None:
+            self.touched.add(key)
+
+    def load_rows(self, rows):
+        """Rebuild the local state and running totals from a full sheet read"""
+        accounts = [row_to_account(values) for values in rows[1:] if values and values[0]]
+        if self.write_behind:
+            self.accounts.clear()
+            self.accounts.update((account["user_id"], account) for account in accounts)
+        else:
+            self.rows = index_sheet_rows(rows)
+            self.row_order = sorted(self.rows.values())
+            self.balances = {account["user_id"]: account["balance"] for account in accounts}
+        self.total_accounts = len(accounts)
+        self.total_value = sum(account["balance"] for account in accounts)
+
+    def known_balance(self, key):
+        if self.write_behind:
+            return self.accounts[key]["balance"]
+        return self.balances.get(key, 0.0)
+
+    async def known_balances(self, user_ids):
+        """Balances as of this bot's last read or write, without a Sheets call"""
+        known = self.accounts if self.write_behind else self.rows
+        return {key: self.known_balance(key) for key in map(str, user_ids) if key in known}
+
+    async def get(self, user_id):
+        key = str(user_id)
+        if self.write_behind:
+            account = self.accounts.get(key)
+            return dict(account) if account else None
+        async with self.rows_lock.shared():
+            row = self.rows.get(key)
+            if not row:
+                return None
+            known = self.balances.get(key, 0.0)
+            account = row_to_account(await sheets_call(self.sheet.row_values, row))
+            # Pick up edits made directly in the sheet, unless a write of our
+            # own landed during the read; the value read may predate it
+            if self.balances.get(key, 0.0) == known:
+                self.total_value += account["balance"] - known
+                self.balances[key] = account["balance"]
+        return account
+
+    async def all(self):
+        if self.write_behind:
+            return [dict(account) for account in self.accounts.values()]
+        rows = await sheets_call(self.sheet.get_all_values)
+        return [row_to_account(values) for values in rows[1:] if values and values[0]]
+
+    async def account_page(self, offset, limit):
+        if self.write_behind:
+            page = itertools.islice(reversed(self.accounts.values()), offset, offset + limit)
+            return [dict(account) for account in page]
+        # Read only the rows on this page in one range request
+        async with self.rows_lock.shared():
+            end = len(self.row_order) - offset
+            rows = self.row_order[max(end - limit, 0):max(end, 0)][::-1]
+            if not rows:
+                return []
+            values = await sheets_call(self.sheet.get, f"A{rows[-1]}:{gspread.utils.rowcol_to_a1(rows[0], ACCOUNT_COLUMNS)}")
+        wanted = set(rows)
+        by_row = {row: row_values for row, row_values in enumerate(values, rows[-1]) if row in wanted and row_values}
+        return [row_to_account(by_row[row]) for row in rows if row in by_row]
+
+    async def totals(self):
+        return self.total_accounts, self.total_value
+
+    async def reconcile_totals(self):
+        """Recount the running totals from scratch, return the drift found"""
+        before = (self.total_accounts, self.total_value)
+        if self.write_behind:
+            self.total_accounts = len(self.accounts)
+            self.total_value = sum(account["balance"] for account in self.accounts.values())
+        else:
+            async with self.rows_lock.exclusive():
+                self.load_rows(await sheets_call(self.sheet.get_all_values))
+        return self.total_accounts - before[0], self.total_value - before[1]
+
+    async def create(self, user_id, name, username, link):
+        account = new_account(user_id, name, username, link)
+        key = account["user_id"]
+        if self.write_behind:
+            if key in self.accounts:
+                return False
+            self.accounts[key] = account
+            self.changed(key)
+        else:
+            async with self.rows_lock.exclusive():
+                if key in self.rows:
+                    return False
+                response = await sheets_call(self.sheet.append_row, account_to_row(account),
+                                             value_input_option=gspread.utils.ValueInputOption.raw)
+                row = appended_rows(response)[0]
+                self.rows[key] = row
+                bisect.insort(self.row_order, row)
+                self.balances[key] = 0.0
+        self.total_accounts += 1
+        return True
+
+    async def set_balance(self, user_id, balance, last_transaction, transaction=None):
+        key = str(user_id)
+        if self.write_behind:
+            account = self.accounts.get(key)
+            if not account:
+                return False
+            self.total_value += float(balance) - account["balance"]
+            account["balance"] = float(balance)
+            account["last_transaction"] = last_transaction
+            self.changed(key)
+        else:
+            async with self.rows_lock.shared():
+                row = self.rows.get(key)
+                if not row:
+                    return False
+                await sheets_call(self.sheet.batch_update, balance_ranges(row, balance, last_transaction),
+                                  value_input_option=gspread.utils.ValueInputOption.user_entered)
+                self.total_value += float(balance) - self.balances.get(key, 0.0)
+                self.balances[key] = float(balance)
+        
+        if transaction:
+            await self.journal.run(self.journal.append, key, transaction)
+        return True
+
+    async def set_balances(self, changes, last_transaction):
+        """Apply (user_id, balance, transaction) changes in one sheet write and one journal append"""
+        changes = [(str(user_id), float(balance), transaction) for user_id, balance, transaction in changes]
+        if self.write_behind:
+            if any(key not in self.accounts for key, _, _ in changes):
+                return False
+            for key, balance, _ in changes:
+                account = self.accounts[key]
+                self.total_value += balance - account["balance"]
+                account["balance"] = balance
+                account["last_transaction"] = last_transaction
+                self.changed(key)
+        else:
+            async with self.rows_lock.shared():
+                if any(key not in self.rows for key, _, _ in changes):
+                    return False
+                ranges = []
+                for key, balance, _ in changes:
+                    ranges += balance_ranges(self.rows[key], balance, last_transaction)
+                await sheets_call(self.sheet.batch_update, ranges,
+                                  value_input_option=gspread.utils.ValueInputOption.user_entered)
+                for key, balance, _ in changes:
+                    self.total_value += balance - self.balances.get(key, 0.0)
+                    self.balances[key] = balance
+        
+        await self.journal.run(self.journal.write, [dict(transaction, user_id=key) for key, _, transaction in changes if transaction])
+        return True
+
+    async def reset(self, user_id, last_transaction):
+        if not await self.set_balance(user_id, 0, last_transaction):
+            return False
+        await self.journal.run(self.journal.clear, user_id)
+        return True
+
+    async def delete(self, user_id):
+        key = str(user_id)
+        if self.write_behind:
+            account = self.accounts.pop(key, None)
+            if account is None:
+                return False
+            self.total_value -= account["balance"]
+            self.changed(key)
+        else:
+            async with self.rows_lock.exclusive():
+                row = self.rows.get(key)
+                if not row:
+                    return False
+                await sheets_call(self.sheet.delete_rows, row)
+                self.rows = shift_deleted_rows(self.rows, [row])
+                position = bisect.bisect_left(self.row_order, row)
+                self.row_order[position:] = [below - 1 for below in self.row_order[position + 1:]]
+                self.total_value -= self.balances.pop(key, 0.0)
+        self.total_accounts -= 1
+        return True
+
+    async def transactions(self, user_id, offset=0, limit=HISTORY_PAGE_SIZE):
+        return await self.journal.run(self.journal.page, user_id, offset, limit)
+
+    async def transaction_count(self, user_id):
+        return await self.journal.run(self.journal.count, user_id)
+
+    async def executor_totals(self, user_id):
+        return await self.journal.run(self.journal.executor_totals, user_id)
+
+# IDs bound per "IN (...)" query, well under SQLite's variable limit (999 before 3.32)
+SQLITE_IN_CHUNK = 500
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    username TEXT NOT NULL DEFAULT '',
+    link TEXT NOT NULL DEFAULT '',
+    balance REAL NOT NULL DEFAULT 0,
+    created TEXT NOT NULL DEFAULT '',
+    last_transaction TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    amount REAL NOT NULL,
+    executor_id INTEGER NOT NULL,
+    executor_name TEXT NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_by_user ON transactions (user_id, id);
+CREATE TABLE IF NOT EXISTS bank_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    accounts INTEGER NOT NULL,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS executor_totals (
+    user_id TEXT NOT NULL,
+    executor_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    executor_name TEXT NOT NULL,
+    amount REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, executor_id, type)
+);
+"""
+
+# Fold transactions into executor_totals; rows are (user_id, executor_id, type, executor_name, amount)
+SQLITE_ADD_EXECUTOR_TOTAL = (
+    "INSERT INTO executor_totals (user_id, executor_id, type, executor_name, amount, count) "
+    "VALUES (?, ?, ?, ?, ?, 1) "
+    "ON CONFLICT (user_id, executor_id, type) DO UPDATE SET "
+    "executor_name = excluded.executor_name, amount = amount + excluded.amount, count = count + 1"
+)
+
+class SQLiteStorage:
+    """Accounts and transactions in a local SQLite database (WAL mode).
+
+    The database is the source of truth, so commands finish without any
+    network round trip. A SheetMirror replicates every change to the sheet
+    so owners can keep reading the spreadsheet. On first start an empty
+    database is seeded from the sheet. Bank totals live in the bank_totals
+    row and per-executor totals in executor_totals; both are adjusted in
+    the same transaction as each mutation.
+    
+    Reads use their own connection on the event loop; in WAL mode they
+    never wait for a writer. Write transactions run on a single database
+    thread, in order, so waiting for another process's write lock
+    (busy_timeout) holds up that thread rather than the event loop.
+    """
+
+    def __init__(self, path, bank=None):
+        self.path = path
+        self.bank = bank
+        self.db = None  # reads, on the event loop
+        self.writer = None  # writes, on the database thread
+        self.executor = None
+        self.mirror = SheetMirror(self.get_now, bank)
+        self.reconciler = None
+        self.leader_jobs = None
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    def open(self):
+        self.writer = self.connect()
+        self.writer.executescript(SQLITE_SCHEMA)
+        self.db = self.connect()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Write transaction that takes the database write lock up front"""
+        self.writer.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.writer
+        except BaseException:
+            self.writer.rollback()
+            raise
+        self.writer.commit()
+
+    def run_transaction(self, work):
+        with self.write() as db:
+            return work(db)
+
+    async def transact(self, work):
+        """Run work(db) in one write transaction on the database thread, return its result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.run_transaction, work)
+
+    async def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{self.bank or 'default'}")
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.open)
+        if not self.db.execute("SELECT 1 FROM accounts LIMIT 1").fetchone():
+            await self.import_sheet()
+        if not self.db.execute("SELECT 1 FROM bank_totals").fetchone():
+            await self.reconcile_totals()
+        if not self.db.execute("SELECT 1 FROM executor_totals LIMIT 1").fetchone():
+            await self.transact(self.rebuild_executor_totals)
+        self.leader_jobs = asyncio.create_task(self.lead())
+
+    async def lead(self):
+        """Replicate to the sheet and reconcile totals, on the leader only in worker mode"""
+        await LEADER.wait()
+        await self.mirror.start()
+        self.reconciler = asyncio.create_task(reconcile_totals_periodically(self))
+
+    def mark(self, user_id):
+        """Queue an account for the sheet, through the leader in worker mode"""
+        if WORKER_STATE:
+            WORKER_STATE.mark(self.bank, user_id)
+        else:
+            self.mirror.mark(user_id)
+
+    async def stop(self):
+        for task in (self.leader_jobs, self.reconciler):
+            if task:
+                task.cancel()
+        await self.mirror.stop()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.writer.close)
+        self.executor.shutdown()
+        self.db.close()
+
+    async def import_sheet(self):
+        """Seed an empty database with the accounts currently in the sheet"""
+        await SHEET_CONNECTED.wait()
+        rows = await sheets_call(self.sheet.get_all_values)
+        accounts = [row_to_account(values) for values in rows[1:] if values and values[0]]
+        await self.transact(lambda db: db.executemany(
+            "INSERT OR IGNORE INTO accounts (user_id, name, username, link, balance, created, last_transaction) "
+            "VALUES (:user_id, :name, :username, :link, :balance, :created, :last_transaction)",
+            accounts
+        ))
+        self.mirror.rows = index_sheet_rows(rows)
+        print(f"✅ Imported {len(accounts)} accounts from the sheet")
+
+    def rebuild_executor_totals(self, db):
+        """Recompute executor_totals from the full transaction history"""
+        db.execute("DELETE FROM executor_totals")
+        db.execute(
+            "INSERT INTO executor_totals (user_id, executor_id, type, executor_name, amount, count) "
+            "SELECT user_id, executor_id, type, executor_name, amount, count FROM ("
+            # With a lone MAX(), SQLite takes the bare executor_name from the newest row of each group
+            "SELECT user_id, executor_id, type, executor_name, SUM(amount) AS amount, COUNT(*) AS count, "
+            "MAX(id) FROM transactions GROUP BY user_id, executor_id, type"
+            ") AS totals ORDER BY (SELECT MIN(id) FROM transactions WHERE user_id = totals.user_id "
+            "AND executor_id = totals.executor_id AND type = totals.type)"
+        )
+
+    @property
+    def sheet(self):
+        return bank_worksheet(self.bank)
+
+    def get_now(self, user_id):
+        """Read one account without awaiting"""
+        row = self.db.execute("SELECT * FROM accounts WHERE user_id = ?", (str(user_id),)).fetchone()
+        return dict(row) if row else None
+
+    async def get(self, user_id):
+        return self.get_now(user_id)
+
+    async def all(self):
+        return [dict(row) for row in self.db.execute("SELECT * FROM accounts ORDER BY rowid")]
+
+    async def known_balances(self, user_ids):
+        # Primary key lookups, so a batch costs its own size rather than the bank's
+        wanted = list(dict.fromkeys(map(str, user_ids)))
+        balances = {}
+        for start in range(0, len(wanted), SQLITE_IN_CHUNK):
+            chunk = wanted[start:start + SQLITE_IN_CHUNK]
+            rows = self.db.execute(
+                f"SELECT user_id, balance FROM accounts WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            balances.update((row["user_id"], row["balance"]) for row in rows)
+        return balances
+
+    async def account_page(self, offset, limit):
+        rows = self.db.execute("SELECT * FROM accounts ORDER BY rowid DESC LIMIT ? OFFSET ?", (limit, offset))
+        return [dict(row) for row in rows]
+
+    async def totals(self):
+        row = self.db.execute("SELECT accounts, value FROM bank_totals").fetchone()
+        return (row["accounts"], row["value"]) if row else (0, 0.0)
+
+    async def reconcile_totals(self):
+        """Recount the running totals from scratch, return the drift found"""
+        def work(db):
+            before = db.execute("SELECT accounts, value FROM bank_totals").fetchone()
+            count, value = db.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM accounts").fetchone()
+            db.execute("INSERT OR REPLACE INTO bank_totals (id, accounts, value) VALUES (1, ?, ?)", (count, value))
+            return before, count, value
+        before, count, value = await self.transact(work)
+        if not before:
+            return 0, 0.0
+        return count - before["accounts"], value - before["value"]
+
+    async def create(self, user_id, name, username, link):
+        account = new_account(user_id, name, username, link)
+        def work(db):
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO accounts (user_id, name, username, link, balance, created, last_transaction) "
+                "VALUES (:user_id, :name, :username, :link, :balance, :created, :last_transaction)",
+                account
+            )
+            if not cursor.rowcount:
+                return False
+            db.execute("UPDATE bank_totals SET accounts = accounts + 1")
+            return True
+        if not await self.transact(work):
+            return False
+        self.mark(account["user_id"])
+        return True
+
+    async def set_balance(self, user_id, balance, last_transaction, transaction=None):
+        key = str(user_id)
+        # Balance, history and totals change in the same database transaction
+        def work(db):
+            row = db.execute("SELECT balance FROM accounts WHERE user_id = ?", (key,)).fetchone()
+            if not row:
+                return False
+            db.execute(
+                "UPDATE accounts SET balance = ?, last_transaction = ? WHERE user_id = ?",
+                (float(balance), last_transaction, key)
+            )
+            db.execute("UPDATE bank_totals SET value = value + ?", (float(balance) - row["balance"],))
+            if transaction:
+                db.execute(
+                    "INSERT INTO transactions (user_id, timestamp, amount, executor_id, executor_name, type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, transaction["timestamp"], transaction["amount"], transaction["executor_id"],
+                     transaction["executor_name"], transaction["type"])
+                )
+                db.execute(
+                    SQLITE_ADD_EXECUTOR_TOTAL,
+                    (key, transaction["executor_id"], transaction["type"], transaction["executor_name"],
+                     transaction["amount"])
+                )
+            return True
+        if not await self.transact(work):
+            return False
+        self.mark(key)
+        return True
+
+    async def set_balances(self, changes, last_transaction):
+        """Apply (user_id, balance, transaction) changes in one database transaction"""
+        changes = [(str(user_id), float(balance), transaction) for user_id, balance, transaction in changes]
+        def work(db):
+            delta = 0.0
+            for key, balance, _ in changes:
+                row = db.execute("SELECT balance FROM accounts WHERE user_id = ?", (key,)).fetchone()
+                if not row:
+                    return False
+                delta += balance - row["balance"]
+            db.executemany(
+                "UPDATE accounts SET balance = ?, last_transaction = ? WHERE user_id = ?",
+                [(balance, last_transaction, key) for key, balance, _ in changes]
+            )
+            db.execute("UPDATE bank_totals SET value = value + ?", (delta,))
+            db.executemany(
+                "INSERT INTO transactions (user_id, timestamp, amount, executor_id, executor_name, type) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, transaction["timestamp"], transaction["amount"], transaction["executor_id"],
+                  transaction["executor_name"], transaction["type"])
+                 for key, _, transaction in changes if transaction]
+            )
+            db.executemany(
+                SQLITE_ADD_EXECUTOR_TOTAL,
+                [(key, transaction["executor_id"], transaction["type"], transaction["executor_name"],
+                  transaction["amount"])
+                 for key, _, transaction in changes if transaction]
+            )
+            return True
+        if not await self.transact(work):
+            return False
+        for key, _, _ in changes:
+            self.mark(key)
+        return True
+
+    async def reset(self, user_id, last_transaction):
+        key = str(user_id)
+        def work(db):
+            row = db.execute("SELECT balance FROM accounts WHERE user_id = ?", (key,)).fetchone()
+            if not row:
+                return False
+            db.execute(
+                "UPDATE accounts SET balance = 0, last_transaction = ? WHERE user_id = ?",
+                (last_transaction, key)
+            )
+            db.execute("UPDATE bank_totals SET value = value - ?", (row["balance"],))
+            db.execute("DELETE FROM transactions WHERE user_id = ?", (key,))
+            db.execute("DELETE FROM executor_totals WHERE user_id = ?", (key,))
+            return True
+        if not await self.transact(work):
+            return False
+        self.mark(key)
+        return True
+
+    async def delete(self, user_id):
+        key = str(user_id)
+        def work(db):
+            row = db.execute("SELECT balance FROM accounts WHERE user_id = ?", (key,)).fetchone()
+            if not row:
+                return False
+            db.execute("DELETE FROM accounts WHERE user_id = ?", (key,))
+            db.execute("UPDATE bank_totals SET accounts = accounts - 1, value = value - ?", (row["balance"],))
+            return True
+        if not await self.transact(work):
+            return False
+        self.mark(key)
+        return True
+
+    async def transactions(self, user_id, offset=0, limit=HISTORY_PAGE_SIZE):
+        rows = self.db.execute(
+            "SELECT timestamp, amount, executor_id, executor_name, type FROM transactions "
+            "WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (str(user_id), -1 if limit is None else limit, offset)
+        )
+        return [dict(row) for row in rows]
+
+    async def transaction_count(self, user_id):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM transactions WHERE user_id = ?", (str(user_id),)
+        ).fetchone()[0]
+
+    async def executor_totals(self, user_id):
+        rows = self.db.execute(
+            "SELECT executor_id, type, executor_name, amount, count FROM executor_totals "
+            "WHERE user_id = ? ORDER BY rowid", (str(user_id),)
+        )
+        return [dict(row) for row in rows]
+
+async def reconcile_totals_periodically(storage):
+    """Recount the bank totals from scratch every RECONCILE_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            accounts_drift, value_drift = await storage.reconcile_totals()
+            if accounts_drift or abs(value_drift) > 0.005:
+                print(f"⚠️ Bank totals drifted by {accounts_drift} accounts and {CURRENCY}{value_drift:,.2f}, corrected")
+        except Exception as e:
+            print(f"Failed to reconcile bank totals: {e}")
+
+def create_storage(bank=None):
+    """Build the storage backend selected by STORAGE_BACKEND for a bank"""
+    if STORAGE_BACKEND == "sheets":
+        return SheetsStorage(write_behind=WRITE_BEHIND, bank=bank)
+    return SQLiteStorage(bank_path(SQLITE_PATH, bank), bank)
+
+# Created by main(); handlers wait for STORAGE_READY before using it
+STORAGE = None
+STORAGE_READY = asyncio.Event()
+# Handlers stop waiting for a bank that is still starting after this many seconds
+STORAGE_READY_TIMEOUT = float(os.environ.get("STORAGE_READY_TIMEOUT", "15"))
+
+class StorageNotReady(Exception):
+    """The bank a handler needs did not finish starting in time"""
+
+# Bank of the update being handled, set by in_bank(); None is the default bank
+CURRENT_BANK = contextvars.ContextVar("current_bank", default=None)
+
+class BankRegistry:
+    """Storage of the banks in use, loaded on first use.
+
+    The default bank is STORAGE and always stays open. Other banks open
+    their worksheet and start their storage the first time a handler
+    needs them. They are kept in LRU order, and past BANK_CACHE_SIZE the
+    least recently used bank with no handler inside it is stopped. Memory,
+    background flushes and Sheets quota then follow the active banks only.
+    """
+
+    def __init__(self):
+        self.loaded = collections.OrderedDict()  # bank name -> started storage
+        self.loading = {}  # bank name -> task starting it
+        self.stopping = {}  # bank name -> task stopping it
+        self.users = collections.Counter()  # bank name -> handlers running in it
+
+    async def current(self):
+        """Storage of the bank the running handler belongs to"""
+        return await self.get(CURRENT_BANK.get())
+
+    async def get(self, bank):
+        """Started storage of a bank, raising StorageNotReady if it takes over STORAGE_READY_TIMEOUT"""
+        if bank is None:
+            if not STORAGE_READY.is_set():
+                try:
+                    await asyncio.wait_for(STORAGE_READY.wait(), STORAGE_READY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise StorageNotReady("default bank") from None
+            return STORAGE
+        storage = self.loaded.get(bank)
+        if storage is not None:
+            self.loaded.move_to_end(bank)
+            return storage
+        if bank not in self.loading:
+            self.loading[bank] = asyncio.create_task(self.load(bank))
+        # Shielded so a cancelled or timed out handler does not abort a load others wait on
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.loading[bank]), STORAGE_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise StorageNotReady(f"bank {bank}") from None
+
+    async def load(self, bank):
+        try:
+            # A bank that is still closing must release its files first
+            if bank in self.stopping:
+                await self.stopping[bank]
+            BANK_WORKSHEETS[bank] = await open_bank_worksheet(bank)
+            storage = create_storage(bank)
+            try:
+                await storage.start()
+            except:
+                BANK_WORKSHEETS.pop(bank, None)
+                raise
+        finally:
+            del self.loading[bank]
+        self.loaded[bank] = storage
+        print(f"✅ Bank {bank} loaded")
+        self.evict()
+        return storage
+
+    def evict(self):
+        """Stop idle banks, least recently used first, until at most BANK_CACHE_SIZE are loaded"""
+        for bank in list(self.loaded):
+            if len(self.loaded) <= BANK_CACHE_SIZE:
+                break
+            if self.users[bank]:
+                continue
+            self.stopping[bank] = asyncio.create_task(self.unload(bank, self.loaded.pop(bank)))
 
-# Get Google Sheets credentials from environment variables
-google_creds_json = os.environ.get('GOOGLE_CREDS_JSON')
-if google_creds_json:
-    creds_dict = json.loads(google_creds_json)
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-else:
-    # Fallback to file (for local development only)
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scope)
-
-client = gspread.authorize(creds)
-sheet = client.open(SPREADSHEET_NAME).sheet1
-
-# Load admins, co-owners, log channel, and connected groups
-try:
-    with open("admins.json", "r") as f:
-        ADMINS = json.load(f)
-except:
-    ADMINS = []
-
-try:
-    with open("co_owners.json", "r") as f:
-        CO_OWNERS = json.load(f)
-except:
-    CO_OWNERS = []
-
-try:
-    with open("config.json", "r") as f:
-        config = json.load(f)
-        LOG_CHANNEL = config.get("log_channel")
-        CONNECTED_GROUPS = config.get("connected_groups", [])
-except:
-    LOG_CHANNEL = None
-    CONNECTED_GROUPS = []
-
-def save_admins():
-    with open("admins.json", "w") as f:
-        json.dump(ADMINS, f)
-
-def save_co_owners():
-    with open("co_owners.json", "w") as f:
-        json.dump(CO_OWNERS, f)
-
-def save_config():
-    config = {
-        "log_channel": LOG_CHANNEL,
-        "connected_groups": CONNECTED_GROUPS
-    }
-    with open("config.json", "w") as f:
-        json.dump(config, f)
+    async def unload(self, bank, storage):
+        try:
+            await storage.stop()
+        except Exception as e:
+            print(f"Failed to stop bank {bank}: {e}")
+        finally:
+            BANK_WORKSHEETS.pop(bank, None)
+            del self.stopping[bank]
 
-def get_all_accounts():
-    return sheet.get_all_records()
+    @contextlib.contextmanager
+    def using(self, bank):
+        """Route storage calls in this context to bank and keep it loaded meanwhile"""
+        token = CURRENT_BANK.set(bank)
+        self.users[bank] += 1
+        try:
+            yield
+        finally:
+            self.users[bank] -= 1
+            CURRENT_BANK.reset(token)
+            if len(self.loaded) > BANK_CACHE_SIZE:
+                self.evict()
+
+    async def stop(self):
+        for task in list(self.loading.values()):
+            task.cancel()
+        while self.loaded:
+            bank, storage = self.loaded.popitem(last=False)
+            self.stopping[bank] = asyncio.create_task(self.unload(bank, storage))
+        if self.stopping:
+            await asyncio.gather(*self.stopping.values(), return_exceptions=True)
+
+BANKS = BankRegistry()
+
+def bank_of_chat(chat):
+    """Bank serving a chat; groups without a bank of their own use the default bank"""
+    return GROUP_BANKS.get(chat.id) if chat else None
 
-def find_user_row(user_id):
-    """Find user row by ID, return None if not found"""
+def in_bank(callback):
+    """Wrap a handler callback so its storage calls go to the bank of its chat"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with BANKS.using(bank_of_chat(update.effective_chat)):
+            try:
+                return await callback(update, context)
+            except StorageNotReady as e:
+                print(f"⚠️ {e} not ready after {STORAGE_READY_TIMEOUT:g}s, update not handled")
+                await reply_not_ready(update)
+    return wrapper
+
+async def reply_not_ready(update):
+    """Tell the user the bank is still starting, instead of leaving the command hanging"""
+    text = "⏳ The bank is not ready yet, please try again in a moment."
     try:
-        data = sheet.col_values(1)
-        for i, val in enumerate(data):
-            if str(val) == str(user_id):
-                return i + 1
-        return None
-    except:
-        return None
+        if update.callback_query:
+            await update.callback_query.answer(text)
+        elif update.message:
+            error_msg = await update.message.reply_text(text)
+            schedule_delete(error_msg, 5)
+            schedule_delete(update.message, 5)
+    except Exception as e:
+        print(f"Failed to report that the bank is not ready: {e}")
+
+async def get_all_accounts():
+    """All accounts in creation order"""
+    storage = await BANKS.current()
+    return await storage.all()
+
+async def get_known_balances(user_ids):
+    """Balances of the given accounts as this bot last saw them, without reading the sheet"""
+    storage = await BANKS.current()
+    return await storage.known_balances(user_ids)
+
+async def get_account_page(offset, limit):
+    """One page of accounts, newest first"""
+    storage = await BANKS.current()
+    return await storage.account_page(offset, limit)
+
+async def get_bank_totals():
+    """Number of accounts and total value, kept up to date by every mutation"""
+    storage = await BANKS.current()
+    return await storage.totals()
+
+async def get_account(user_id):
+    """Fetch a whole account, return None if not found"""
+    storage = await BANKS.current()
+    return await storage.get(user_id)
+
+async def create_account(user_id, name, username, link):
+    """Create an account with a zero balance, return False if it already exists"""
+    storage = await BANKS.current()
+    return await storage.create(user_id, name, username, link)
 
-def delete_user_account(user_id):
+async def update_balance(user_id, balance, last_transaction, transaction=None):
+    """Set balance and last transaction, recording the transaction if given"""
+    storage = await BANKS.current()
+    return await storage.set_balance(user_id, balance, last_transaction, transaction)
+
+async def update_balances(changes, last_transaction):
+    """Apply a batch of (user_id, balance, transaction) changes atomically, return False if any account is missing"""
+    storage = await BANKS.current()
+    return await storage.set_balances(changes, last_transaction)
+
+async def reset_account(user_id, last_transaction):
+    """Zero the balance and clear the transaction history of an account"""
+    storage = await BANKS.current()
+    return await storage.reset(user_id, last_transaction)
+
+async def get_transactions(user_id, offset=0, limit=HISTORY_PAGE_SIZE):
+    """Transactions of an account, newest first; limit=None returns all of them"""
+    storage = await BANKS.current()
+    return await storage.transactions(user_id, offset, limit)
+
+async def get_executor_totals(user_id):
+    """Running totals of an account's transactions per executor ID and type"""
+    storage = await BANKS.current()
+    return await storage.executor_totals(user_id)
+
+async def get_transaction_count(user_id):
+    """Number of transactions recorded for an account"""
+    storage = await BANKS.current()
+    return await storage.transaction_count(user_id)
+
+async def delete_user_account(user_id):
     """Delete user account by ID"""
+    storage = await BANKS.current()
     try:
-        row = find_user_row(user_id)
-        if row:
-            sheet.delete_rows(row)
-            return True
-        return False
+        return await storage.delete(user_id)
     except:
         return False
 
+async def start_storage(application):
+    """Start the storage backend and open it to handlers, stop the bot if that fails"""
+    try:
+        await STORAGE.start()
+    except Exception as e:
+        print(f"❌ Storage failed to start: {e}")
+        if WEBHOOK_STOPPING is not None:
+            # stop_running() only ends run_polling; run_webhook waits on its own event
+            WEBHOOK_STOPPING.set()
+        else:
+            application.stop_running()
+        return
+    STORAGE_READY.set()
+    mark_startup("storage_ready")
+
+async def stop_storage():
+    """Drain pending writes and close the storage backend of every bank"""
+    await BANKS.stop()
+    if STORAGE_READY.is_set():
+        await STORAGE.stop()
+
 def format_datetime():
     return datetime.now().strftime("%m-%d-%Y, %I:%M %p")
 
 def can_modify(user):
     """Check if user is owner or admin"""
-    return user.id == OWNER_ID or (user.username and user.username in ADMINS) or (user.username and user.username in CO_OWNERS)
+    return user.id == OWNER_ID or ROLES.role(user) is not None
 
 def is_owner(user):
     """Check if user is owner"""
@@ -110,77 +2092,302 @@ def is_owner(user):
 
 def is_co_owner(user):
     """Check if user is co-owner"""
-    return user.username and user.username in CO_OWNERS
+    return ROLES.role(user) == CO_OWNER
 
 def is_manager(user):
     """Check if user is manager"""
-    return user.username and user.username in ADMINS
+    return ROLES.role(user) == MANAGER
 
 def can_manage_users(user):
     """Check if user can manage other users (owner and co-owners)"""
-    return user.id == OWNER_ID or (user.username and user.username in CO_OWNERS)
+    return user.id == OWNER_ID or ROLES.role(user) == CO_OWNER
 
-async def send_log(context: ContextTypes.DEFAULT_TYPE, message: str):
-    """Send log message to log channel"""
-    if LOG_CHANNEL:
+# Log channel: entries are queued and sent in batches by a background task
+LOG_BATCH_WINDOW = 1.0
+LOG_ENTRY_SEPARATOR = "\n\n"
+# On shutdown, a batch already taken off the queue gets this long to finish sending
+LOG_STOP_TIMEOUT = 10
+
+def split_log_text(entries, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Join log entries into as few messages as fit within limit characters"""
+    chunks = []
+    current = ""
+    for entry in entries:
+        # An oversized entry is cut at line breaks so HTML tags stay intact
+        while len(entry) > limit:
+            cut = entry.rfind("\n", 0, limit)
+            if cut <= 0:
+                cut = limit
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(entry[:cut])
+            entry = entry[cut:].lstrip("\n")
+        if current and len(current) + len(LOG_ENTRY_SEPARATOR) + len(entry) > limit:
+            chunks.append(current)
+            current = ""
+        current = current + LOG_ENTRY_SEPARATOR + entry if current else entry
+    if current:
+        chunks.append(current)
+    return chunks
+
+class LogPipeline:
+    """Sends log channel entries from a background task.
+
+    send_log only enqueues, so commands never wait on the log channel.
+    Entries arriving within LOG_BATCH_WINDOW of each other are joined into
+    one message per channel, split at the Telegram message limit. Flood
+    control is honoured by waiting out retry_after and resending.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.bot = None
+        self.task = None
+        self.sending = False  # a batch is off the queue and not fully sent
+        self.closing = False
+
+    def put(self, channel_id, text):
+        self.queue.put_nowait((channel_id, text))
+
+    def take_batch(self, entries=()):
+        """Group the given entries and everything queued so far by channel"""
+        batch = {}
+        for channel_id, text in entries:
+            batch.setdefault(channel_id, []).append(text)
+        while not self.queue.empty():
+            channel_id, text = self.queue.get_nowait()
+            batch.setdefault(channel_id, []).append(text)
+        return batch
+
+    async def run(self):
+        while not self.closing:
+            first = await self.queue.get()
+            self.sending = True
+            try:
+                if not self.closing:
+                    await asyncio.sleep(LOG_BATCH_WINDOW)
+                await self.send_batch(self.take_batch([first]))
+            finally:
+                self.sending = False
+
+    async def send_batch(self, batch):
+        for channel_id, entries in batch.items():
+            for chunk in split_log_text(entries):
+                await self.send(channel_id, chunk)
+
+    async def send(self, channel_id, text):
+        while True:
+            try:
+                await self.bot.send_message(
+                    chat_id=channel_id,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                    rate_limit_args=PRIORITY_LOG
+                )
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                print(f"Failed to send log: {e}")
+                return
+
+    async def start(self, bot):
+        self.bot = bot
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            # Entries taken off the queue exist nowhere else, so let their batch finish
+            self.closing = True
+            if self.sending:
+                done, _ = await asyncio.wait({self.task}, timeout=LOG_STOP_TIMEOUT)
+                if not done:
+                    print(f"⚠️ Log batch still sending after {LOG_STOP_TIMEOUT}s, the rest of it is dropped")
+            self.task.cancel()
+        # Send whatever is still queued before the bot goes away
         try:
-            await context.bot.send_message(
-                chat_id=LOG_CHANNEL,
-                text=message,
-                parse_mode=ParseMode.HTML
-            )
+            await self.send_batch(self.take_batch())
         except Exception as e:
-            print(f"Failed to send log: {e}")
+            print(f"Failed to flush logs: {e}")
 
-# Transaction history storage (in real app, this would be in database)
-TRANSACTION_HISTORY = {}
+LOG_PIPELINE = LogPipeline()
 
-# Store message IDs for auto-delete functionality
-BAL_MESSAGES = {}
-INFOBANK_MESSAGES = {}
+async def send_log(context: ContextTypes.DEFAULT_TYPE, message: str):
+    """Queue a log message for the log channel"""
+    if LOG_CHANNEL:
+        LOG_PIPELINE.put(LOG_CHANNEL, message)
 
-def add_transaction(user_id, amount, executor_id, executor_name, transaction_type="added"):
-    """Add transaction to history"""
-    if user_id not in TRANSACTION_HISTORY:
-        TRANSACTION_HISTORY[user_id] = []
-    
-    TRANSACTION_HISTORY[user_id].append({
-        "timestamp": format_datetime(),
-        "amount": amount,
-        "executor_id": executor_id,
-        "executor_name": executor_name,
-        "type": transaction_type
-    })
-    
-    # Keep only last 10 transactions
-    if len(TRANSACTION_HISTORY[user_id]) > 10:
-        TRANSACTION_HISTORY[user_id] = TRANSACTION_HISTORY[user_id][-10:]
+# Auto-delete: every pending deletion is driven by a single timer task
+AUTO_DELETE_DELAY = 60
+PENDING_DELETES_PATH = os.environ.get("PENDING_DELETES_PATH", "pending_deletes.json")
+PENDING_DELETES_SAVE_INTERVAL = 30
+# Deletions falling due within this many seconds of each other go out in one
+# deleteMessages call, which takes up to DELETE_BATCH_SIZE ids of one chat
+DELETE_BATCH_WINDOW = float(os.environ.get("DELETE_BATCH_WINDOW", "0.2"))
+DELETE_BATCH_SIZE = 100
+# On shutdown, deletions already sent get this long to finish before they are saved for the next start
+DELETE_STOP_TIMEOUT = 5
 
-async def schedule_auto_delete(message, message_key, message_type="bal"):
-    """Schedule auto-delete for message after 1 minute"""
-    await asyncio.sleep(60)  # 1 minute
-    
-    # Check if message is still in the dictionary (not deleted by user action)
-    if message_type == "bal" and message_key in BAL_MESSAGES:
+class DeletionScheduler:
+    """Deletes messages at their due time using one timer task.
+
+    Pending deletions live in a heap of (due, chat_id, message_id) plus a
+    dict with the current due time of each message. Rescheduling pushes a
+    new heap entry and cancelling only drops the dict entry; stale heap
+    entries are skipped when they reach the top. Everything falling due
+    within DELETE_BATCH_WINDOW of the first due entry is taken together and
+    deleted with one deleteMessages call per chat. Pending deletions, and
+    those sent but not yet answered, are saved to disk periodically and on
+    shutdown, and reloaded on start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.heap = []
+        self.due = {}
+        self.wakeup = asyncio.Event()
+        self.bot = None
+        self.task = None
+        self.saver = None
+        self.changed = False
+        self.save_lock = asyncio.Lock()
+        self.inflight = {}  # deletion task -> [(due, chat_id, message_id)] it is deleting
+
+    def schedule(self, chat_id, message_id, delay=AUTO_DELETE_DELAY):
+        """Delete a message after delay seconds, replacing any earlier schedule"""
+        due = time.time() + delay
+        self.due[(chat_id, message_id)] = due
+        heapq.heappush(self.heap, (due, chat_id, message_id))
+        self.changed = True
+        if self.heap[0][0] == due:
+            self.wakeup.set()
+        # Drop stale entries once they outnumber live ones
+        if len(self.heap) > 2 * len(self.due) + 64:
+            self.heap = [(due, chat_id, message_id) for (chat_id, message_id), due in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, chat_id, message_id):
+        """Forget a pending deletion"""
+        if self.due.pop((chat_id, message_id), None) is not None:
+            self.changed = True
+
+    async def run(self):
+        while True:
+            # Skip entries that were cancelled or rescheduled
+            while self.heap and self.due.get(self.heap[0][1:]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            
+            batches = {}
+            until = time.time() + DELETE_BATCH_WINDOW
+            while self.heap and self.heap[0][0] <= until:
+                due, chat_id, message_id = heapq.heappop(self.heap)
+                if self.due.get((chat_id, message_id)) != due:
+                    continue
+                del self.due[(chat_id, message_id)]
+                batches.setdefault(chat_id, []).append((due, chat_id, message_id))
+            self.changed = True
+            for chat_id, entries in batches.items():
+                for i in range(0, len(entries), DELETE_BATCH_SIZE):
+                    batch = entries[i:i + DELETE_BATCH_SIZE]
+                    task = asyncio.create_task(self.delete(chat_id, [message_id for _, _, message_id in batch]))
+                    # Saved with the pending ones until Telegram has answered
+                    self.inflight[task] = batch
+                    task.add_done_callback(self.finish)
+
+    def finish(self, task):
+        self.inflight.pop(task, None)
+        self.changed = True
+
+    async def delete(self, chat_id, message_ids):
+        # Messages that are already gone are skipped by Telegram, so only a
+        # failure of the whole call (no rights, chat gone) ends up here
         try:
-            await message.delete()
-            # Remove from tracking
-            if message_key in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key]
-        except:
-            # Message already deleted, remove from tracking
-            if message_key in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key]
-    elif message_type == "infobank" and message_key in INFOBANK_MESSAGES:
+            await self.bot.delete_messages(chat_id, message_ids)
+        except Exception as e:
+            print(f"Failed to delete {len(message_ids)} messages in {chat_id}: {e}")
+
+    def load(self):
         try:
-            await message.delete()
-            # Remove from tracking
-            if message_key in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key]
+            with open(self.path, "r") as f:
+                pending = json.load(f)
         except:
-            # Message already deleted, remove from tracking
-            if message_key in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key]
+            return
+        for due, chat_id, message_id in pending:
+            self.due[(chat_id, message_id)] = due
+            self.heap.append((due, chat_id, message_id))
+        heapq.heapify(self.heap)
+
+    async def save(self):
+        """Write the pending deletions to disk on a worker thread"""
+        async with self.save_lock:
+            pending = [[due, chat_id, message_id] for (chat_id, message_id), due in self.due.items()]
+            pending += [list(entry) for batch in self.inflight.values() for entry in batch]
+            self.changed = False
+            try:
+                await asyncio.to_thread(write_file_atomic, self.path, json.dumps(pending))
+            except BaseException:
+                self.changed = True
+                raise
+
+    async def save_periodically(self):
+        while True:
+            await asyncio.sleep(PENDING_DELETES_SAVE_INTERVAL)
+            if self.changed:
+                try:
+                    await self.save()
+                except Exception as e:
+                    print(f"Failed to save pending deletions: {e}")
+
+    async def start(self, bot):
+        self.bot = bot
+        self.load()
+        self.task = asyncio.create_task(self.run())
+        self.saver = asyncio.create_task(self.save_periodically())
+
+    async def stop(self):
+        # Never started: a worker that was not the leader, leave the file to the leader
+        if self.task is None:
+            return
+        for task in (self.task, self.saver):
+            task.cancel()
+        # Let deletions already sent finish; any that do not are kept for the next start
+        if self.inflight:
+            await asyncio.wait(list(self.inflight), timeout=DELETE_STOP_TIMEOUT)
+        for task in list(self.inflight):
+            for due, chat_id, message_id in self.inflight.pop(task):
+                self.due.setdefault((chat_id, message_id), due)
+            task.cancel()
+        await self.save()
+
+DELETION_SCHEDULER = DeletionScheduler(PENDING_DELETES_PATH)
+
+def schedule_delete(message, delay=AUTO_DELETE_DELAY):
+    """Schedule a message for deletion, replacing any earlier schedule for it"""
+    if WORKER_STATE:
+        WORKER_STATE.schedule(message.chat.id, message.message_id, time.time() + delay)
+    else:
+        DELETION_SCHEDULER.schedule(message.chat.id, message.message_id, delay)
+
+def delete_soon(message):
+    """Delete a message with the next batch of deletions"""
+    schedule_delete(message, DELETE_BATCH_WINDOW)
+
+def cancel_delete(message):
+    """Cancel the scheduled deletion of a message"""
+    if WORKER_STATE:
+        WORKER_STATE.schedule(message.chat.id, message.message_id, None)
+    else:
+        DELETION_SCHEDULER.cancel(message.chat.id, message.message_id)
 
 async def setlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set log channel for bank activities"""
@@ -189,21 +2396,14 @@ async def setlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is owner or co-owner
     if not can_manage_users(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if message is sent in a channel
     if not update.message.chat.type == "channel":
         error_msg = await update.message.reply_text("Please use this command in the channel you want to set as log channel.")
-        await asyncio.sleep(2)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
         return
     
     # Get channel info
@@ -215,27 +2415,17 @@ async def setlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_member = await context.bot.get_chat_member(channel_id, context.bot.id)
         if not chat_member.status in ["administrator", "creator"]:
             error_msg = await update.message.reply_text("❌ Bot must be an admin in this channel to set it as log channel.")
-            await asyncio.sleep(2)
-            try:
-                await error_msg.delete()
-                await update.message.delete()
-            except:
-                pass
+            schedule_delete(error_msg, 2)
+            schedule_delete(update.message, 2)
             return
     except Exception as e:
         error_msg = await update.message.reply_text("❌ Cannot access channel information. Make sure bot is added as admin.")
-        await asyncio.sleep(2)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
         return
     
     # Set log channel
-    global LOG_CHANNEL
-    LOG_CHANNEL = channel_id
-    save_config()
+    await edit_config(lambda config: config.update(log_channel=channel_id))
     
     # Send success message
     success_msg = await update.message.reply_text(
@@ -255,49 +2445,44 @@ async def setlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Delete messages after delay
-    await asyncio.sleep(3)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 3)
+    schedule_delete(update.message, 3)
 
 async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Connect another group to use the same bank data"""
+    """Connect another group to the default bank, or with /connect <name> to a bank of its own"""
     user = update.effective_user
     
     # Check if user is owner or co-owner
     if not can_manage_users(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if message is sent in a group
     if update.message.chat.type not in ["group", "supergroup"]:
         error_msg = await update.message.reply_text("Please use this command in the group you want to connect.")
-        await asyncio.sleep(2)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
         return
     
     group_id = update.message.chat.id
     group_title = update.message.chat.title
     
+    # Optional bank name, which is also the worksheet title
+    bank = context.args[0] if context.args else None
+    if bank is not None and not BANK_NAME.fullmatch(bank):
+        error_msg = await update.message.reply_text("❌ Bank names use up to 32 letters, digits, - and _.")
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
+        return
+    if bank is not None:
+        bank = canonical_bank_name(bank)
+    
     # Check if already connected
     if group_id in CONNECTED_GROUPS:
         error_msg = await update.message.reply_text("❌ This group is already connected to the bank.")
-        await asyncio.sleep(2)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
         return
     
     # Check if bot is admin in the group
@@ -305,33 +2490,42 @@ async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_member = await context.bot.get_chat_member(group_id, context.bot.id)
         if not chat_member.status in ["administrator", "creator"]:
             error_msg = await update.message.reply_text("❌ Bot must be an admin in this group to connect it.")
-            await asyncio.sleep(2)
-            try:
-                await error_msg.delete()
-                await update.message.delete()
-            except:
-                pass
+            schedule_delete(error_msg, 2)
+            schedule_delete(update.message, 2)
             return
     except Exception as e:
         error_msg = await update.message.reply_text("❌ Cannot access group information. Make sure bot is added as admin.")
-        await asyncio.sleep(2)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 2)
+        schedule_delete(update.message, 2)
         return
     
+    # Open the bank now, so a name that cannot be a bank is refused before it is saved
+    if bank is not None:
+        try:
+            await BANKS.get(bank)
+        except Exception as e:
+            error_msg = await update.message.reply_text(f"❌ Cannot use bank {html.escape(bank)}: {html.escape(str(e))}", parse_mode=ParseMode.HTML)
+            schedule_delete(error_msg, 5)
+            schedule_delete(update.message, 5)
+            return
+    
     # Connect group
-    CONNECTED_GROUPS.append(group_id)
-    save_config()
+    def add_group(config):
+        groups = config.setdefault("connected_groups", [])
+        if group_id not in groups:
+            groups.append(group_id)
+        if bank is not None:
+            config.setdefault("banks", {})[str(group_id)] = bank
+    await edit_config(add_group)
+    
+    bank_label = f"bank {html.escape(bank)}" if bank else "the bank"
     
     # Send success message
     success_msg = await update.message.reply_text(
         f"✅ <b>Group Connected</b>\n"
-        f"• {group_title} is now connected to the bank\n"
+        f"• {group_title} is now connected to {bank_label}\n"
         f"• All bank commands will work here\n"
-        f"• User accounts are shared across all connected groups",
+        f"• User accounts are shared across all groups on {bank_label}",
         parse_mode=ParseMode.HTML
     )
     
@@ -339,18 +2533,14 @@ async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     executor_link = f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
     await send_log(context,
         f"🔗 <b>Group Connected</b>\n"
-        f"• {executor_link} connected {group_title} to the bank\n"
+        f"• {executor_link} connected {group_title} to {bank_label}\n"
         f"• Group ID: {group_id}\n"
         f"• Date: {format_datetime()}"
     )
     
     # Delete messages after delay
-    await asyncio.sleep(3)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 3)
+    schedule_delete(update.message, 3)
 
 async def bal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -360,10 +2550,7 @@ async def bal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Owner/manager checking another user's account
         if not can_modify(user):
             # Delete command message immediately for unauthorized users
-            try:
-                await update.message.delete()
-            except:
-                pass
+            delete_soon(update.message)
             return
         target = update.message.reply_to_message.from_user
     else:
@@ -371,20 +2558,15 @@ async def bal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target = user
     
     # Check if target has an account
-    row = find_user_row(target.id)
-    if not row:
+    account = await get_account(target.id)
+    if not account:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Get account details
-    name = sheet.cell(row, 2).value
-    balance = float(sheet.cell(row, 5).value or 0)
-    created_date = sheet.cell(row, 6).value
-    last_transaction = sheet.cell(row, 7).value or "Never"
+    balance = account["balance"]
+    last_transaction = account["last_transaction"] or "Never"
     
     # Clean the last transaction - remove any transaction details after the date
     if "•" in last_transaction:
@@ -413,39 +2595,34 @@ async def bal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Schedule auto-delete after 1 minute
-    message_key = f"bal_{target.id}_{user.id}_{message.message_id}"
-    BAL_MESSAGES[message_key] = message
-    asyncio.create_task(schedule_auto_delete(message, message_key, "bal"))
+    schedule_delete(message)
     
     # Then delete the command message after 0.5 seconds
-    await asyncio.sleep(0.5)
-    try:
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(update.message, 0.5)
 
-async def show_transaction_history(query, target_id, original_user_id):
-    """Show transaction history for a user"""
+async def show_transaction_history(query, target_id, original_user_id, page=0):
+    """Show one page of transaction history for a user, newest first"""
     # Get account details
-    row = find_user_row(target_id)
-    if not row:
+    account = await get_account(target_id)
+    if not account:
         return
     
-    balance = float(sheet.cell(row, 5).value or 0)
-    created_date = sheet.cell(row, 6).value
+    balance = account["balance"]
+    created_date = account["created"]
     
-    # Get transactions
-    transactions = TRANSACTION_HISTORY.get(target_id, [])
+    # Get transactions for this page
+    transactions_count = await get_transaction_count(target_id)
+    transactions = await get_transactions(target_id, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
     
     # Format balance to 5 digits and transactions count to 4 digits
     balance_formatted = f"{balance:05.0f}"
-    transactions_count_formatted = f"{len(transactions):04d}"
+    transactions_count_formatted = f"{transactions_count:04d}"
     
     if not transactions:
         message_text = "<b>transactions history</b> 🔖\n—————————————\n\n"
     else:
         message_text = "<b>transactions history</b> 🔖\n\n"
-        for transaction in reversed(transactions[-10:]):  # Show latest first
+        for transaction in transactions:  # Latest first
             executor_link = f'<a href="tg://user?id={transaction["executor_id"]}">{transaction["executor_name"]}</a>'
             amount_formatted = f"{transaction['amount']:02.0f}"
             message_text += f"• {transaction['timestamp']}\n   {CURRENCY}{amount_formatted} {transaction['type']} by {executor_link}\n\n"
@@ -462,44 +2639,48 @@ async def show_transaction_history(query, target_id, original_user_id):
          InlineKeyboardButton("close", callback_data=f"close_bal_{target_id}_{original_user_id}")]
     ]
     
+    # Page through older history
+    page_buttons = []
+    if page > 0:
+        page_buttons.append(InlineKeyboardButton("newer", callback_data=f"history_page_{target_id}_{page - 1}_{original_user_id}"))
+    if (page + 1) * HISTORY_PAGE_SIZE < transactions_count:
+        page_buttons.append(InlineKeyboardButton("older", callback_data=f"history_page_{target_id}_{page + 1}_{original_user_id}"))
+    if page_buttons:
+        keyboard.insert(0, page_buttons)
+    
     await query.edit_message_text(
         message_text,
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode=ParseMode.HTML
     )
     
-    # Update auto-delete tracking for the edited message
-    message_key = f"history_{target_id}_{original_user_id}_{query.message.message_id}"
-    BAL_MESSAGES[message_key] = query.message
-    asyncio.create_task(schedule_auto_delete(query.message, message_key, "bal"))
+    # Restart the auto-delete timer for the edited message
+    schedule_delete(query.message)
 
 async def show_per_admin(query, target_id, original_user_id):
     """Show balance per admin"""
     # Get account details
-    row = find_user_row(target_id)
-    if not row:
+    account = await get_account(target_id)
+    if not account:
         return
     
-    balance = float(sheet.cell(row, 5).value or 0)
+    balance = account["balance"]
     
-    # Calculate balance per admin - include both added and used transactions
-    transactions = TRANSACTION_HISTORY.get(target_id, [])
+    # Balance per admin from the running totals - added minus used
     admin_balances = {}
-    
-    for transaction in transactions:
-        admin_name = transaction["executor_name"]
-        if admin_name not in admin_balances:
-            admin_balances[admin_name] = 0
-        
-        if transaction["type"] == "added":
-            admin_balances[admin_name] += transaction["amount"]
-        elif transaction["type"] == "used":
-            admin_balances[admin_name] -= transaction["amount"]
+    admin_names = {}
+    for total in await get_executor_totals(target_id):
+        executor_id = total["executor_id"]
+        admin_names[executor_id] = total["executor_name"]
+        if total["type"] == "added":
+            admin_balances[executor_id] = admin_balances.get(executor_id, 0) + total["amount"]
+        elif total["type"] == "used":
+            admin_balances[executor_id] = admin_balances.get(executor_id, 0) - total["amount"]
     
     message_text = ""
-    for admin_name, amount in admin_balances.items():
+    for executor_id, amount in admin_balances.items():
         amount_formatted = f"{amount:02.0f}"
-        message_text += f"• balance by {admin_name}\n   amounting to {CURRENCY}{amount_formatted}\n\n"
+        message_text += f"• balance by {html.escape(admin_names[executor_id])}\n   amounting to {CURRENCY}{amount_formatted}\n\n"
     
     if not admin_balances:
         message_text = "• no balances recorded\n\n"
@@ -520,22 +2701,66 @@ async def show_per_admin(query, target_id, original_user_id):
         parse_mode=ParseMode.HTML
     )
     
-    # Update auto-delete tracking for the edited message
-    message_key = f"per_admin_{target_id}_{original_user_id}_{query.message.message_id}"
-    BAL_MESSAGES[message_key] = query.message
-    asyncio.create_task(schedule_auto_delete(query.message, message_key, "bal"))
+    # Restart the auto-delete timer for the edited message
+    schedule_delete(query.message)
+
+async def show_data_list(query, original_user_id, offset=0):
+    """Show one page of the account list, newest first"""
+    total_accs, _ = await get_bank_totals()
+    offset = max(min(offset, total_accs - 1), 0)
+    accounts = await get_account_page(offset, DATA_LIST_PAGE_SIZE)
+    
+    # Render only this page, stopping early rather than overflowing the message
+    lines = ["<b>data list —</b>\n"]
+    length = len(lines[0])
+    for i, acc in enumerate(accounts, offset + 1):
+        name = html.escape((acc["name"] or "Unknown")[:DATA_LIST_NAME_LENGTH])
+        line = f"{i}. {name} {CURRENCY}{acc['balance']:,.0f}"
+        if length + len(line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+            break
+        lines.append(line)
+        length += len(line) + 1
+    if not accounts:
+        lines.append("• no accounts")
+    shown = len(lines) - 1 if accounts else 0
+    message_text = "\n".join(lines)
+    
+    # Page buttons carry the offset of the page they open
+    page_buttons = []
+    if offset > 0:
+        page_buttons.append(InlineKeyboardButton("newer", callback_data=f"data_page_{max(offset - DATA_LIST_PAGE_SIZE, 0)}_{original_user_id}"))
+    if offset + shown < total_accs:
+        page_buttons.append(InlineKeyboardButton("older", callback_data=f"data_page_{offset + shown}_{original_user_id}"))
+    
+    # Add go back and close buttons with user ID
+    keyboard = [
+        [InlineKeyboardButton("go back", callback_data=f"go_back_{original_user_id}"), 
+         InlineKeyboardButton("close", callback_data=f"close_{original_user_id}")]
+    ]
+    if page_buttons:
+        keyboard.insert(0, page_buttons)
+    
+    # Edit the original message to show data list with buttons
+    await query.edit_message_text(
+        message_text, 
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=ParseMode.HTML
+    )
+    
+    # Restart the auto-delete timer for the edited message
+    schedule_delete(query.message)
 
 async def show_admin_list(query, original_user_id):
     """Show admin list in alphabetical order"""
     # Get all admins and sort alphabetically
-    all_admins = sorted(ADMINS)
+    all_admins = sorted(ROLES.members(MANAGER), key=str.lower)
     
     message_text = "<b>admins list —</b>\n\n"
     if not all_admins:
         message_text += "• no admins\n\n"
     else:
         for admin in all_admins:
-            message_text += f"• {admin}\n"
+            message_text += f"• {html.escape(admin)}\n"
     
     # Create buttons
     keyboard = [
@@ -549,10 +2774,8 @@ async def show_admin_list(query, original_user_id):
         parse_mode=ParseMode.HTML
     )
     
-    # Update auto-delete tracking for the edited message
-    message_key = f"admin_list_{original_user_id}_{query.message.message_id}"
-    INFOBANK_MESSAGES[message_key] = query.message
-    asyncio.create_task(schedule_auto_delete(query.message, message_key, "infobank"))
+    # Restart the auto-delete timer for the edited message
+    schedule_delete(query.message)
 
 async def infobank(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -560,19 +2783,14 @@ async def infobank(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is the owner or co-owner
     if not (is_owner(user) or is_co_owner(user)):
         # Immediately delete the command message
-        try:
-            await update.message.delete()
-        except:
-            pass  # If already deleted, just ignore
+        delete_soon(update.message)
         return
     
     # Get owner info
     owner_link = f'<a href="tg://user?id={OWNER_ID}">riv</a>'
     
     # Get totals
-    accounts = get_all_accounts()
-    total_accs = len(accounts)
-    total_value = sum(float(acc.get('Balance', 0)) for acc in accounts)
+    total_accs, total_value = await get_bank_totals()
     
     # Format to 4 digits for accounts, 3 digits for value
     total_accs_formatted = f"{total_accs:04d}"
@@ -597,15 +2815,10 @@ async def infobank(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Schedule auto-delete after 1 minute
-    message_key = f"infobank_{user_id}_{message.message_id}"
-    INFOBANK_MESSAGES[message_key] = message
-    asyncio.create_task(schedule_auto_delete(message, message_key, "infobank"))
+    schedule_delete(message)
     
     # Immediately delete the command message too
-    try:
-        await update.message.delete()
-    except:
-        pass  # If already deleted, just ignore
+    delete_soon(update.message)
 
 async def co(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -613,19 +2826,13 @@ async def co(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is the owner or co-owner
     if not can_manage_users(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
@@ -633,29 +2840,17 @@ async def co(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if target is a bot
     if target.is_bot:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if target is already co-owner
-    if target.username in CO_OWNERS:
+    if ROLES.role(target) == CO_OWNER:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Remove from managers if they were one
-    if target.username in ADMINS:
-        ADMINS.remove(target.username)
-        save_admins()
-    
-    # Add to co-owners
-    CO_OWNERS.append(target.username)
-    save_co_owners()
+    # Make co-owner, replacing any manager role
+    await ROLES.set(target, CO_OWNER)
     
     # Send success message first
     success_msg = await update.message.reply_text("promotion success ☑️")
@@ -670,12 +2865,8 @@ async def co(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete both messages after 2 seconds
-    await asyncio.sleep(2)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 2)
+    schedule_delete(update.message, 2)
 
 async def prom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -683,19 +2874,13 @@ async def prom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is the owner or co-owner
     if not can_manage_users(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
@@ -703,29 +2888,17 @@ async def prom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if target is a bot
     if target.is_bot:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if target is already manager
-    if target.username in ADMINS:
+    if ROLES.role(target) == MANAGER:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Remove from co-owners if they were one
-    if target.username in CO_OWNERS:
-        CO_OWNERS.remove(target.username)
-        save_co_owners()
-    
-    # Add to managers
-    ADMINS.append(target.username)
-    save_admins()
+    # Make manager, replacing any co-owner role
+    await ROLES.set(target, MANAGER)
     
     # Send success message first
     success_msg = await update.message.reply_text("promotion success ☑️")
@@ -740,12 +2913,8 @@ async def prom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete both messages after 2 seconds
-    await asyncio.sleep(2)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 2)
+    schedule_delete(update.message, 2)
 
 async def dem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -753,19 +2922,13 @@ async def dem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is the owner or co-owner
     if not can_manage_users(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
@@ -773,29 +2936,17 @@ async def dem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if target is a bot
     if target.is_bot:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if target is manager or co-owner
-    if target.username not in ADMINS and target.username not in CO_OWNERS:
+    if ROLES.role(target) is None:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Remove from both lists
-    if target.username in ADMINS:
-        ADMINS.remove(target.username)
-        save_admins()
-    
-    if target.username in CO_OWNERS:
-        CO_OWNERS.remove(target.username)
-        save_co_owners()
+    # Remove their role
+    await ROLES.set(target, None)
     
     # Send success message first
     success_msg = await update.message.reply_text("demotion success ☑️")
@@ -810,12 +2961,8 @@ async def dem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete both messages after 2 seconds
-    await asyncio.sleep(2)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 2)
+    schedule_delete(update.message, 2)
 
 async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -823,22 +2970,15 @@ async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is owner, co-owner or manager
     if not can_modify(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Send error message and delete both after 0.1 second
         error_msg = await update.message.reply_text("please reply to a user's message ❌")
-        await asyncio.sleep(0.1)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 0.1)
+        schedule_delete(update.message, 0.1)
         return
     
     target = update.message.reply_to_message.from_user
@@ -846,39 +2986,25 @@ async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if target is a bot
     if target.is_bot:
         error_msg = await update.message.reply_text("cannot create account for bot ❌")
-        await asyncio.sleep(0.1)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
+        schedule_delete(error_msg, 0.1)
+        schedule_delete(update.message, 0.1)
         return
     
-    # Check if account already exists
-    if find_user_row(target.id):
-        error_msg = await update.message.reply_text("user already has an account ❌")
-        await asyncio.sleep(0.1)
-        try:
-            await error_msg.delete()
-            await update.message.delete()
-        except:
-            pass
-        return
-    
-    # Create account
+    # Create account, checking for an existing one under the account lock
+    # so two concurrent /new commands cannot append the same user twice
     name = target.full_name
     username = f"@{target.username}" if target.username else ""
     link = f'<a href="tg://user?id={target.id}">{target.first_name}</a>'
     
-    sheet.append_row([
-        target.id, 
-        name, 
-        username, 
-        link, 
-        "0",  # Starting balance
-        format_datetime(),  # Created date
-        ""  # Last transaction
-    ])
+    async with account_lock(target.id):
+        created = await create_account(target.id, name, username, link)
+    
+    # Check if account already exists
+    if not created:
+        error_msg = await update.message.reply_text("user already has an account ❌")
+        schedule_delete(error_msg, 0.1)
+        schedule_delete(update.message, 0.1)
+        return
     
     # Send success message first
     success_msg = await update.message.reply_text("creation success ☑️")
@@ -893,12 +3019,8 @@ async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete both messages after 2 seconds
-    await asyncio.sleep(2)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 2)
+    schedule_delete(update.message, 2)
 
 async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -906,69 +3028,57 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is owner, co-owner or manager
     if not can_modify(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
+        return
+    
+    # Bulk form without a reply, e.g. "/add 50 @alice @bob" or "/add 50 all"
+    if not update.message.reply_to_message and context.args:
+        await bulk_mutation(update, context, "added")
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if amount is provided
     if not context.args or len(context.args) < 1:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     try:
         amount = float(context.args[0])
         if amount <= 0:
             # Delete command message immediately
-            try:
-                await update.message.delete()
-            except:
-                pass
+            delete_soon(update.message)
             return
     except:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
     
-    # Check if target has an account
-    row = find_user_row(target.id)
-    if not row:
-        # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
-        return
-    
-    # Get current balance and update
-    current_balance = float(sheet.cell(row, 5).value or 0)
-    new_balance = current_balance + amount
-    
-    # Update balance and last transaction
-    sheet.update_cell(row, 5, str(new_balance))
-    sheet.update_cell(row, 7, format_datetime())
+    # Read, update and record under the account lock so concurrent
+    # mutations of the same account cannot lose each other's updates
+    async with account_lock(target.id):
+        account = await get_account(target.id)
+        if account:
+            # Get current balance and update
+            current_balance = account["balance"]
+            new_balance = current_balance + amount
+            
+            # Update balance and last transaction, adding the transaction to history
+            await update_balance(target.id, new_balance, format_datetime(),
+                                 make_transaction(amount, user.id, user.first_name, "added"))
     
-    # Add transaction to history
-    add_transaction(target.id, amount, user.id, user.first_name, "added")
+    # Check if target has an account
+    if not account:
+        # Delete command message immediately
+        delete_soon(update.message)
+        return
     
     # Create user links
     executor_link = f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
@@ -991,11 +3101,7 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete the command message after 0.5 seconds
-    await asyncio.sleep(0.5)
-    try:
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(update.message, 0.5)
 
 async def use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -1003,81 +3109,67 @@ async def use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is owner, co-owner or manager
     if not can_modify(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
+        return
+    
+    # Bulk form without a reply, e.g. "/use 50 @alice @bob" or "/use 50 all"
+    if not update.message.reply_to_message and context.args:
+        await bulk_mutation(update, context, "used")
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if amount is provided
     if not context.args or len(context.args) < 1:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     try:
         amount = float(context.args[0])
         if amount <= 0:
             # Delete command message immediately
-            try:
-                await update.message.delete()
-            except:
-                pass
+            delete_soon(update.message)
             return
     except:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
     
+    # Read, check, update and record under the account lock so concurrent
+    # mutations of the same account cannot lose updates or overdraw it
+    async with account_lock(target.id):
+        account = await get_account(target.id)
+        
+        # Get current balance
+        current_balance = account["balance"] if account else 0
+        
+        if account and current_balance >= amount:
+            # Deduct amount from balance
+            new_balance = current_balance - amount
+            
+            # Update balance and last transaction, adding the transaction to history
+            await update_balance(target.id, new_balance, format_datetime(),
+                                 make_transaction(amount, user.id, user.first_name, "used"))
+    
     # Check if target has an account
-    row = find_user_row(target.id)
-    if not row:
+    if not account:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Get current balance
-    current_balance = float(sheet.cell(row, 5).value or 0)
-    
     # Check if user has sufficient balance
     if current_balance < amount:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Deduct amount from balance
-    new_balance = current_balance - amount
-    
-    # Update balance and last transaction
-    sheet.update_cell(row, 5, str(new_balance))
-    sheet.update_cell(row, 7, format_datetime())
-    
-    # Add transaction to history
-    add_transaction(target.id, amount, user.id, user.first_name, "used")
-    
     # Create user links
     executor_link = f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
     target_link = f'<a href="tg://user?id={target.id}">{target.first_name}</a>'
@@ -1099,10 +3191,152 @@ async def use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete the command message immediately
+    delete_soon(update.message)
+
+# Bulk /add and /use without a reply: "/add 50 @alice @bob 123456789" gives
+# every target 50, "/add @alice=50 123456789=25" sets amounts per target and
+# "all" targets every account. The batch is validated as a whole and
+# committed with one write.
+BULK_SUMMARY_LINES = 30
+BULK_ERROR_DELAY = 5
+
+def parse_amount(text):
+    amount = float(text)
+    if not 0 < amount < float("inf"):
+        raise ValueError
+    return amount
+
+def parse_bulk_args(args):
+    """Turn bulk command arguments into (target, amount) pairs, raising ValueError on bad input"""
+    default_amount = None
+    first = args[0]
+    if "=" not in first and not first.startswith("@") and first.lower() != "all":
+        try:
+            default_amount = parse_amount(first)
+        except ValueError:
+            raise ValueError(f"invalid amount {first}")
+        args = args[1:]
+    
+    pairs = []
+    for token in args:
+        target, has_amount, amount = token.partition("=")
+        if has_amount:
+            try:
+                pairs.append((target, parse_amount(amount)))
+            except ValueError:
+                raise ValueError(f"invalid amount for {target}")
+        elif default_amount is None:
+            raise ValueError(f"no amount for {token}")
+        else:
+            pairs.append((token, default_amount))
+    if not pairs:
+        raise ValueError("no accounts given")
+    return pairs
+
+def resolve_bulk_targets(pairs, accounts):
+    """Sum the amount per account ID, return (amounts, targets without an account)"""
+    by_username = {account["username"].lower(): account["user_id"] for account in accounts if account["username"]}
+    known = [account["user_id"] for account in accounts]
+    known_set = set(known)
+    amounts = {}
+    unknown = []
+    for target, amount in pairs:
+        if target.lower() == "all":
+            user_ids = known
+        elif target.startswith("@"):
+            user_ids = [by_username[target.lower()]] if target.lower() in by_username else []
+        else:
+            user_ids = [target] if target in known_set else []
+        if not user_ids:
+            unknown.append(target)
+        for user_id in user_ids:
+            amounts[user_id] = amounts.get(user_id, 0) + amount
+    return amounts, unknown
+
+async def reply_bulk_error(update, text):
+    error_msg = await update.message.reply_text(f"{html.escape(text)} ❌", parse_mode=ParseMode.HTML)
+    schedule_delete(error_msg, BULK_ERROR_DELAY)
+    schedule_delete(update.message, BULK_ERROR_DELAY)
+
+async def bulk_mutation(update: Update, context: ContextTypes.DEFAULT_TYPE, transaction_type):
+    """Add to or use from many accounts at once with a single batch write"""
+    user = update.effective_user
+    
     try:
-        await update.message.delete()
-    except:
-        pass
+        pairs = parse_bulk_args(context.args)
+    except ValueError as e:
+        await reply_bulk_error(update, str(e))
+        return
+    
+    accounts = {account["user_id"]: account for account in await get_all_accounts()}
+    # A bare number in front is always the amount, so an account ID there is a mistake
+    first = context.args[0]
+    if first in accounts:
+        await reply_bulk_error(update, f"{first} is an account ID; put the amount first or write {first}=amount")
+        return
+    amounts, unknown = resolve_bulk_targets(pairs, accounts.values())
+    if unknown:
+        await reply_bulk_error(update, f"no account for {', '.join(unknown)}")
+        return
+    
+    # Lock every target in a fixed order so concurrent batches cannot deadlock
+    async with contextlib.AsyncExitStack() as stack:
+        for user_id in sorted(amounts):
+            await stack.enter_async_context(account_lock(user_id))
+        
+        # The snapshot still holds unless a target changed before we took the
+        # locks; only then read the accounts again
+        known = await get_known_balances(amounts)
+        if any(known.get(user_id) != accounts[user_id]["balance"] for user_id in amounts):
+            accounts = {account["user_id"]: account for account in await get_all_accounts()}
+            missing = [user_id for user_id in amounts if user_id not in accounts]
+            if missing:
+                await reply_bulk_error(update, f"no account for {', '.join(missing)}")
+                return
+        
+        sign = 1 if transaction_type == "added" else -1
+        short = [accounts[user_id]["name"] for user_id, amount in amounts.items()
+                 if sign < 0 and accounts[user_id]["balance"] < amount]
+        if short:
+            await reply_bulk_error(update, f"insufficient balance for {', '.join(short)}")
+            return
+        
+        changes = [
+            (user_id, accounts[user_id]["balance"] + sign * amount,
+             make_transaction(amount, user.id, user.first_name, transaction_type))
+            for user_id, amount in amounts.items()
+        ]
+        if not await update_balances(changes, format_datetime()):
+            await reply_bulk_error(update, "accounts changed while applying, try again")
+            return
+    
+    # One summary reply and one log entry for the whole batch
+    executor_link = f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
+    verb = "added" if sign > 0 else "used"
+    total = sum(amounts.values())
+    lines = [
+        f"• {html.escape(accounts[user_id]['name'][:DATA_LIST_NAME_LENGTH])} — {CURRENCY}{amounts[user_id]:,.0f} → {CURRENCY}{balance:,.0f}"
+        for user_id, balance, _ in changes
+    ]
+    shown = lines[:BULK_SUMMARY_LINES]
+    if len(lines) > len(shown):
+        shown.append(f"• … and {len(lines) - len(shown)} more")
+    
+    await update.message.reply_text(
+        f"<b>done!</b> by {executor_link}\n\n"
+        f"{verb} {CURRENCY}{total:,.0f} across {len(changes)} accounts\n" +
+        "\n".join(shown),
+        parse_mode=ParseMode.HTML
+    )
+    
+    await send_log(context,
+        f"{'💰' if sign > 0 else '💸'} <b>Bulk Funds {verb.title()}</b>\n"
+        f"• {executor_link} {verb} {CURRENCY}{total:,.0f} across {len(changes)} accounts\n" +
+        "\n".join(lines) + "\n"
+        f"• Date: {format_datetime()}"
+    )
+    
+    schedule_delete(update.message, 0.5)
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -1110,41 +3344,28 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if user is owner, co-owner or manager
     if not can_modify(user):
         # Delete command message immediately for unauthorized users
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     # Check if replying to a message
     if not update.message.reply_to_message or not update.message.reply_to_message.from_user:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
     target = update.message.reply_to_message.from_user
     
+    # Reset under the account lock so it is ordered with concurrent /add and /use
+    async with account_lock(target.id):
+        # Reset account balance to 0 and clear transaction history for this user
+        reset_done = await reset_account(target.id, format_datetime())
+    
     # Check if target has an account
-    row = find_user_row(target.id)
-    if not row:
+    if not reset_done:
         # Delete command message immediately
-        try:
-            await update.message.delete()
-        except:
-            pass
+        delete_soon(update.message)
         return
     
-    # Reset account balance to 0
-    sheet.update_cell(row, 5, "0")
-    sheet.update_cell(row, 7, format_datetime())
-    
-    # Clear transaction history for this user
-    if target.id in TRANSACTION_HISTORY:
-        del TRANSACTION_HISTORY[target.id]
-    
     # Send success message first
     success_msg = await update.message.reply_text("reset success ☑️")
     
@@ -1159,22 +3380,19 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Then delete both messages after 2 seconds
-    await asyncio.sleep(2)
-    try:
-        await success_msg.delete()
-        await update.message.delete()
-    except:
-        pass
+    schedule_delete(success_msg, 2)
+    schedule_delete(update.message, 2)
 
 async def handle_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Automatically delete accounts when users leave the group"""
     try:
         left_member = update.message.left_chat_member
         
-        # Check if the user who left has an account
-        if find_user_row(left_member.id):
-            # Delete the account
-            delete_user_account(left_member.id)
+        # Delete the account if the user who left has one
+        async with account_lock(left_member.id):
+            deleted = await delete_user_account(left_member.id)
+        
+        if deleted:
             print(f"✅ Deleted account for user who left: {left_member.id} ({left_member.full_name})")
             
             # Log the action if log channel is set
@@ -1189,6 +3407,64 @@ async def handle_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         print(f"Error handling left member: {e}")
 
+CALLBACK_BRANCHES = ("history_page_", "history_back_", "history_", "per_admin_", "bal_back_", "close_bal_",
+                     "data_list_", "data_page_", "admin_list_", "go_back_", "close_")
+
+def callback_branch(update):
+    """Metrics label for the button_callback branch an update takes"""
+    data = (update.callback_query.data or "") if update.callback_query else ""
+    for prefix in CALLBACK_BRANCHES:
+        if data.startswith(prefix):
+            return "button:" + prefix.rstrip("_")
+    return "button:other"
+
+def format_ms(seconds):
+    return f"{seconds * 1000:.0f}ms"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show latency and call statistics to the owner"""
+    user = update.effective_user
+    
+    # Owner only
+    if not is_owner(user):
+        delete_soon(update.message)
+        return
+    
+    uptime = int(time.monotonic() - STARTUP_STARTED)
+    lines = [
+        "<b>bot stats</b> 📊",
+        f"uptime — {uptime // 3600}h {uptime % 3600 // 60}m",
+        f"parked updates — {UPDATE_PROCESSOR.queue_depth} (peak {UPDATE_PROCESSOR.peak_queued})",
+        "",
+        "<b>handlers</b>",
+    ]
+    for (label,) in sorted(HANDLER_SECONDS.values):
+        lines.append(
+            f"{html.escape(label)} — {HANDLER_SECONDS.count(label)} · "
+            f"p50 {format_ms(HANDLER_SECONDS.quantile(0.5, label))} · "
+            f"p95 {format_ms(HANDLER_SECONDS.quantile(0.95, label))} · "
+            f"{HANDLER_ERRORS.values.get((label,), 0)} errors"
+        )
+    
+    sheets_calls = sum(SHEETS_SECONDS.count(*labels) for labels in SHEETS_SECONDS.values)
+    slowest_sheets = max((SHEETS_SECONDS.quantile(0.95, *labels) for labels in SHEETS_SECONDS.values), default=0)
+    telegram_calls = sum(TELEGRAM_SECONDS.count(*labels) for labels in TELEGRAM_SECONDS.values)
+    slowest_telegram = max((TELEGRAM_SECONDS.quantile(0.95, *labels) for labels in TELEGRAM_SECONDS.values), default=0)
+    throttled = " · ".join(f"{name} {seconds:.1f}s" for name, seconds in RATE_LIMITER.throttled_seconds.items())
+    lines += [
+        "",
+        f"<b>sheets</b> — {sheets_calls} calls · {SHEETS_ERRORS.total()} errors · worst p95 {format_ms(slowest_sheets)}",
+        f"<b>telegram</b> — {telegram_calls} calls · {TELEGRAM_ERRORS.total()} errors · worst p95 {format_ms(slowest_telegram)}",
+        f"• {TELEGRAM_BYTES.values.get(('sent',), 0) // 1024} KB sent · {TELEGRAM_BYTES.values.get(('received',), 0) // 1024} KB received",
+        f"<b>throttled</b> — {throttled}",
+    ]
+    
+    message = await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    
+    # Schedule auto-delete after 1 minute
+    schedule_delete(message)
+    schedule_delete(update.message, 0.5)
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = update.effective_user
@@ -1210,7 +3486,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await query.answer()
                     return
         
-        elif callback_data.startswith(("data_list_", "go_back_", "close_", "admin_list_")):
+        elif callback_data.startswith(("data_list_", "data_page_", "go_back_", "close_", "admin_list_")):
             # For infobank callbacks
             original_user_id = int(callback_data.split('_')[-1])
             
@@ -1221,30 +3497,29 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
         
         # Handle balance-related callbacks
-        if callback_data.startswith("history_") and not callback_data.startswith("history_back_"):
+        if callback_data.startswith("history_") and not callback_data.startswith(("history_back_", "history_page_")):
             # Format: history_123456789_987654321
             parts = callback_data.split("_")
             target_id = int(parts[1])
             original_user_id = int(parts[2])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"bal_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
             await show_transaction_history(query, target_id, original_user_id)
         
+        elif callback_data.startswith("history_page_"):
+            # Format: history_page_123456789_2_987654321
+            parts = callback_data.split("_")
+            target_id = int(parts[2])
+            page = max(int(parts[3]), 0)
+            original_user_id = int(parts[4])
+            
+            await show_transaction_history(query, target_id, original_user_id, page)
+        
         elif callback_data.startswith("per_admin_"):
             # Format: per_admin_123456789_987654321
             parts = callback_data.split("_")
             target_id = int(parts[2])
             original_user_id = int(parts[3])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"history_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
             await show_per_admin(query, target_id, original_user_id)
         
         elif callback_data.startswith("history_back_"):
@@ -1253,11 +3528,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(parts[2])
             original_user_id = int(parts[3])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"per_admin_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
             await show_transaction_history(query, target_id, original_user_id)
         
         elif callback_data.startswith("bal_back_"):
@@ -1266,19 +3536,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(parts[2])
             original_user_id = int(parts[3])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"history_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
             # Get account details
-            row = find_user_row(target_id)
-            if not row:
+            account = await get_account(target_id)
+            if not account:
                 return
             
-            name = sheet.cell(row, 2).value
-            balance = float(sheet.cell(row, 5).value or 0)
-            last_transaction = sheet.cell(row, 7).value or "Never"
+            name = account["name"]
+            balance = account["balance"]
+            last_transaction = account["last_transaction"] or "Never"
             
             # Clean the last transaction - remove any transaction details after the date
             if "•" in last_transaction:
@@ -1305,10 +3570,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
             
-            # Update auto-delete tracking for the edited message
-            message_key = f"bal_{target_id}_{original_user_id}_{query.message.message_id}"
-            BAL_MESSAGES[message_key] = query.message
-            asyncio.create_task(schedule_auto_delete(query.message, message_key, "bal"))
+            # Restart the auto-delete timer for the edited message
+            schedule_delete(query.message)
         
         elif callback_data.startswith("close_bal_"):
             # Format: close_bal_123456789_987654321 - for balance messages
@@ -1316,90 +3579,39 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(parts[2])
             original_user_id = int(parts[3])
             
-            # Remove message from auto-delete tracking since user is closing
-            message_key_to_remove = f"bal_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
-            message_key_to_remove = f"history_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
-            message_key_to_remove = f"per_admin_{target_id}_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in BAL_MESSAGES:
-                del BAL_MESSAGES[message_key_to_remove]
-            
-            await query.message.delete()
+            # Replaces the pending auto-delete
+            delete_soon(query.message)
         
         # Handle infobank callbacks
         elif callback_data.startswith("data_list_"):
             # Format: data_list_123456789
             original_user_id = int(callback_data.split('_')[-1])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"infobank_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
-            accounts = get_all_accounts()
-            accounts.reverse()  # Newest first
-            accounts = accounts[:1000]  # Limit to 1000
-            
-            message_text = "<b>data list —</b>\n\n"
-            for i, acc in enumerate(accounts, 1):
-                name = acc.get('Name', 'Unknown')
-                balance = float(acc.get('Balance', 0))
-                message_text += f"{i}. {name} {CURRENCY}{balance:,.0f}\n"
-            
-            # Add go back and close buttons with user ID
-            keyboard = [
-                [InlineKeyboardButton("go back", callback_data=f"go_back_{original_user_id}"), 
-                 InlineKeyboardButton("close", callback_data=f"close_{original_user_id}")]
-            ]
-            
-            # Edit the original message to show data list with buttons
-            await query.edit_message_text(
-                message_text, 
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.HTML
-            )
+            await show_data_list(query, original_user_id)
+        
+        elif callback_data.startswith("data_page_"):
+            # Format: data_page_25_123456789
+            parts = callback_data.split("_")
+            offset = int(parts[2])
+            original_user_id = int(parts[3])
             
-            # Update auto-delete tracking for the edited message
-            message_key = f"data_list_{original_user_id}_{query.message.message_id}"
-            INFOBANK_MESSAGES[message_key] = query.message
-            asyncio.create_task(schedule_auto_delete(query.message, message_key, "infobank"))
+            await show_data_list(query, original_user_id, offset)
         
         elif callback_data.startswith("admin_list_"):
             # Format: admin_list_123456789
             original_user_id = int(callback_data.split('_')[-1])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"infobank_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
             await show_admin_list(query, original_user_id)
         
         elif callback_data.startswith("go_back_"):
             # Format: go_back_123456789
             original_user_id = int(callback_data.split('_')[-1])
             
-            # Remove message from auto-delete tracking since user is interacting
-            message_key_to_remove = f"data_list_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
-            message_key_to_remove = f"admin_list_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
             # Get owner info
             owner_link = f'<a href="tg://user?id={OWNER_ID}">riv</a>'
             
             # Get totals
-            accounts = get_all_accounts()
-            total_accs = len(accounts)
-            total_value = sum(float(acc.get('Balance', 0)) for acc in accounts)
+            total_accs, total_value = await get_bank_totals()
             
             # Format to 4 digits for accounts, 3 digits for value
             total_accs_formatted = f"{total_accs:04d}"
@@ -1422,56 +3634,824 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
             
-            # Update auto-delete tracking for the edited message
-            message_key = f"infobank_{original_user_id}_{query.message.message_id}"
-            INFOBANK_MESSAGES[message_key] = query.message
-            asyncio.create_task(schedule_auto_delete(query.message, message_key, "infobank"))
+            # Restart the auto-delete timer for the edited message
+            schedule_delete(query.message)
         
         elif callback_data.startswith("close_"):
             # Format: close_123456789 - for infobank messages
             original_user_id = int(callback_data.split('_')[-1])
             
-            # Remove message from auto-delete tracking since user is closing
-            message_key_to_remove = f"infobank_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
-            message_key_to_remove = f"data_list_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
-            message_key_to_remove = f"admin_list_{original_user_id}_{query.message.message_id}"
-            if message_key_to_remove in INFOBANK_MESSAGES:
-                del INFOBANK_MESSAGES[message_key_to_remove]
-            
-            # Delete message immediately
-            await query.message.delete()
+            # Replaces the pending auto-delete
+            delete_soon(query.message)
     
     except (ValueError, IndexError) as e:
         print(f"Error parsing callback data: {callback_data} - {e}")
         # Ignore callback data parsing errors
         pass
 
-# Start bot
-app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-# Add handlers
-app.add_handler(CommandHandler("setlog", setlog))
-app.add_handler(CommandHandler("connect", connect))
-app.add_handler(CommandHandler("infobank", infobank))
-app.add_handler(CommandHandler("co", co))
-app.add_handler(CommandHandler("prom", prom))
-app.add_handler(CommandHandler("dem", dem))
-app.add_handler(CommandHandler("new", new))
-app.add_handler(CommandHandler("add", add))
-app.add_handler(CommandHandler("use", use))
-app.add_handler(CommandHandler("reset", reset))
-app.add_handler(CommandHandler("bal", bal))
-app.add_handler(CallbackQueryHandler(button_callback))
-
-# Add handler for left chat members
-from telegram.ext import MessageHandler, filters
-app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, handle_left_member))
-
-print("✅ River Bank is running!")
-app.run_polling()
+# Updates from different chats are processed concurrently, up to this many at once
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, one at a time per chat.
+
+    The first update of an idle chat runs straight away and then drains,
+    in arrival order, any updates that came in for the same chat while it
+    ran. Those wait in a per-chat deque instead of holding one of the
+    max_concurrent_updates slots, so one busy chat cannot starve the rest.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.chat_queues = {}  # chat ID -> coroutines waiting behind the running update
+        self.queued = 0
+        self.peak_queued = 0
+
+    @property
+    def queue_depth(self):
+        """Updates parked behind a busy chat"""
+        return self.queued
+
+    @property
+    def active_chats(self):
+        """Chats with an update being processed"""
+        return len(self.chat_queues)
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        
+        queue = self.chat_queues.get(chat.id)
+        if queue is not None:
+            # This chat is busy: its running update will pick this one up
+            queue.append(coroutine)
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            return
+        
+        queue = self.chat_queues[chat.id] = collections.deque()
+        try:
+            await coroutine
+            while queue:
+                coroutine = queue.popleft()
+                self.queued -= 1
+                await coroutine
+        finally:
+            del self.chat_queues[chat.id]
+            # Only reached with leftovers when cancelled during shutdown
+            while queue:
+                queue.popleft().close()
+                self.queued -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+UPDATE_PROCESSOR = ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+
+# Outbound Bot API requests share one global budget and one per chat. When
+# requests queue up, user replies go first, then edits, log messages and
+# finally deletions.
+RATE_LIMIT_GLOBAL = 30  # requests per second across all chats
+RATE_LIMIT_PRIVATE = 1  # messages per second in a private chat
+RATE_LIMIT_GROUP = 20  # messages per minute in a group or channel
+RATE_LIMIT_MAX_RETRIES = 3
+RATE_LIMIT_MAX_CHATS = 10000
+
+PRIORITY_REPLY, PRIORITY_EDIT, PRIORITY_LOG, PRIORITY_DELETE = range(4)
+PRIORITY_NAMES = ("replies", "edits", "logs", "deletes")
+ENDPOINT_PRIORITIES = {
+    "editMessageText": PRIORITY_EDIT,
+    "editMessageReplyMarkup": PRIORITY_EDIT,
+    "deleteMessage": PRIORITY_DELETE,
+    "deleteMessages": PRIORITY_DELETE,
+}
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Throttles Bot API requests with a global and a per-chat token bucket.
+
+    A request that cannot go straight away waits in a list ordered by
+    priority and arrival; a dispatcher task releases waiters as tokens
+    refill. Deletions and requests without a chat only draw from the global
+    bucket. On RetryAfter the affected bucket is paused for retry_after and
+    the request is retried up to RATE_LIMIT_MAX_RETRIES times. Time spent
+    waiting is counted per priority class.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL)
+        self.chat_buckets = {}
+        self.waiters = []  # sorted (priority, sequence, chat_id, future)
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.requests = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.throttled_seconds = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.retry_afters = 0
+        self.retry_after_seconds = 0.0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= RATE_LIMIT_MAX_CHATS:
+                now = time.monotonic()
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle(now)}
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(RATE_LIMIT_PRIVATE, RATE_LIMIT_PRIVATE)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_GROUP / 60, RATE_LIMIT_GROUP)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def try_take(self, chat_id, now):
+        """Take a token from the global and chat bucket, or return the seconds to wait"""
+        wait = self.global_bucket.wait_time(now)
+        if chat_id is not None:
+            wait = max(wait, self.chat_bucket(chat_id).wait_time(now))
+        if wait > 0:
+            return wait
+        self.global_bucket.take()
+        if chat_id is not None:
+            self.chat_bucket(chat_id).take()
+        return 0
+
+    def dispatch(self):
+        """Release every waiter that may go now and return the seconds until the next one can"""
+        now = time.monotonic()
+        delay = None
+        remaining = []
+        for waiter in self.waiters:
+            future = waiter[3]
+            if future.done():
+                continue
+            wait = self.try_take(waiter[2], now)
+            if wait:
+                remaining.append(waiter)
+                delay = wait if delay is None else min(delay, wait)
+            else:
+                future.set_result(None)
+        self.waiters = remaining
+        return delay
+
+    async def run(self):
+        while True:
+            delay = self.dispatch()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def acquire(self, priority, chat_id):
+        if not self.waiters and self.try_take(chat_id, time.monotonic()) == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self.waiters, (priority, next(self.sequence), chat_id, future))
+        self.wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        else:
+            priority = ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_REPLY)
+        chat_id = None if priority == PRIORITY_DELETE else data.get("chat_id")
+        name = PRIORITY_NAMES[priority]
+        self.requests[name] += 1
+        
+        retries = 0
+        while True:
+            started = time.monotonic()
+            await self.acquire(priority, chat_id)
+            self.throttled_seconds[name] += time.monotonic() - started
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_afters += 1
+                self.retry_after_seconds += e.retry_after
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self.global_bucket.pause(e.retry_after)
+                retries += 1
+                if retries > RATE_LIMIT_MAX_RETRIES:
+                    raise
+
+    async def initialize(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def shutdown(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for waiter in self.waiters:
+            waiter[3].cancel()
+        self.waiters = []
+
+RATE_LIMITER = PriorityRateLimiter()
+
+# Background startup tasks, so updates are accepted while Sheets and storage connect
+STARTUP_TASKS = []
+
+async def post_init(application):
+    """Start background schedulers and begin connecting the sheet and storage"""
+    STARTUP_TASKS.append(asyncio.create_task(connect_sheet()))
+    STARTUP_TASKS.append(asyncio.create_task(start_storage(application)))
+    if WORKER_STATE:
+        # Scheduled jobs start once this worker is elected leader
+        STARTUP_TASKS.append(asyncio.create_task(WORKER_STATE.lead(application.bot)))
+    else:
+        await DELETION_SCHEDULER.start(application.bot)
+    await LOG_PIPELINE.start(application.bot)
+    await ROLES.start()
+    await start_metrics_server()
+    mark_startup("accepting_updates")
+
+async def post_stop(application):
+    """Flush queued log messages while the bot can still send them"""
+    await LOG_PIPELINE.stop()
+
+async def post_shutdown(application):
+    """Persist pending deletions and drain storage on shutdown"""
+    for task in STARTUP_TASKS:
+        task.cancel()
+    await stop_metrics_server()
+    await ROLES.stop()
+    await DELETION_SCHEDULER.stop()
+    await stop_storage()
+
+# Webhook mode: BOT_MODE=webhook serves updates over HTTP instead of long
+# polling. WEBHOOK_URL, when set, is registered with Telegram on start;
+# leave it unset to post updates to the endpoint yourself. Telegram only
+# delivers to https:// URLs, so either set WEBHOOK_CERT and WEBHOOK_KEY to
+# serve TLS directly or put a TLS-terminating reverse proxy in front.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT")  # PEM certificate chain
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY")  # PEM private key
+# Left-member notices arrive as messages
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_READ_TIMEOUT = 10
+# Set while run_webhook serves; setting it shuts the server down
+WEBHOOK_STOPPING = None
+
+async def read_http_request(reader):
+    """Read one HTTP request and return (method, path, headers, body)"""
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if length > HTTP_MAX_BODY:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, target.split("?", 1)[0], headers, body
+
+async def handle_http(reader, writer, routes):
+    """Serve one request per connection from routes, a dict of path -> handler.
+
+    A handler is called as handler(method, headers, body) and returns
+    (status, content_type, body).
+    """
+    status, content_type, body = 400, "text/plain", b"Bad Request"
+    try:
+        method, path, headers, payload = await asyncio.wait_for(read_http_request(reader), HTTP_READ_TIMEOUT)
+        route = routes.get(path)
+        if route is None:
+            status, body = 404, b"Not Found"
+        else:
+            status, content_type, body = await route(method, headers, payload)
+    except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        pass
+    except Exception as e:
+        print(f"HTTP handler error: {e}")
+        status, body = 500, b"Internal Server Error"
+    try:
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+        writer.close()
+    except Exception:
+        pass
+
+async def start_http_server(host, port, routes, ssl_context=None):
+    return await asyncio.start_server(functools.partial(handle_http, routes=routes), host, port, ssl=ssl_context)
+
+def webhook_ssl_context():
+    """TLS context for the webhook server from WEBHOOK_CERT and WEBHOOK_KEY, None to serve plain HTTP"""
+    if not WEBHOOK_CERT and not WEBHOOK_KEY:
+        return None
+    if not (WEBHOOK_CERT and WEBHOOK_KEY):
+        raise ValueError("WEBHOOK_CERT and WEBHOOK_KEY must be set together")
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+    return context
+
+async def handle_webhook(application, method, headers, body):
+    """Check the secret token and queue the posted update"""
+    if method != "POST":
+        return 405, "text/plain", b"Method Not Allowed"
+    token = headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return 403, "text/plain", b"Forbidden"
+    try:
+        update = Update.de_json(json.loads(body), application.bot)
+    except Exception:
+        return 400, "text/plain", b"Bad Request"
+    await application.update_queue.put(update)
+    return 200, "text/plain", b"OK"
+
+async def run_webhook(application):
+    """Run the application behind the built-in webhook server until SIGINT/SIGTERM or WEBHOOK_STOPPING"""
+    global WEBHOOK_STOPPING
+    if not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    if WEBHOOK_URL and not WEBHOOK_URL.startswith("https://"):
+        raise ValueError("Telegram only delivers webhooks over HTTPS, WEBHOOK_URL must start with https://")
+    ssl_context = webhook_ssl_context()
+    
+    stopping = WEBHOOK_STOPPING = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.start()
+        server = await start_http_server(WEBHOOK_LISTEN, WEBHOOK_PORT, {
+            WEBHOOK_PATH: functools.partial(handle_webhook, application),
+        }, ssl_context)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        print(f"🌐 Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}" + (" over TLS" if ssl_context else ""))
+        
+        await stopping.wait()
+        
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+        await post_stop(application)
+    finally:
+        WEBHOOK_STOPPING = None
+        await application.shutdown()
+        await post_shutdown(application)
+
+# Worker mode: BOT_MODE=workers runs an ingress process that long-polls
+# Telegram and hands each update to one of WORKERS worker processes, picked
+# by chat ID, so every chat is handled in order by a single process. The
+# workers are this script with BOT_MODE=worker, each serving the webhook
+# endpoint on 127.0.0.1:WORKER_PORT + index. They share the SQLite database.
+# One of them, elected by file lock, runs the scheduled jobs.
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_PORT = int(os.environ.get("WORKER_PORT", "8600"))
+WORKER_DB_PATH = os.environ.get("WORKER_DB_PATH", "workers.db")
+LEADER_LOCK_PATH = os.environ.get("LEADER_LOCK_PATH", "leader.lock")
+LEADER_RETRY_INTERVAL = 1.0
+WORKER_PULL_INTERVAL = 0.25
+WORKER_RESTART_DELAY = 1.0
+INGRESS_POLL_TIMEOUT = 30
+INGRESS_QUEUE_SIZE = 1000
+INGRESS_DRAIN_TIMEOUT = 10
+
+# Set once this process may run scheduled jobs; always, unless it is a worker
+LEADER = asyncio.Event()
+if BOT_MODE != "worker":
+    LEADER.set()
+
+WORKER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deletion_ops (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    due REAL
+);
+CREATE TABLE IF NOT EXISTS sheet_dirty (
+    bank TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (bank, user_id)
+);
+"""
+
+class WorkerState:
+    """Work the workers hand to the leader, through a small shared SQLite database.
+
+    Every worker records auto-delete schedules (a NULL due cancels one) and
+    accounts that need replicating to the sheet. The leader is the worker
+    holding an exclusive flock on LEADER_LOCK_PATH. It pulls both into its
+    own DeletionScheduler and sheet mirrors. The kernel drops the lock
+    when the leader exits. The next worker to take it resumes from
+    pending_deletes.json and this database.
+
+    All database work runs on one thread of its own, in order, so waiting
+    for another worker's write lock never blocks the event loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="workers-db")
+        self.leader_lock = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(WORKER_SCHEMA)
+
+    def submit(self, func, *args):
+        """Run a database write on the database thread without waiting for it"""
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(report_worker_db_error)
+
+    def schedule(self, chat_id, message_id, due):
+        self.submit(self.insert_deletion, chat_id, message_id, due)
+
+    def insert_deletion(self, chat_id, message_id, due):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO deletion_ops (chat_id, message_id, due) VALUES (?, ?, ?)",
+                (chat_id, message_id, due)
+            )
+
+    def mark(self, bank, user_id):
+        self.submit(self.insert_dirty, bank, user_id)
+
+    def insert_dirty(self, bank, user_id):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO sheet_dirty (bank, user_id) VALUES (?, ?)", (bank or "", user_id))
+
+    async def elect(self):
+        """Wait until this worker holds the leader lock"""
+        fd = os.open(LEADER_LOCK_PATH, os.O_RDWR | os.O_CREAT)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+        # Held open for the life of the process
+        self.leader_lock = fd
+
+    async def lead(self, bot):
+        """Once elected, run the scheduled jobs and keep pulling work from the other workers"""
+        await self.elect()
+        print(f"👑 Worker {WORKER_INDEX} is the leader")
+        LEADER.set()
+        await DELETION_SCHEDULER.start(bot)
+        while True:
+            try:
+                await self.pull()
+            except Exception as e:
+                print(f"Failed to pull work from the workers: {e}")
+            await asyncio.sleep(WORKER_PULL_INTERVAL)
+
+    def take_work(self):
+        """Read the queued deletions, and take the dirty accounts off the queue"""
+        # The write lock keeps other workers from adding rows between the reads and deletes
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            deletions = self.db.execute("SELECT id, chat_id, message_id, due FROM deletion_ops ORDER BY id").fetchall()
+            dirty = self.db.execute("SELECT bank, user_id FROM sheet_dirty").fetchall()
+            self.db.execute("DELETE FROM sheet_dirty")
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        return deletions, dirty
+
+    def drop_deletions(self, last_id):
+        with self.db:
+            self.db.execute("DELETE FROM deletion_ops WHERE id <= ?", (last_id,))
+
+    async def pull(self):
+        loop = asyncio.get_running_loop()
+        deletions, dirty = await loop.run_in_executor(self.executor, self.take_work)
+        
+        # Deletions leave the queue only once they are saved in pending_deletes.json,
+        # so a leader that dies in between leaves them to the next one
+        if deletions:
+            for _, chat_id, message_id, due in deletions:
+                if due is None:
+                    DELETION_SCHEDULER.cancel(chat_id, message_id)
+                else:
+                    DELETION_SCHEDULER.schedule(chat_id, message_id, due - time.time())
+            await DELETION_SCHEDULER.save()
+            await loop.run_in_executor(self.executor, self.drop_deletions, deletions[-1][0])
+        for bank, user_id in dirty:
+            try:
+                storage = await BANKS.get(bank or None)
+                storage.mirror.mark(user_id)
+            except Exception as e:
+                print(f"Failed to queue account {user_id} of bank {bank or 'default'} for the sheet: {e}")
+                self.mark(bank, user_id)
+
+WORKER_STATE = None  # WorkerState, in worker processes only
+
+def report_worker_db_error(future):
+    if future.exception():
+        print(f"Failed to hand work to the leader: {future.exception()}")
+
+def worker_environment(index, secret):
+    """Environment of worker process index"""
+    env = dict(os.environ)
+    # Workers take plain HTTP from the ingress on 127.0.0.1 and register no webhook
+    for name in ("WEBHOOK_URL", "WEBHOOK_CERT", "WEBHOOK_KEY"):
+        env.pop(name, None)
+    env.update({
+        "BOT_MODE": "worker",
+        "WORKER_INDEX": str(index),
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(WORKER_PORT + index),
+        "WEBHOOK_SECRET": secret,
+        "METRICS_PORT": str(METRICS_PORT + index) if METRICS_PORT else "0",
+    })
+    return env
+
+async def supervise_worker(index, secret, processes, stopping):
+    """Run worker process index, restarting it whenever it exits"""
+    while True:
+        # A session of its own, so Ctrl-C reaches the ingress only and it stops the workers in order
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env=worker_environment(index, secret),
+            start_new_session=True
+        )
+        processes[index] = process
+        code = await process.wait()
+        if stopping.is_set():
+            return
+        print(f"⚠️ Worker {index} exited with code {code}, restarting")
+        await asyncio.sleep(WORKER_RESTART_DELAY)
+
+async def forward_updates(index, queue, client, secret):
+    """Post queued updates to worker index one at a time, so their order holds"""
+    url = f"http://127.0.0.1:{WORKER_PORT + index}{WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+    while True:
+        body, handed = await queue.get()
+        for attempt in itertools.count():
+            try:
+                response = await client.post(url, content=body, headers=headers)
+                if response.status_code == 200:
+                    break
+                if response.status_code < 500:
+                    print(f"⚠️ Worker {index} rejected an update with {response.status_code}, dropped")
+                    break
+            except httpx.HTTPError:
+                # Starting or restarting; keep the update and everything behind it
+                pass
+            await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+        handed.set_result(None)
+        queue.task_done()
+
+async def run_ingress():
+    """Long-poll Telegram and route every update to the worker that owns its chat"""
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError("Worker mode shares state through SQLite, set STORAGE_BACKEND=sqlite")
+    
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    secret = os.urandom(16).hex()
+    processes = {}
+    supervisors = [asyncio.create_task(supervise_worker(i, secret, processes, stopping)) for i in range(WORKERS)]
+    queues = [asyncio.Queue(INGRESS_QUEUE_SIZE) for _ in range(WORKERS)]
+    print(f"✅ Routing updates to {WORKERS} workers")
+    
+    async with Bot(BOT_TOKEN) as bot, httpx.AsyncClient(timeout=HTTP_READ_TIMEOUT) as client:
+        forwarders = [asyncio.create_task(forward_updates(i, queue, client, secret)) for i, queue in enumerate(queues)]
+        await bot.delete_webhook()
+        offset = None
+        stop = asyncio.create_task(stopping.wait())
+        while not stopping.is_set():
+            poll = asyncio.create_task(bot.get_updates(
+                offset=offset,
+                timeout=INGRESS_POLL_TIMEOUT,
+                allowed_updates=ALLOWED_UPDATES
+            ))
+            await asyncio.wait({poll, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                print(f"Failed to fetch updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            handoffs = []
+            for update in updates:
+                chat = update.effective_chat
+                handed = loop.create_future()
+                await queues[(chat.id if chat else 0) % WORKERS].put((update.to_json(), handed))
+                handoffs.append((update.update_id, handed))
+            
+            # The next poll tells Telegram everything below its offset was
+            # received, so only move past updates a worker has accepted
+            batch = asyncio.gather(*(handed for _, handed in handoffs))
+            await asyncio.wait({batch, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if not batch.done():
+                await asyncio.wait({batch}, timeout=INGRESS_DRAIN_TIMEOUT)
+            for update_id, handed in handoffs:
+                if not handed.done():
+                    print(f"⚠️ {sum(not handed.done() for _, handed in handoffs)} updates were not handed to a worker, "
+                          f"Telegram will send them again")
+                    break
+                offset = update_id + 1
+        
+        # Tell Telegram the updates handed over so far were received
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+            except Exception:
+                pass
+        for task in forwarders + supervisors:
+            task.cancel()
+    
+    for process in processes.values():
+        if process.returncode is None:
+            process.terminate()
+    await asyncio.gather(*(process.wait() for process in processes.values()))
+
+# Prometheus endpoint for the metrics; METRICS_PORT=0 turns it off
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+METRICS_SERVER = None
+
+def gauge_samples():
+    """Point-in-time values read from the running components"""
+    yield "bank_update_queue_depth", "gauge", "Updates parked behind a busy chat", {}, UPDATE_PROCESSOR.queue_depth
+    yield "bank_active_chats", "gauge", "Chats with an update being processed", {}, UPDATE_PROCESSOR.active_chats
+    for priority, seconds in RATE_LIMITER.throttled_seconds.items():
+        yield "bank_rate_limit_throttled_seconds_total", "counter", "Time requests waited for a rate limit token", {"priority": priority}, seconds
+    yield "bank_rate_limit_retry_after_total", "counter", "RetryAfter responses from Telegram", {}, RATE_LIMITER.retry_afters
+    mirror = getattr(STORAGE, "mirror", None)
+    if mirror is not None:
+        yield "bank_sheet_mirror_pending", "gauge", "Accounts waiting to be flushed to the sheet", {}, len(mirror.dirty)
+    yield "bank_loaded_banks", "gauge", "Banks besides the default one with storage loaded", {}, len(BANKS.loaded)
+    for milestone, seconds in STARTUP_TIMINGS.items():
+        yield "bank_startup_seconds", "gauge", "Seconds from start to each startup milestone", {"milestone": milestone}, seconds
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in labels.items()}
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{format_labels(labels)} {value}" for name, labels, value in metric.samples())
+    described = set()
+    for name, kind, help_text, labels, value in gauge_samples():
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(method, headers, body):
+    if method != "GET":
+        return 405, "text/plain", b"Method Not Allowed"
+    return 200, "text/plain; version=0.0.4", render_metrics().encode()
+
+async def start_metrics_server():
+    global METRICS_SERVER
+    if METRICS_PORT:
+        METRICS_SERVER = await start_http_server(METRICS_LISTEN, METRICS_PORT, {"/metrics": handle_metrics})
+
+async def stop_metrics_server():
+    if METRICS_SERVER:
+        METRICS_SERVER.close()
+        await METRICS_SERVER.wait_closed()
+
+class MeteredRequest(BaseRequest):
+    """Wraps the Bot API HTTP client to time requests and count their bytes"""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit("/", 1)[-1]
+        if request_data is not None:
+            TELEGRAM_BYTES.inc("sent", amount=len(request_data.json_payload))
+        started = time.perf_counter()
+        try:
+            status, body = await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception:
+            TELEGRAM_ERRORS.inc(endpoint)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, endpoint)
+        TELEGRAM_BYTES.inc("received", amount=len(body))
+        if status >= 400:
+            TELEGRAM_ERRORS.inc(endpoint)
+        return status, body
+
+def build_application(request=None):
+    """Create the application and register every handler.
+
+    request replaces the HTTP client used for Bot API calls, e.g. with the
+    fake Bot API in bench.py.
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UPDATE_PROCESSOR)
+        .rate_limiter(RATE_LIMITER)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    # Bot API calls are timed and counted on their way to the HTTP client
+    builder = builder.request(MeteredRequest(request or HTTPXRequest(connection_pool_size=256)))
+    application = builder.build()
+    
+    # Add handlers, each timed under its command name
+    commands = {
+        "setlog": setlog,
+        "connect": connect,
+        "infobank": infobank,
+        "co": co,
+        "prom": prom,
+        "dem": dem,
+        "new": new,
+        "add": add,
+        "use": use,
+        "reset": reset,
+        "bal": bal,
+        "stats": stats,
+    }
+    for command, callback in commands.items():
+        application.add_handler(CommandHandler(command, metered(command, in_bank(callback))))
+    application.add_handler(CallbackQueryHandler(metered(callback_branch, in_bank(button_callback))))
+    
+    # Add handler for left chat members
+    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, metered("left_member", in_bank(handle_left_member))))
+    return application
+
+def main():
+    """Load settings, build the bot and serve updates until stopped"""
+    global STORAGE, WORKER_STATE
+    if BOT_MODE == "workers":
+        asyncio.run(run_ingress())
+        return
+    
+    load_settings()
+    if BOT_MODE == "worker":
+        if STORAGE_BACKEND != "sqlite":
+            raise ValueError("Worker mode shares state through SQLite, set STORAGE_BACKEND=sqlite")
+        WORKER_STATE = WorkerState(WORKER_DB_PATH)
+        WORKER_STATE.open()
+    STORAGE = create_storage()
+    application = build_application()
+    
+    print(f"✅ River Bank worker {WORKER_INDEX} is running!" if WORKER_STATE else "✅ River Bank is running!")
+    if BOT_MODE in ("webhook", "worker"):
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+if __name__ == "__main__":
+    main()
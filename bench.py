@@ -0,0 +1,390 @@
+# bench.py
+"""Offline benchmark for River Bank.
+
+Drives bal, add, use, new, infobank and button callbacks through the real
+handlers, update processor and rate limiter, against an in-memory
+worksheet with simulated latency and quota and a local fake Bot API. No
+network access or credentials are needed.
+
+    python bench.py --requests 2000 --concurrency 16 --backend sqlite
+
+Reports throughput plus p50/p95/p99 latency per command.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import gspread
+from telegram import Update
+from telegram.request import BaseRequest
+
+HEADER = ["User ID", "Name", "Username", "Link", "Balance", "Created", "Last Transaction"]
+BOT_USER = {"id": 999000, "is_bot": True, "first_name": "River Bank", "username": "river_bank_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+CHAT_BASE = -1001000000000
+USER_BASE = 5000000
+NEW_USER_BASE = 9000000
+
+# Share of each command in the generated workload
+WORKLOAD = {
+    "bal": 35,
+    "add": 20,
+    "use": 15,
+    "new": 5,
+    "infobank": 5,
+    "history": 10,
+    "data_list": 5,
+    "data_page": 5,
+}
+
+class QuotaResponse:
+    """Just enough of a requests.Response for gspread's APIError"""
+    status_code = 429
+    text = "Quota exceeded"
+
+    def json(self):
+        return {"error": {"code": 429, "message": "Quota exceeded for quota metric 'Requests'", "status": "RESOURCE_EXHAUSTED"}}
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def batch_update(self, body):
+        self.worksheet.call("write")
+        with self.worksheet.lock:
+            for request in body["requests"]:
+                span = request["deleteDimension"]["range"]
+                del self.worksheet.data[span["startIndex"]:span["endIndex"]]
+
+class FakeWorksheet:
+    """In-memory stand-in for a gspread Worksheet.
+
+    Every call sleeps for the configured latency and counts against a
+    per-minute read or write quota; calls over quota raise the same
+    APIError (429) as Google does.
+    """
+
+    id = 0
+    title = "Sheet1"
+
+    def __init__(self, rows, latency, quota):
+        self.data = [list(row) for row in rows]
+        self.latency = latency
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.windows = {"read": [], "write": []}
+        self.calls = {"read": 0, "write": 0, "throttled": 0}
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def call(self, kind):
+        time.sleep(self.latency)
+        with self.lock:
+            now = time.monotonic()
+            window = self.windows[kind] = [started for started in self.windows[kind] if now - started < 60]
+            if self.quota and len(window) >= self.quota:
+                self.calls["throttled"] += 1
+                raise gspread.exceptions.APIError(QuotaResponse())
+            window.append(now)
+            self.calls[kind] += 1
+
+    def set_range(self, a1, values):
+        row, col = gspread.utils.a1_to_rowcol(a1.split("!")[-1].split(":")[0])
+        for i, row_values in enumerate(values):
+            while len(self.data) < row + i:
+                self.data.append([])
+            target = self.data[row - 1 + i]
+            for j, value in enumerate(row_values):
+                while len(target) < col + j:
+                    target.append("")
+                target[col - 1 + j] = str(value)
+
+    def col_values(self, col):
+        self.call("read")
+        with self.lock:
+            return [row[col - 1] if len(row) >= col else "" for row in self.data]
+
+    def get_all_values(self):
+        self.call("read")
+        with self.lock:
+            return [list(row) for row in self.data]
+
+    def row_values(self, row):
+        self.call("read")
+        with self.lock:
+            return list(self.data[row - 1]) if row <= len(self.data) else []
+
+    def get(self, a1):
+        self.call("read")
+        first, last = a1.split(":")
+        first_row, _ = gspread.utils.a1_to_rowcol(first)
+        last_row, _ = gspread.utils.a1_to_rowcol(last)
+        with self.lock:
+            return [list(row) for row in self.data[first_row - 1:last_row]]
+
+    def batch_update(self, data, value_input_option=None):
+        self.call("write")
+        with self.lock:
+            for update in data:
+                self.set_range(update["range"], update["values"])
+
+    def append_rows(self, rows, value_input_option=None):
+        self.call("write")
+        with self.lock:
+            start = len(self.data) + 1
+            self.data.extend([str(value) for value in row] for row in rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{start}:G{start + len(rows) - 1}"}}
+
+    def append_row(self, row, value_input_option=None):
+        return self.append_rows([row], value_input_option)
+
+    def delete_rows(self, row):
+        self.call("write")
+        with self.lock:
+            del self.data[row - 1]
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API requests locally after a simulated round trip"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def result(self, endpoint, parameters):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(parameters.get("chat_id", CHAT_BASE))
+            return {
+                "message_id": int(parameters.get("message_id", 0)) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": BOT_USER,
+                "text": parameters.get("text", ""),
+            }
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = {}
+        if request_data is not None:
+            parameters = {key: json.loads(value) if value[:1] in "[{\"" else value
+                          for key, value in request_data.json_parameters.items()}
+            self.bytes_sent += len(request_data.json_payload)
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        await asyncio.sleep(self.latency)
+        body = json.dumps({"ok": True, "result": self.result(endpoint, parameters)}).encode()
+        self.bytes_received += len(body)
+        return 200, body
+
+def seed_rows(accounts):
+    rows = [HEADER]
+    for i in range(accounts):
+        user_id = USER_BASE + i
+        rows.append([str(user_id), f"User {i}", f"@user{i}", f'<a href="tg://user?id={user_id}">User {i}</a>',
+                     "1000000", "01-01-2025, 12:00 PM", ""])
+    return rows
+
+def user(user_id, name="User"):
+    return {"id": user_id, "is_bot": False, "first_name": name}
+
+class Workload:
+    """Builds Update objects for the benchmark commands"""
+
+    def __init__(self, bot, owner_id, accounts, seed):
+        self.bot = bot
+        self.owner_id = owner_id
+        self.accounts = accounts
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000000)
+        self.new_users = itertools.count(NEW_USER_BASE)
+
+    def account_holder(self):
+        return USER_BASE + self.random.randrange(self.accounts)
+
+    def message(self, chat_id, sender, text, reply_to=None):
+        command = text.split()[0]
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": sender,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }
+        if reply_to is not None:
+            message["reply_to_message"] = {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": message["chat"],
+                "from": user(reply_to),
+                "text": "hi",
+            }
+        return Update.de_json({"update_id": next(self.update_ids), "message": message}, self.bot)
+
+    def callback(self, chat_id, sender_id, data):
+        query = {
+            "id": str(next(self.update_ids)),
+            "from": user(sender_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": BOT_USER,
+                "text": "bench",
+            },
+        }
+        return Update.de_json({"update_id": next(self.update_ids), "callback_query": query}, self.bot)
+
+    def make(self, command, chat_id):
+        owner = user(self.owner_id, "Owner")
+        if command == "bal":
+            return self.message(chat_id, user(self.account_holder()), "/bal")
+        if command == "add":
+            return self.message(chat_id, owner, f"/add {self.random.randint(1, 500)}", self.account_holder())
+        if command == "use":
+            return self.message(chat_id, owner, f"/use {self.random.randint(1, 100)}", self.account_holder())
+        if command == "new":
+            return self.message(chat_id, owner, "/new", next(self.new_users))
+        if command == "infobank":
+            return self.message(chat_id, owner, "/infobank")
+        if command == "history":
+            return self.callback(chat_id, self.owner_id, f"history_{self.account_holder()}_{self.owner_id}")
+        if command == "data_list":
+            return self.callback(chat_id, self.owner_id, f"data_list_{self.owner_id}")
+        offset = self.random.randrange(0, max(self.accounts, 1), 25)
+        return self.callback(chat_id, self.owner_id, f"data_page_{offset}_{self.owner_id}")
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def report(latencies, elapsed, worksheet, bot_api):
+    total = sum(len(values) for values in latencies.values())
+    print(f"\n{total} updates in {elapsed:.2f}s — {total / elapsed:.1f} updates/s\n")
+    print(f"{'command':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    everything = []
+    for command in WORKLOAD:
+        ordered = sorted(latencies.get(command, []))
+        everything += ordered
+        if ordered:
+            print(f"{command:<12}{len(ordered):>8}{percentile(ordered, 50) * 1000:>10.1f}"
+                  f"{percentile(ordered, 95) * 1000:>10.1f}{percentile(ordered, 99) * 1000:>10.1f}"
+                  f"{ordered[-1] * 1000:>10.1f}")
+    everything.sort()
+    print(f"{'all':<12}{len(everything):>8}{percentile(everything, 50) * 1000:>10.1f}"
+          f"{percentile(everything, 95) * 1000:>10.1f}{percentile(everything, 99) * 1000:>10.1f}"
+          f"{everything[-1] * 1000 if everything else 0:>10.1f}")
+    print(f"\nSheets calls: {worksheet.calls['read']} reads, {worksheet.calls['write']} writes, "
+          f"{worksheet.calls['throttled']} over quota")
+    calls = ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(bot_api.calls.items()))
+    print(f"Bot API calls: {calls}")
+    print(f"Bot API bytes: {bot_api.bytes_sent} sent, {bot_api.bytes_received} received")
+
+async def run(args, bank_bot):
+    worksheet = FakeWorksheet(seed_rows(args.accounts), args.sheets_latency, args.sheets_quota)
+    bot_api = FakeBotAPI(args.api_latency)
+    bank_bot.open_sheet = lambda: worksheet
+    bank_bot.BOT_TOKEN = "123456:BENCHMARK"
+    bank_bot.LOG_CHANNEL = CHAT_BASE - 1
+    bank_bot.STORAGE = bank_bot.create_storage()
+    if not args.rate_limits:
+        # The fake API has no flood control, so only measure the limiter's overhead
+        bank_bot.RATE_LIMIT_PRIVATE = bank_bot.RATE_LIMIT_GROUP = 10 ** 9
+        bank_bot.RATE_LIMITER.global_bucket = bank_bot.TokenBucket(10 ** 9, 10 ** 9)
+
+    application = bank_bot.build_application(request=bot_api)
+    await application.initialize()
+    await bank_bot.post_init(application)
+    await application.start()
+    await bank_bot.STORAGE_READY.wait()
+
+    workload = Workload(application.bot, bank_bot.OWNER_ID, args.accounts, args.seed)
+    commands = list(WORKLOAD)
+    weights = [WORKLOAD[command] for command in commands]
+    schedule = workload.random.choices(commands, weights, k=args.requests)
+    latencies = {}
+    remaining = iter(schedule)
+
+    async def worker(index):
+        chat_id = CHAT_BASE - 100 - index
+        for command in remaining:
+            update = workload.make(command, chat_id)
+            started = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.setdefault(command, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    await bank_bot.post_stop(application)
+    await application.shutdown()
+    await bank_bot.post_shutdown(application)
+    report(latencies, elapsed, worksheet, bot_api)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline River Bank benchmark")
+    parser.add_argument("--requests", type=int, default=1000, help="updates to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="chats sending updates at once")
+    parser.add_argument("--accounts", type=int, default=500, help="accounts seeded in the sheet")
+    parser.add_argument("--backend", choices=("sqlite", "sheets"), default="sqlite")
+    parser.add_argument("--write-behind", action="store_true", help="write-behind mode for the sheets backend")
+    parser.add_argument("--sheets-latency", type=float, default=0.1, help="seconds per Sheets call")
+    parser.add_argument("--sheets-quota", type=int, default=0, help="Sheets reads and writes per minute each, 0 for unlimited")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument("--rate-limits", action="store_true", help="keep Telegram's real rate limits")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # Everything the bot writes goes to a scratch directory
+    workdir = tempfile.mkdtemp(prefix="river-bank-bench-")
+    os.environ.update({
+        "STORAGE_BACKEND": args.backend,
+        "WRITE_BEHIND": "1" if args.write_behind else "0",
+        "SQLITE_PATH": os.path.join(workdir, "bank.db"),
+        "JOURNAL_PATH": os.path.join(workdir, "transactions.jsonl"),
+        "SNAPSHOT_PATH": os.path.join(workdir, "accounts.snapshot"),
+        "PENDING_DELETES_PATH": os.path.join(workdir, "pending_deletes.json"),
+        "METRICS_PORT": "0",
+        # The quota governor follows the fake worksheet's quota
+        "SHEETS_READS_PER_MINUTE": str(args.sheets_quota or 10 ** 6),
+        "SHEETS_WRITES_PER_MINUTE": str(args.sheets_quota or 10 ** 6),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bank_bot
+
+    print(f"Benchmarking {args.backend}{' (write-behind)' if args.write_behind else ''}: "
+          f"{args.requests} updates, {args.concurrency} chats, {args.accounts} accounts, "
+          f"Sheets {args.sheets_latency * 1000:.0f}ms, Bot API {args.api_latency * 1000:.0f}ms")
+    asyncio.run(run(args, bank_bot))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import importlib.util
+import os
+import types
+
+import gspread
+import pytest
+
+BANK_BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bank_bot.py")
+
+class FakeWorksheet:
+    """In-memory stand-in for a gspread worksheet, covering the calls the bot makes"""
+
+    id = 0
+    title = "Sheet1"
+
+    def __init__(self, rows=()):
+        self.data = [["User ID", "Name", "Username", "Link", "Balance", "Created", "Last Transaction"]]
+        self.data += [list(row) for row in rows]
+        self.calls = []  # names of the methods called, in order
+
+    def get_all_values(self):
+        self.calls.append("get_all_values")
+        return [list(map(str, row)) for row in self.data]
+
+    def col_values(self, col):
+        self.calls.append("col_values")
+        return [row[col - 1] if len(row) >= col else "" for row in self.data]
+
+    def row_values(self, row):
+        self.calls.append("row_values")
+        # Like the API, a row past the end reads as empty
+        return list(map(str, self.data[row - 1])) if row <= len(self.data) else []
+
+    def get(self, a1):
+        self.calls.append("get")
+        first, _, last = a1.partition(":")
+        first_row, _ = gspread.utils.a1_to_rowcol(first)
+        last_row, _ = gspread.utils.a1_to_rowcol(last or first)
+        return [list(map(str, row)) for row in self.data[first_row - 1:last_row]]
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls.append("batch_update")
+        for update in data:
+            first_row, first_col = gspread.utils.a1_to_rowcol(update["range"].split("!")[-1].split(":")[0])
+            for i, values in enumerate(update["values"]):
+                row = self.data[first_row - 1 + i]
+                for j, value in enumerate(values):
+                    row += [""] * (first_col + j - len(row))
+                    row[first_col - 1 + j] = value
+
+    def append_rows(self, rows, value_input_option=None):
+        self.calls.append("append_rows")
+        start = len(self.data) + 1
+        self.data += [list(map(str, row)) for row in rows]
+        return {"updates": {"updatedRange": f"{self.title}!A{start}:G{start + len(rows) - 1}"}}
+
+    def append_row(self, row, value_input_option=None):
+        return self.append_rows([row], value_input_option)
+
+    def delete_rows(self, row):
+        self.calls.append("delete_rows")
+        del self.data[row - 1]
+
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    """Import a fresh copy of bank_bot against a fake worksheet, with every local file in tmp_path"""
+    
+    def load(worksheet=None, **env):
+        worksheet = worksheet or FakeWorksheet()
+        monkeypatch.chdir(tmp_path)
+        env = dict({
+            "SHEETS_READS_PER_MINUTE": "100000",
+            "SHEETS_WRITES_PER_MINUTE": "100000",
+            "SQLITE_PATH": str(tmp_path / "bank.db"),
+            "JOURNAL_PATH": str(tmp_path / "transactions.jsonl"),
+        }, **env)
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location("bank_bot", BANK_BOT_PATH)
+        bot = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bot)
+        bot.sheet = worksheet
+        bot.SHEET_CONNECTED.set()
+        return bot
+    
+    return load
+
+class FakeMessage:
+    def __init__(self, chat_id=1, message_id=1):
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.message_id = message_id
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(self.chat.id)
+
+def fake_command(args, user_id=1):
+    """(update, context) for a command sent by user_id with the given arguments"""
+    user = types.SimpleNamespace(id=user_id, first_name="Owner", username="owner")
+    update = types.SimpleNamespace(
+        effective_user=user,
+        effective_chat=types.SimpleNamespace(id=-1),
+        message=FakeMessage(),
+        callback_query=None,
+    )
+    return update, types.SimpleNamespace(args=args, bot=None)
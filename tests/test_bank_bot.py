@@ -0,0 +1,1088 @@
+import asyncio
+import functools
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime
+
+import gspread
+import pytest
+import telegram
+
+from conftest import FakeWorksheet, fake_command
+
+def accounts(count, balance=10):
+    return [[str(1000 + i), f"User {i}", f"@user{i}", "link", str(balance), "created", ""] for i in range(1, count + 1)]
+
+async def start_bank(bot):
+    bot.STORAGE = bot.create_storage()
+    await bot.start_storage(None)
+    assert bot.STORAGE_READY.is_set()
+    return bot.STORAGE
+
+# Startup
+
+def test_handlers_wait_until_storage_is_ready(load_bot):
+    worksheet = FakeWorksheet(accounts(2))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="0")
+    # Importing the bot touches neither Sheets nor Telegram
+    assert worksheet.calls == [] and bot.STORAGE is None
+    
+    async def main():
+        waiting = asyncio.create_task(bot.get_all_accounts())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await start_bank(bot)
+        assert [account["user_id"] for account in await waiting] == ["1001", "1002"]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+def test_handlers_give_up_on_a_bank_that_is_not_ready(load_bot):
+    bot = load_bot(STORAGE_READY_TIMEOUT="0.05")
+    
+    @bot.in_bank
+    async def show_balance(update, context):
+        await bot.get_all_accounts()
+        await update.message.reply_text("balance")
+    
+    async def main():
+        update, context = fake_command([])
+        await show_balance(update, context)
+        return update.message.replies
+    
+    assert asyncio.run(main()) == ["⏳ The bank is not ready yet, please try again in a moment."]
+
+# Write-behind mode
+
+def test_write_behind_coalesces_balance_writes(load_bot):
+    worksheet = FakeWorksheet(accounts(3))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="1")
+    
+    async def main():
+        storage = await start_bank(bot)
+        for balance in (20, 30, 40):
+            assert await storage.set_balance(1001, balance, "now")
+        assert await storage.set_balance(1003, 5, "later")
+        assert not await storage.set_balance(9999, 5, "later")
+        # Served from local state before anything reached the sheet
+        assert (await storage.get(1001))["balance"] == 40.0
+        assert "batch_update" not in worksheet.calls
+        
+        assert await storage.mirror.flush()
+        # One RAW write for the rows and one parsed write for their balance cells
+        assert worksheet.calls.count("batch_update") == 2
+        assert [row[4] for row in worksheet.data[1:]] == ["40.0", "10", "5.0"]
+        assert not storage.mirror.dirty
+        await storage.stop()
+    
+    asyncio.run(main())
+
+class RecordingWorksheet(FakeWorksheet):
+    def __init__(self, rows=()):
+        super().__init__(rows)
+        self.writes = []  # (value_input_option, cells written)
+
+    def batch_update(self, data, value_input_option=None):
+        self.writes.append((value_input_option, [update["range"] for update in data]))
+        super().batch_update(data, value_input_option)
+
+    def append_rows(self, rows, value_input_option=None):
+        self.writes.append((value_input_option, [row[0] for row in rows]))
+        return super().append_rows(rows, value_input_option)
+
+def test_write_behind_writes_names_raw(load_bot):
+    worksheet = RecordingWorksheet(accounts(1))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="1")
+    raw, parsed = gspread.utils.ValueInputOption.raw, gspread.utils.ValueInputOption.user_entered
+    
+    async def main():
+        storage = await start_bank(bot)
+        assert await storage.create(2000, "=IMPORTXML(1)", "", "link")
+        assert await storage.set_balance(1001, 20, "now")
+        assert await storage.mirror.flush()
+        await storage.stop()
+    
+    asyncio.run(main())
+    assert worksheet.writes == [
+        (raw, ["A2:G2"]),
+        (raw, ["2000"]),
+        (parsed, ["E2", "G2", "E3", "G3"]),
+    ]
+    assert worksheet.data[2][1] == "=IMPORTXML(1)"
+
+def test_write_behind_keeps_accounts_dirty_after_a_failed_flush(load_bot):
+    worksheet = FakeWorksheet(accounts(2))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="1")
+    
+    def fail(*args, **kwargs):
+        raise ConnectionError("quota")
+    
+    async def main():
+        storage = await start_bank(bot)
+        assert await storage.set_balance(1002, 7, "now")
+        worksheet.batch_update, working = fail, worksheet.batch_update
+        assert not await storage.mirror.flush()
+        assert storage.mirror.dirty == {"1002"}
+        
+        worksheet.batch_update = working
+        assert await storage.mirror.flush()
+        assert worksheet.data[2][4] == "7.0"
+        await storage.stop()
+    
+    asyncio.run(main())
+
+def test_shared_lock_lets_readers_overlap_and_a_waiting_writer_go_first(load_bot):
+    bot = load_bot()
+    events = []
+    
+    async def hold(lock, name, seconds):
+        async with lock:
+            events.append(("start", name))
+            await asyncio.sleep(seconds)
+            events.append(("end", name))
+    
+    async def main():
+        rows_lock = bot.SharedLock()
+        first = asyncio.create_task(hold(rows_lock.shared(), "shared1", 0.05))
+        second = asyncio.create_task(hold(rows_lock.shared(), "shared2", 0.05))
+        await asyncio.sleep(0.01)
+        writer = asyncio.create_task(hold(rows_lock.exclusive(), "exclusive", 0.05))
+        await asyncio.sleep(0.01)
+        # Arrives while the writer waits, so it runs after the writer
+        late = asyncio.create_task(hold(rows_lock.shared(), "shared3", 0))
+        await asyncio.gather(first, second, writer, late)
+    
+    asyncio.run(main())
+    assert events[:2] == [("start", "shared1"), ("start", "shared2")]
+    assert events[4:] == [("start", "exclusive"), ("end", "exclusive"), ("start", "shared3"), ("end", "shared3")]
+
+# Transaction journal
+
+def test_journal_replays_history_and_totals_after_restart(load_bot, tmp_path):
+    bot = load_bot()
+    path = str(tmp_path / "journal.jsonl")
+    journal = bot.TransactionJournal(path)
+    journal.open()
+    for amount in range(1, 6):
+        journal.append(1, bot.make_transaction(amount, 7, "Admin"))
+    journal.append(2, bot.make_transaction(50, 7, "Admin", "used"))
+    journal.clear(2)
+    journal.append(2, bot.make_transaction(3, 8, "Other"))
+    journal.close()
+    
+    journal = bot.TransactionJournal(path)
+    journal.open()
+    assert journal.count(1) == 5
+    assert [entry["amount"] for entry in journal.page(1, 0, 2)] == [5, 4]
+    assert [entry["amount"] for entry in journal.page(1, 4, 10)] == [1]
+    assert [entry["amount"] for entry in journal.page(2)] == [3]
+    assert journal.executor_totals(1) == [
+        {"executor_id": 7, "type": "added", "executor_name": "Admin", "amount": 15.0, "count": 5}]
+    journal.close()
+
+def test_journal_recovers_index_after_crash(load_bot, tmp_path):
+    bot = load_bot(JOURNAL_INDEX_INTERVAL="4")
+    path = str(tmp_path / "journal.jsonl")
+    journal = bot.TransactionJournal(path)
+    journal.open()
+    for amount in range(10):
+        journal.append(amount % 2, bot.make_transaction(amount, 7, "Admin"))
+    # The index was saved along the way, but not for the last entries
+    assert json.load(open(path + ".idx"))["size"] < os.path.getsize(path)
+    # Crash in the middle of an append: no close, a torn line at the end
+    journal.writer.write(b'{"user_id": "0", "ty')
+    journal.writer.flush()
+    journal.writer.close()
+    journal.reader.close()
+    
+    journal = bot.TransactionJournal(path)
+    journal.open()
+    assert (journal.count(0), journal.count(1)) == (5, 5)
+    assert [entry["amount"] for entry in journal.page(1, 0, 2)] == [9, 7]
+    journal.append(0, bot.make_transaction(100, 7, "Admin"))
+    assert [entry["amount"] for entry in journal.page(0, 0, 2)] == [100, 8]
+    journal.close()
+    with open(path, "rb") as f:
+        assert all(line.endswith(b"\n") for line in f)
+    
+    # An index that does not match the journal is rebuilt from scratch
+    with open(path + ".idx", "w") as f:
+        json.dump({"size": os.path.getsize(path) + 1, "offsets": {}, "totals": {}}, f)
+    journal = bot.TransactionJournal(path)
+    journal.open()
+    assert (journal.count(0), journal.count(1)) == (6, 5)
+    journal.close()
+
+def test_journal_runs_on_its_own_thread(load_bot, tmp_path):
+    bot = load_bot()
+    journal = bot.TransactionJournal(str(tmp_path / "journal.jsonl"))
+    
+    async def main():
+        await journal.run(journal.open)
+        await journal.run(journal.write, [dict(bot.make_transaction(5, 7, "Admin"), user_id="1")])
+        assert await journal.run(journal.count, 1) == 1
+        await journal.run(journal.close)
+    
+    asyncio.run(main())
+    journal.executor.shutdown()
+
+# Running totals
+
+class StaleReadWorksheet(FakeWorksheet):
+    """Returns a row as it was when the read started, after a delay"""
+
+    def row_values(self, row):
+        values = super().row_values(row)
+        time.sleep(0.1)
+        return values
+
+def test_a_read_does_not_undo_a_balance_written_meanwhile(load_bot):
+    worksheet = StaleReadWorksheet(accounts(1))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="0")
+    
+    async def main():
+        storage = await start_bank(bot)
+        reading = asyncio.create_task(storage.get(1001))
+        await asyncio.sleep(0.02)
+        assert await storage.set_balance(1001, 50, "now")
+        assert (await reading)["balance"] == 10.0
+        assert await storage.totals() == (1, 50.0)
+        assert storage.balances["1001"] == 50.0
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+# Data list paging
+
+@pytest.mark.parametrize("backend, write_behind", [("sheets", "0"), ("sheets", "1"), ("sqlite", "0")])
+def test_account_pages_are_newest_first(load_bot, backend, write_behind):
+    worksheet = FakeWorksheet(accounts(7))
+    bot = load_bot(worksheet, STORAGE_BACKEND=backend, WRITE_BEHIND=write_behind)
+    
+    async def main():
+        storage = await start_bank(bot)
+        pages = [[account["user_id"] for account in await storage.account_page(offset, 3)] for offset in (0, 3, 6, 9)]
+        assert pages == [["1007", "1006", "1005"], ["1004", "1003", "1002"], ["1001"], []]
+        await storage.stop()
+    
+    asyncio.run(main())
+
+def test_row_index_follows_deletes(load_bot):
+    worksheet = FakeWorksheet(accounts(5))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="0")
+    
+    async def main():
+        storage = await start_bank(bot)
+        assert await storage.delete(1002)
+        assert await storage.create(2000, "New", "", "link")
+        assert await storage.delete(1004)
+        
+        expected = {row[0]: number for number, row in enumerate(worksheet.data[1:], 2)}
+        assert storage.rows == expected
+        assert storage.row_order == sorted(expected.values())
+        
+        # Writes below a deleted row land on the shifted row
+        assert await storage.set_balance(1005, 42, "now")
+        assert worksheet.data[expected["1005"] - 1][4] == "42"
+        
+        page = await storage.account_page(1, 2)
+        assert [account["user_id"] for account in page] == ["1005", "1003"]
+        assert await storage.totals() == (4, 62.0)
+        await storage.stop()
+    
+    asyncio.run(main())
+
+# Scheduled deletions
+
+class FakeBot:
+    def __init__(self, hang=False):
+        self.hang = hang
+        self.deleted = []
+    
+    async def delete_messages(self, chat_id, message_ids):
+        if self.hang:
+            await asyncio.sleep(60)
+        self.deleted.append((chat_id, list(message_ids)))
+
+def test_pending_deletions_survive_a_restart(load_bot, tmp_path):
+    bot = load_bot()
+    path = str(tmp_path / "pending.json")
+    
+    async def first_run():
+        scheduler = bot.DeletionScheduler(path)
+        await scheduler.start(FakeBot())
+        scheduler.schedule(1, 10, 60)
+        scheduler.schedule(1, 11, 60)
+        scheduler.schedule(2, 12, 0.05)
+        scheduler.schedule(2, 12, 60)  # rescheduled: the earlier due time no longer applies
+        scheduler.cancel(1, 11)
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+    
+    asyncio.run(first_run())
+    assert sorted(entry[1:] for entry in json.load(open(path))) == [[1, 10], [2, 12]]
+    
+    async def second_run():
+        scheduler = bot.DeletionScheduler(path)
+        fake = FakeBot()
+        await scheduler.start(fake)
+        assert sorted(scheduler.due) == [(1, 10), (2, 12)]
+        for key in list(scheduler.due):
+            scheduler.schedule(*key, 0)
+        await asyncio.sleep(bot.DELETE_BATCH_WINDOW + 0.1)
+        await scheduler.stop()
+        return fake.deleted
+    
+    assert sorted(asyncio.run(second_run())) == [(1, [10]), (2, [12])]
+    assert json.load(open(path)) == []
+
+def test_deletions_due_together_go_out_in_one_call_per_chat(load_bot, tmp_path):
+    bot = load_bot()
+    
+    async def main():
+        scheduler = bot.DeletionScheduler(str(tmp_path / "pending.json"))
+        fake = FakeBot()
+        await scheduler.start(fake)
+        for message_id in range(10, 15):
+            scheduler.schedule(1, message_id, 0)
+        scheduler.schedule(2, 20, bot.DELETE_BATCH_WINDOW / 2)
+        scheduler.schedule(2, 21, 60)
+        await asyncio.sleep(bot.DELETE_BATCH_WINDOW + 0.1)
+        await scheduler.stop()
+        return fake.deleted
+    
+    assert sorted(asyncio.run(main())) == [(1, [10, 11, 12, 13, 14]), (2, [20])]
+
+def test_unanswered_deletions_are_kept_on_stop(load_bot, tmp_path):
+    bot = load_bot()
+    bot.DELETE_STOP_TIMEOUT = 0.1
+    path = str(tmp_path / "pending.json")
+    
+    async def main():
+        scheduler = bot.DeletionScheduler(path)
+        await scheduler.start(FakeBot(hang=True))
+        scheduler.schedule(1, 10, 0)
+        scheduler.schedule(1, 11, 60)
+        await asyncio.sleep(bot.DELETE_BATCH_WINDOW + 0.1)
+        assert scheduler.inflight
+        await scheduler.stop()
+    
+    asyncio.run(main())
+    assert sorted(entry[1:] for entry in json.load(open(path))) == [[1, 10], [1, 11]]
+
+# Update processing
+
+def chat_update(update_id, chat_id):
+    chat = telegram.Chat(id=chat_id, type="private")
+    return telegram.Update(update_id, message=telegram.Message(update_id, datetime.now(), chat))
+
+def test_updates_run_in_order_per_chat_and_concurrently_across_chats(load_bot):
+    bot = load_bot()
+    processor = bot.ChatOrderedUpdateProcessor(8)
+    events = []
+    
+    async def handle(name, delay):
+        events.append(("start", name))
+        await asyncio.sleep(delay)
+        events.append(("end", name))
+    
+    async def main():
+        await asyncio.gather(
+            processor.process_update(chat_update(1, 100), handle("a1", 0.05)),
+            processor.process_update(chat_update(2, 100), handle("a2", 0)),
+            processor.process_update(chat_update(3, 100), handle("a3", 0)),
+            processor.process_update(chat_update(4, 200), handle("b1", 0)),
+        )
+    
+    asyncio.run(main())
+    order = [name for kind, name in events if kind == "start"]
+    # Chat 200 is not held up behind chat 100, whose updates run one after another in order
+    assert events.index(("start", "b1")) < events.index(("end", "a1"))
+    assert [name for name in order if name.startswith("a")] == ["a1", "a2", "a3"]
+    assert events.index(("end", "a1")) < events.index(("start", "a2"))
+    assert processor.peak_queued == 2
+    assert processor.queue_depth == 0 and processor.active_chats == 0
+
+# Log channel
+
+def test_split_log_text_packs_entries_within_the_limit(load_bot):
+    bot = load_bot()
+    assert bot.split_log_text(["a" * 4, "b" * 4, "c" * 4], limit=10) == ["aaaa\n\nbbbb", "cccc"]
+    # An oversized entry is cut at its line breaks
+    assert bot.split_log_text(["x" * 6 + "\n" + "y" * 6], limit=10) == ["x" * 6, "y" * 6]
+    assert all(len(chunk) <= 10 for chunk in bot.split_log_text(["z" * 25], limit=10))
+
+class FakeLogBot:
+    def __init__(self, flood_once=False, delay=0):
+        self.flood_once = flood_once
+        self.delay = delay
+        self.sent = []
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        if self.flood_once:
+            self.flood_once = False
+            raise telegram.error.RetryAfter(0)
+        self.sent.append((chat_id, text))
+
+def test_log_pipeline_sends_one_message_per_channel_per_batch(load_bot):
+    bot = load_bot()
+    bot.LOG_BATCH_WINDOW = 0.05
+    
+    async def main():
+        pipeline = bot.LogPipeline()
+        fake = FakeLogBot(flood_once=True)
+        await pipeline.start(fake)
+        pipeline.put(1, "first")
+        pipeline.put(2, "other")
+        pipeline.put(1, "second")
+        await asyncio.sleep(0.2)
+        pipeline.put(1, "later")
+        await pipeline.stop()
+        return fake.sent
+    
+    assert asyncio.run(main()) == [(1, "first\n\nsecond"), (2, "other"), (1, "later")]
+
+def test_log_pipeline_finishes_the_batch_in_flight_on_stop(load_bot):
+    bot = load_bot()
+    bot.LOG_BATCH_WINDOW = 0.05
+    
+    async def main():
+        pipeline = bot.LogPipeline()
+        fake = FakeLogBot(delay=0.2)
+        await pipeline.start(fake)
+        pipeline.put(1, "first")
+        await asyncio.sleep(0.1)
+        # The batch is being sent; stop waits for it instead of dropping it
+        await pipeline.stop()
+        return fake.sent
+    
+    assert asyncio.run(main()) == [(1, "first")]
+
+# Outbound rate limiting
+
+def test_rate_limiter_releases_waiting_requests_by_priority(load_bot):
+    bot = load_bot()
+    released = []
+    
+    def request(name):
+        async def callback():
+            released.append(name)
+            return name
+        return callback
+    
+    async def main():
+        limiter = bot.PriorityRateLimiter()
+        limiter.global_bucket = bot.TokenBucket(20, 1)
+        await limiter.initialize()
+        await limiter.process_request(request("first"), (), {}, "sendMessage", {"chat_id": -1}, None)
+        # The bucket is empty now: everything below has to wait its turn
+        waiting = [
+            limiter.process_request(request("delete"), (), {}, "deleteMessage", {"chat_id": -2}, None),
+            limiter.process_request(request("edit"), (), {}, "editMessageText", {"chat_id": -3}, None),
+            limiter.process_request(request("log"), (), {}, "sendMessage", {"chat_id": -4}, bot.PRIORITY_LOG),
+            limiter.process_request(request("reply"), (), {}, "sendMessage", {"chat_id": -5}, None),
+        ]
+        tasks = []
+        for coroutine in waiting:
+            tasks.append(asyncio.create_task(coroutine))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await limiter.shutdown()
+    
+    asyncio.run(main())
+    assert released == ["first", "reply", "edit", "log", "delete"]
+
+def test_rate_limiter_retries_after_flood_control(load_bot):
+    bot = load_bot()
+    attempts = []
+    
+    async def callback():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise telegram.error.RetryAfter(0.1)
+        return "sent"
+    
+    async def main():
+        limiter = bot.PriorityRateLimiter()
+        await limiter.initialize()
+        result = await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": -1}, None)
+        await limiter.shutdown()
+        return result, limiter.retry_afters
+    
+    assert asyncio.run(main()) == ("sent", 1)
+    assert attempts[1] - attempts[0] >= 0.09
+
+# Webhook mode
+
+UPDATE_JSON = json.dumps({
+    "update_id": 7,
+    "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "/bal"},
+}).encode()
+
+async def post(port, path, body, headers=(), method="POST", ssl_context=None):
+    """Send one HTTP request to the local server, return the status code"""
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", port, ssl=ssl_context, server_hostname="localhost" if ssl_context else None)
+    head = [f"{method} {path} HTTP/1.1", "Host: localhost", f"Content-Length: {len(body)}", *headers]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+def test_webhook_checks_method_secret_and_body_before_queueing(load_bot):
+    bot = load_bot(WEBHOOK_SECRET="s3cret")
+    secret = "X-Telegram-Bot-Api-Secret-Token: s3cret"
+    
+    async def main():
+        application = types.SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        server = await bot.start_http_server("127.0.0.1", 0, {
+            "/telegram": functools.partial(bot.handle_webhook, application),
+        })
+        port = server.sockets[0].getsockname()[1]
+        statuses = [
+            await post(port, "/telegram", b"", [secret], method="GET"),
+            await post(port, "/telegram", UPDATE_JSON, ["X-Telegram-Bot-Api-Secret-Token: wrong"]),
+            await post(port, "/telegram", UPDATE_JSON),
+            await post(port, "/telegram", b"{not json", [secret]),
+            await post(port, "/elsewhere", UPDATE_JSON, [secret]),
+            await post(port, "/telegram", UPDATE_JSON, [secret]),
+        ]
+        server.close()
+        await server.wait_closed()
+        queued = [application.update_queue.get_nowait() for _ in range(application.update_queue.qsize())]
+        return statuses, queued
+    
+    statuses, queued = asyncio.run(main())
+    assert statuses == [405, 403, 403, 400, 404, 200]
+    assert [update.update_id for update in queued] == [7]
+    assert queued[0].message.text == "/bal"
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+        self.calls = []
+
+    async def initialize(self):
+        self.calls.append("initialize")
+
+    async def start(self):
+        self.calls.append("start")
+
+    async def stop(self):
+        self.calls.append("stop")
+
+    async def shutdown(self):
+        self.calls.append("shutdown")
+
+    def stop_running(self):
+        raise AssertionError("stop_running only applies to run_polling")
+
+def test_webhook_server_exits_when_storage_fails_to_start(load_bot):
+    bot = load_bot(BOT_MODE="webhook", WEBHOOK_SECRET="s3cret", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT="0", METRICS_PORT="0")
+    
+    async def fail():
+        raise OSError("disk full")
+    bot.STORAGE = types.SimpleNamespace(start=fail)
+    bot.open_sheet = lambda: bot.sheet
+    application = FakeApplication()
+    
+    async def main():
+        await asyncio.wait_for(bot.run_webhook(application), 5)
+    
+    asyncio.run(main())
+    assert application.calls == ["initialize", "start", "stop", "shutdown"]
+    assert not bot.STORAGE_READY.is_set()
+    assert bot.WEBHOOK_STOPPING is None
+
+def test_webhook_refuses_plain_http_urls_and_half_tls_settings(load_bot):
+    bot = load_bot(WEBHOOK_SECRET="s3cret", WEBHOOK_URL="http://bank.example/telegram")
+    with pytest.raises(ValueError, match="https://"):
+        asyncio.run(bot.run_webhook(FakeApplication()))
+    
+    bot = load_bot(WEBHOOK_SECRET="s3cret", WEBHOOK_CERT="cert.pem")
+    with pytest.raises(ValueError, match="together"):
+        bot.webhook_ssl_context()
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs the openssl command to make a certificate")
+def test_webhook_serves_https_with_a_certificate(load_bot, tmp_path):
+    cert, key = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost", "-keyout", key, "-out", cert], check=True, capture_output=True)
+    bot = load_bot(WEBHOOK_SECRET="s3cret", WEBHOOK_CERT=cert, WEBHOOK_KEY=key)
+    
+    async def main():
+        application = FakeApplication()
+        server = await bot.start_http_server("127.0.0.1", 0, {
+            "/telegram": functools.partial(bot.handle_webhook, application),
+        }, bot.webhook_ssl_context())
+        port = server.sockets[0].getsockname()[1]
+        client = ssl.create_default_context(cafile=cert)
+        status = await post(port, "/telegram", UPDATE_JSON, ["X-Telegram-Bot-Api-Secret-Token: s3cret"], ssl_context=client)
+        server.close()
+        await server.wait_closed()
+        return status, application.update_queue.qsize()
+    
+    assert asyncio.run(main()) == (200, 1)
+
+# Write-behind snapshot
+
+def test_snapshot_round_trip_and_crc_rejection(load_bot, tmp_path):
+    bot = load_bot()
+    path = str(tmp_path / "accounts.snapshot")
+    saved = [dict(bot.new_account(1000 + i, f"User {i}", "", "link"), balance=float(i)) for i in range(3)]
+    bot.save_snapshot(path, saved, {"1001"})
+    loaded, dirty, checksum = bot.load_snapshot(path)
+    assert loaded == saved
+    assert dirty == {"1001"}
+    assert checksum == bot.accounts_checksum(saved)
+    
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    data[-1] ^= 0xFF
+    with open(path, "wb") as f:
+        f.write(data)
+    assert bot.load_snapshot(path) is None
+
+def test_corrupt_snapshot_falls_back_to_the_sheet(load_bot):
+    worksheet = FakeWorksheet(accounts(2))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="1")
+    bot.save_snapshot(bot.SNAPSHOT_PATH, [dict(bot.new_account(9999, "Stale", "", "link"), balance=1.0)], set())
+    with open(bot.SNAPSHOT_PATH, "rb") as f:
+        data = bytearray(f.read())
+    data[bot.SNAPSHOT_HEADER.size] ^= 0xFF
+    with open(bot.SNAPSHOT_PATH, "wb") as f:
+        f.write(data)
+    
+    async def main():
+        storage = await start_bank(bot)
+        assert sorted(account["user_id"] for account in await storage.all()) == ["1001", "1002"]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+# Benchmark
+
+@pytest.mark.parametrize("backend", ["sqlite", "sheets"])
+def test_benchmark_runs_offline(backend, tmp_path):
+    bench = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench.py")
+    result = subprocess.run(
+        [sys.executable, bench, "--requests", "40", "--concurrency", "4", "--accounts", "20",
+         "--backend", backend, "--sheets-latency", "0", "--api-latency", "0"],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Sheets calls:" in result.stdout
+
+# Sheets quota governor
+
+class SlowWorksheet(FakeWorksheet):
+    def get_all_values(self):
+        time.sleep(0.05)
+        return super().get_all_values()
+
+def test_identical_sheet_reads_in_flight_are_shared(load_bot):
+    worksheet = SlowWorksheet(accounts(2))
+    bot = load_bot(worksheet)
+    
+    async def main():
+        first = await asyncio.gather(*[bot.sheets_call(worksheet.get_all_values) for _ in range(5)])
+        assert worksheet.calls.count("get_all_values") == 1
+        assert all(rows == first[0] for rows in first)
+        
+        # A write in between starts a fresh read, so it sees the write
+        before = asyncio.create_task(bot.sheets_call(worksheet.get_all_values))
+        await asyncio.sleep(0)
+        await bot.sheets_call(worksheet.batch_update, [{"range": "E2", "values": [["99"]]}])
+        after = await bot.sheets_call(worksheet.get_all_values)
+        await before
+        assert worksheet.calls.count("get_all_values") == 3
+        assert after[1][4] == "99"
+    
+    asyncio.run(main())
+
+def test_sheet_calls_wait_for_quota_and_retry_429(load_bot):
+    worksheet = FakeWorksheet(accounts(3))
+    bot = load_bot(worksheet)
+    bot.SHEETS_QUOTA.buckets["read"] = bot.TokenBucket(20, 2)
+    bot.SHEETS_RETRY_BASE = 0.01
+    failures = [429]
+    
+    def row_values(row):
+        if failures:
+            response = types.SimpleNamespace(status_code=failures.pop(), text="quota", json=lambda: {})
+            raise gspread.exceptions.APIError(response)
+        return worksheet.row_values(row)
+    
+    async def main():
+        started = time.monotonic()
+        rows = await asyncio.gather(*[bot.sheets_call(worksheet.row_values, row) for row in (1, 2, 3, 4)])
+        # Two reads fit the burst, the rest waited for tokens at 20 a second
+        assert time.monotonic() - started >= 0.09
+        assert rows[1][0] == "1001"
+        assert await bot.sheets_call(row_values, 2) == worksheet.row_values(2)
+        assert bot.SHEETS_RETRIES.values[("row_values",)] == 1
+    
+    asyncio.run(main())
+
+# Bulk commands
+
+@pytest.mark.parametrize("backend, write_behind", [("sheets", "0"), ("sheets", "1"), ("sqlite", "0")])
+def test_bulk_use_is_all_or_nothing(load_bot, backend, write_behind):
+    worksheet = FakeWorksheet(accounts(3))
+    worksheet.data[2][4] = "2"
+    bot = load_bot(worksheet, STORAGE_BACKEND=backend, WRITE_BEHIND=write_behind)
+    
+    async def main():
+        storage = await start_bank(bot)
+        update, context = fake_command(["5", "@user1", "@user2", "@user3"])
+        await bot.bulk_mutation(update, context, "used")
+        assert "insufficient balance for User 2" in update.message.replies[0]
+        
+        # A batch naming an account that is gone changes nothing either
+        assert not await storage.set_balances(
+            [("1001", 0, bot.make_transaction(10, 1, "Owner", "used")), ("9999", 0, None)], "now")
+        
+        assert [(account["user_id"], account["balance"]) for account in await storage.all()] == [
+            ("1001", 10.0), ("1002", 2.0), ("1003", 10.0)]
+        assert [await storage.transaction_count(user_id) for user_id in ("1001", "1002", "1003")] == [0, 0, 0]
+        assert await storage.totals() == (3, 22.0)
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+def test_bulk_add_applies_every_target(load_bot):
+    worksheet = FakeWorksheet(accounts(3))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sheets", WRITE_BEHIND="0")
+    
+    async def main():
+        storage = await start_bank(bot)
+        worksheet.calls.clear()
+        update, context = fake_command(["5", "@user1", "1003=7"])
+        await bot.bulk_mutation(update, context, "added")
+        assert update.message.replies[0].startswith("<b>done!</b>")
+        # Nothing changed between resolving the targets and locking them, so one read does
+        assert worksheet.calls.count("get_all_values") == 1
+        assert [row[4] for row in worksheet.data[1:]] == ["15.0", "10", "17.0"]
+        assert [await storage.transaction_count(user_id) for user_id in ("1001", "1002", "1003")] == [1, 0, 1]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+def test_sqlite_known_balances_looks_up_only_the_given_accounts(load_bot):
+    worksheet = FakeWorksheet(accounts(5))
+    worksheet.data[3][4] = "7"
+    bot = load_bot(worksheet, STORAGE_BACKEND="sqlite")
+    bot.SQLITE_IN_CHUNK = 2
+    
+    async def main():
+        storage = await start_bank(bot)
+        statements = []
+        storage.db.set_trace_callback(statements.append)
+        balances = await storage.known_balances(["1001", "1003", "9999", 1003, "1005"])
+        storage.db.set_trace_callback(None)
+        assert balances == {"1001": 10.0, "1003": 7.0, "1005": 10.0}
+        # Four distinct IDs in chunks of two, each a keyed lookup
+        assert len(statements) == 2
+        assert statements == [
+            "SELECT user_id, balance FROM accounts WHERE user_id IN ('1001', '1003')",
+            "SELECT user_id, balance FROM accounts WHERE user_id IN ('9999', '1005')",
+        ]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+def test_bulk_rejects_an_account_id_in_the_amount_position(load_bot):
+    worksheet = FakeWorksheet(accounts(2))
+    bot = load_bot(worksheet, STORAGE_BACKEND="sqlite")
+    
+    async def main():
+        storage = await start_bank(bot)
+        update, context = fake_command(["1001", "@user2"])
+        await bot.bulk_mutation(update, context, "added")
+        assert "1001 is an account ID" in update.message.replies[0]
+        assert [account["balance"] for account in await storage.all()] == [10.0, 10.0]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+# Per admin totals
+
+@pytest.mark.parametrize("backend", ["sheets", "sqlite"])
+def test_executor_totals_follow_each_transaction(load_bot, backend):
+    bot = load_bot(FakeWorksheet(accounts(1)), STORAGE_BACKEND=backend, WRITE_BEHIND="0")
+    
+    async def main():
+        storage = await start_bank(bot)
+        for amount, executor_id, name, kind in [(5, 7, "Admin", "added"), (3, 8, "Other", "used"), (2, 7, "Admin", "added")]:
+            assert await storage.set_balances([("1001", 0, bot.make_transaction(amount, executor_id, name, kind))], "now")
+        assert await storage.executor_totals("1001") == [
+            {"executor_id": 7, "type": "added", "executor_name": "Admin", "amount": 7.0, "count": 2},
+            {"executor_id": 8, "type": "used", "executor_name": "Other", "amount": 3.0, "count": 1},
+        ]
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+# Roles
+
+def test_roles_claim_legacy_usernames_and_reload_hand_edits(load_bot, tmp_path):
+    with open(tmp_path / "admins.json", "w") as f:
+        json.dump(["Alice"], f)
+    bot = load_bot(ROLES_PATH=str(tmp_path / "roles.json"))
+    roles = bot.RoleRegistry(str(tmp_path / "roles.json"))
+    roles.load()
+    alice = types.SimpleNamespace(id=5, username="alice", first_name="Alice")
+    
+    async def main():
+        # The imported username is bound to the user ID on first sight
+        assert roles.role(alice) == bot.MANAGER
+        await roles.stop()
+        saved = json.load(open(roles.path))
+        assert saved["managers"] == {"5": "@alice"}
+        assert saved["unclaimed"] == {}
+        # A later username change keeps the role
+        assert roles.role(types.SimpleNamespace(id=5, username="alice2", first_name="Alice")) == bot.MANAGER
+        
+        # A hand edit is picked up on the next reload
+        saved["co_owners"] = {"6": "@bob"}
+        with open(roles.path, "w") as f:
+            json.dump(saved, f)
+        os.utime(roles.path, ns=(roles.mtime + 10**9, roles.mtime + 10**9))
+        await roles.reload()
+        assert roles.role(types.SimpleNamespace(id=6, username=None, first_name="Bob")) == bot.CO_OWNER
+        assert roles.members(bot.CO_OWNER) == ["@bob"]
+    
+    asyncio.run(main())
+
+def test_role_changes_from_two_processes_are_both_kept(load_bot, tmp_path):
+    bot = load_bot()
+    path = str(tmp_path / "roles.json")
+    first, second = bot.RoleRegistry(path), bot.RoleRegistry(path)
+    first.load()
+    second.load()
+    
+    async def main():
+        await first.set(types.SimpleNamespace(id=5, username="alice", first_name="Alice"), bot.MANAGER)
+        # second has not reloaded, yet its change starts from the file on disk
+        await second.set(types.SimpleNamespace(id=6, username="bob", first_name="Bob"), bot.CO_OWNER)
+    
+    asyncio.run(main())
+    saved = json.load(open(path))
+    assert (saved["managers"], saved["co_owners"]) == ({"5": "@alice"}, {"6": "@bob"})
+    assert second.roles == {5: bot.MANAGER, 6: bot.CO_OWNER}
+
+def test_edit_json_file_merges_concurrent_edits(load_bot, tmp_path):
+    bot = load_bot()
+    path = str(tmp_path / "config.json")
+    
+    def add_groups(first):
+        for group_id in range(first, first + 50):
+            bot.edit_json_file(path, lambda config: config.setdefault("connected_groups", []).append(group_id))
+    
+    async def main():
+        await asyncio.gather(*(asyncio.to_thread(add_groups, first) for first in (0, 100, 200)))
+    
+    asyncio.run(main())
+    assert sorted(json.load(open(path))["connected_groups"]) == [*range(50), *range(100, 150), *range(200, 250)]
+
+# Multiple banks
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        worksheet = self.worksheets[title] = FakeWorksheet()
+        worksheet.title = title
+        worksheet.data = []
+        return worksheet
+
+def test_banks_evict_the_least_recently_used_idle_bank(load_bot, tmp_path):
+    worksheet = FakeWorksheet()
+    worksheet.spreadsheet = FakeSpreadsheet()
+    bot = load_bot(worksheet, STORAGE_BACKEND="sqlite", BANK_CACHE_SIZE="2")
+    
+    async def main():
+        await start_bank(bot)
+        banks = bot.BankRegistry()
+        a = await banks.get("a")
+        await banks.get("b")
+        assert await banks.get("a") is a
+        with banks.using("b"):
+            await banks.get("c")
+            await asyncio.sleep(0)
+            # b is in use, so a goes even though b was used less recently
+            assert list(banks.loaded) == ["b", "c"]
+        assert worksheet.spreadsheet.worksheets["a"].data == [bot.SHEET_HEADER]
+        assert os.path.exists(tmp_path / "bank.a.db")
+        
+        # A bank loaded again after eviction comes back with its accounts
+        with banks.using("a"):
+            assert await (await banks.current()).create(1001, "User", "", "link")
+        await banks.get("b")
+        await banks.get("c")
+        await asyncio.sleep(0)
+        assert "a" not in banks.loaded
+        assert [account["user_id"] for account in await (await banks.get("a")).all()] == ["1001"]
+        await banks.stop()
+        await bot.stop_storage()
+    
+    asyncio.run(main())
+
+def test_connect_rejects_bad_bank_names(load_bot):
+    bot = load_bot()
+    assert bot.BANK_NAME.fullmatch("shop_2-b")
+    assert not any(bot.BANK_NAME.fullmatch(name) for name in ["", "a" * 33, "my bank", "../etc", "shop!"])
+
+def test_bank_names_cannot_reuse_another_tab(load_bot):
+    worksheet = FakeWorksheet()
+    worksheet.spreadsheet = FakeSpreadsheet()
+    notes = worksheet.spreadsheet.add_worksheet("notes", 1, 1)
+    notes.data = [["Date", "Note"]]
+    worksheet.spreadsheet.add_worksheet("blank", 1, 1)
+    bot = load_bot(worksheet)
+    bot.GROUP_BANKS[-1] = "Shop"
+    
+    async def main():
+        assert bot.canonical_bank_name("SHOP") == "Shop"
+        assert bot.canonical_bank_name("other") == "other"
+        for bank, reason in [("sheet1", "default bank"), ("notes", "does not hold a bank")]:
+            with pytest.raises(ValueError, match=reason):
+                await bot.open_bank_worksheet(bank)
+        # An empty tab is taken over and given the header
+        await bot.open_bank_worksheet("blank")
+        assert worksheet.spreadsheet.worksheets["blank"].data == [bot.SHEET_HEADER]
+    
+    asyncio.run(main())
+
+# Worker mode
+
+def chat_updates(chat_ids):
+    return [telegram.Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "group"}, "text": "/bal"},
+    }, None) for update_id, chat_id in enumerate(chat_ids, 1)]
+
+class FakeTelegram:
+    """Bot stand-in for the ingress: one batch of updates, then empty polls"""
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.offsets = []
+
+    def __call__(self, token):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def delete_webhook(self):
+        pass
+
+    async def get_updates(self, offset=None, timeout=0, limit=100, allowed_updates=None):
+        self.offsets.append(offset)
+        updates, self.updates = self.updates, []
+        if not updates:
+            await asyncio.sleep(timeout)
+        return updates
+
+def consecutive_free_ports(count):
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            first = probe.getsockname()[1]
+        sockets = []
+        try:
+            for port in range(first, first + count):
+                sockets.append(socket.socket())
+                sockets[-1].bind(("127.0.0.1", port))
+            return first
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+def test_ingress_routes_each_chat_to_one_worker_in_order(load_bot):
+    bot = load_bot(STORAGE_BACKEND="sqlite", WORKERS="2", WORKER_PORT=str(consecutive_free_ports(2)))
+    bot.INGRESS_POLL_TIMEOUT = 0.05
+    telegram_api = bot.Bot = FakeTelegram(chat_updates([-4, -5, -4, -7, -4, -5]))
+    received = {0: [], 1: []}
+    stopping = []
+    
+    async def supervise_worker(index, secret, processes, event):
+        stopping.append(event)
+        await asyncio.Event().wait()
+    bot.supervise_worker = supervise_worker
+    
+    async def main():
+        servers = []
+        for index in range(2):
+            failed = []
+            
+            async def worker(method, headers, body, index=index, failed=failed):
+                # Worker 1 is still starting when the first update arrives
+                if index == 1 and not failed:
+                    failed.append(True)
+                    return 503, "text/plain", b"Service Unavailable"
+                received[index].append(json.loads(body)["update_id"])
+                if sum(map(len, received.values())) == 6:
+                    stopping[0].set()
+                return 200, "text/plain", b"OK"
+            servers.append(await bot.start_http_server("127.0.0.1", bot.WORKER_PORT + index, {bot.WEBHOOK_PATH: worker}))
+        await asyncio.wait_for(bot.run_ingress(), 10)
+        for server in servers:
+            server.close()
+    
+    asyncio.run(main())
+    # Chat IDs are negative for groups; Python's modulo keeps the owner stable
+    assert received == {0: [1, 3, 5], 1: [2, 4, 6]}
+    assert telegram_api.offsets[-1] == 7
+
+def test_ingress_confirms_only_updates_a_worker_accepted(load_bot):
+    bot = load_bot(STORAGE_BACKEND="sqlite", WORKERS="2", WORKER_PORT=str(consecutive_free_ports(2)))
+    bot.INGRESS_POLL_TIMEOUT = 0.05
+    bot.INGRESS_DRAIN_TIMEOUT = 0.2
+    telegram_api = bot.Bot = FakeTelegram(chat_updates([-4, -5, -4]))
+    received = []
+    stopping = []
+    
+    async def supervise_worker(index, secret, processes, event):
+        stopping.append(event)
+        await asyncio.Event().wait()
+    bot.supervise_worker = supervise_worker
+    
+    async def worker(method, headers, body):
+        received.append(json.loads(body)["update_id"])
+        if len(received) == 2:
+            stopping[0].set()
+        return 200, "text/plain", b"OK"
+    
+    async def main():
+        # Only worker 0 is up; worker 1 never answers
+        server = await bot.start_http_server("127.0.0.1", bot.WORKER_PORT, {bot.WEBHOOK_PATH: worker})
+        await asyncio.wait_for(bot.run_ingress(), 10)
+        server.close()
+    
+    asyncio.run(main())
+    assert received == [1, 3]
+    # Update 2 was never handed over, so Telegram is told only about update 1
+    assert telegram_api.offsets[-1] == 2